@@ -0,0 +1,348 @@
+"""
+Admission Control Module
+
+Generation is admitted through a bounded queue in front of the local model
+instead of letting requests pile up in the web server until a timeout kills
+them. Each arriving request is either:
+
+1. Admitted straight away when a generation slot is free
+2. Queued, when its estimated wait is acceptable
+3. Shed immediately with a ``Retry-After`` hint: 429 when the user already
+   has too many requests waiting, 503 when the queue is full or the wait
+   would exceed ADMISSION_MAX_WAIT_SECONDS
+
+Waiting requests are served round-robin across users (one request per user
+per turn), so a user with many requests in flight cannot starve the others.
+The wait estimate uses the same rotation: the requests served ahead of a
+new one, times the smoothed local generation time, divided by the slots.
+
+Queues are per worker process, like the model itself. Threads wait with
+``acquire``; coroutines in async views wait with ``acquire_async``, which
+holds no thread while queued.
+"""
+
+import asyncio
+import math
+import threading
+from collections import deque
+from django.conf import settings
+
+from .monitoring import get_generation_rates, record_shed_request, set_gauge
+
+# Concurrent generations; the local model is a single llama.cpp instance
+ADMISSION_CONCURRENCY = getattr(
+    settings, 'ADMISSION_CONCURRENCY', getattr(settings, 'DISTRIBUTED_LOCAL_CONCURRENCY', 1)
+)
+ADMISSION_MAX_QUEUE = getattr(settings, 'ADMISSION_MAX_QUEUE', 16)  # waiting requests per process
+ADMISSION_MAX_QUEUED_PER_USER = getattr(settings, 'ADMISSION_MAX_QUEUED_PER_USER', 2)
+# Requests whose estimated wait is longer are shed (seconds); the frontend gives up after 60
+ADMISSION_MAX_WAIT_SECONDS = getattr(settings, 'ADMISSION_MAX_WAIT_SECONDS', 30)
+# A queued request that has waited this long is shed after all (seconds)
+ADMISSION_QUEUE_TIMEOUT = getattr(settings, 'ADMISSION_QUEUE_TIMEOUT', 45)
+# Generation time assumed until one has been measured (seconds)
+ADMISSION_DEFAULT_SERVICE_SECONDS = getattr(settings, 'ADMISSION_DEFAULT_SERVICE_SECONDS', 15)
+
+SHED_REASONS = ('user_limit', 'queue_full', 'wait_too_long', 'timed_out')
+
+
+class AdmissionRejected(Exception):
+    """
+    A request was shed instead of queued.
+
+    Attributes:
+        status: HTTP status to answer with (429 or 503)
+        reason: One of SHED_REASONS
+        retry_after: Whole seconds the client should wait before retrying
+        estimated_wait: The wait estimate (seconds) that led to the decision
+    """
+
+    def __init__(self, status, reason, retry_after, estimated_wait, message):
+        super().__init__(message)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+        self.estimated_wait = estimated_wait
+        self.message = message
+
+
+class _Ticket:
+    """A queued request, woken by an event (threads) or a future (coroutines)."""
+
+    __slots__ = ('user', 'granted', '_event', '_loop', '_future')
+
+    def __init__(self, user, loop=None):
+        self.user = user
+        self.granted = False
+        self._loop = loop
+        if loop is None:
+            self._event = threading.Event()
+        else:
+            self._future = loop.create_future()
+
+    def grant(self):
+        self.granted = True
+        if self._loop is None:
+            self._event.set()
+        else:
+            self._loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self):
+        if not self._future.done():
+            self._future.set_result(None)
+
+    def wait(self, timeout):
+        self._event.wait(timeout)
+
+    async def wait_async(self, timeout):
+        try:
+            await asyncio.wait_for(self._future, timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+class AdmissionController:
+    """
+    Bounded, per-user fair queue in front of a fixed number of generation slots.
+
+    Args:
+        slots: Concurrent generations
+        max_queue: Waiting requests beyond which new ones are shed
+        max_queued_per_user: Waiting requests one user may have
+        max_wait: Largest acceptable estimated wait (seconds)
+        queue_timeout: Longest a request may actually wait (seconds)
+        service_seconds: Fixed generation time for the estimate; None uses the
+            measured local generation time
+    """
+
+    def __init__(self, slots=ADMISSION_CONCURRENCY, max_queue=ADMISSION_MAX_QUEUE,
+                 max_queued_per_user=ADMISSION_MAX_QUEUED_PER_USER, max_wait=ADMISSION_MAX_WAIT_SECONDS,
+                 queue_timeout=ADMISSION_QUEUE_TIMEOUT, service_seconds=None):
+        self.slots = max(1, slots)
+        self.max_queue = max_queue
+        self.max_queued_per_user = max_queued_per_user
+        self.max_wait = max_wait
+        self.queue_timeout = queue_timeout
+        self.service_seconds = service_seconds
+        self._queues = {}  # user -> deque of waiting tickets
+        self._turns = deque()  # users with waiting tickets, in serving order
+        self._waiting = 0
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._stats = {'admitted': 0, 'queued': 0, 'shed': dict.fromkeys(SHED_REASONS, 0)}
+
+    def _service_seconds(self):
+        if self.service_seconds is not None:
+            return self.service_seconds
+        return get_generation_rates().get('generation_seconds') or ADMISSION_DEFAULT_SERVICE_SECONDS
+
+    def _estimate_wait(self, user, service_seconds):
+        # Called with self._lock held. Round-robin serves every other user's
+        # first (own + 1) requests before this user's next one.
+        if self._in_flight < self.slots and not self._waiting:
+            return 0.0
+        own = len(self._queues.get(user, ()))
+        ahead = own + sum(min(len(queue), own + 1) for other, queue in self._queues.items() if other != user)
+        # Conservatively assume the running generations have just started
+        return (ahead + 1) * service_seconds / self.slots
+
+    def estimate_wait(self, user=None):
+        """Estimated seconds a new request from ``user`` would wait for a slot."""
+        service_seconds = self._service_seconds()
+        with self._lock:
+            return self._estimate_wait(user, service_seconds)
+
+    def _shed(self, status, reason, retry_after, estimated_wait, message):
+        # Called with self._lock held
+        self._stats['shed'][reason] += 1
+        record_shed_request(reason)
+        return AdmissionRejected(status, reason, max(1, math.ceil(retry_after)), estimated_wait, message)
+
+    def _enqueue(self, user, service_seconds, loop=None):
+        """Take a free slot (returns an Admission), queue a ticket (returns it), or raise."""
+        with self._lock:
+            if self._in_flight < self.slots and not self._waiting:
+                self._in_flight += 1
+                self._stats['admitted'] += 1
+                self._publish()
+                return Admission(self)
+
+            estimated_wait = self._estimate_wait(user, service_seconds)
+            rejection = None
+            if len(self._queues.get(user, ())) >= self.max_queued_per_user:
+                rejection = self._shed(
+                    429, 'user_limit', estimated_wait, estimated_wait,
+                    "You already have requests waiting. Please wait for them to finish."
+                )
+            elif self._waiting >= self.max_queue:
+                rejection = self._shed(
+                    503, 'queue_full', service_seconds / self.slots, estimated_wait,
+                    "The assistant is at capacity right now. Please try again shortly."
+                )
+            elif estimated_wait > self.max_wait:
+                rejection = self._shed(
+                    503, 'wait_too_long', max(estimated_wait - self.max_wait, service_seconds / self.slots),
+                    estimated_wait, "The assistant is at capacity right now. Please try again shortly."
+                )
+            if rejection is not None:
+                raise rejection
+
+            ticket = _Ticket(user, loop)
+            queue = self._queues.get(user)
+            if queue is None:
+                queue = self._queues[user] = deque()
+                self._turns.append(user)
+            queue.append(ticket)
+            self._waiting += 1
+            self._stats['queued'] += 1
+            self._publish()
+            return ticket
+
+    def _dequeue(self, ticket):
+        # Called with self._lock held, for a ticket that was never granted
+        queue = self._queues[ticket.user]
+        queue.remove(ticket)
+        if not queue:
+            del self._queues[ticket.user]
+            self._turns.remove(ticket.user)
+        self._waiting -= 1
+        self._publish()
+
+    def _finish_wait(self, ticket, service_seconds):
+        with self._lock:
+            if ticket.granted:
+                self._stats['admitted'] += 1
+                return Admission(self)
+            # Still queued: leave the queue and give up
+            self._dequeue(ticket)
+            raise self._shed(
+                503, 'timed_out', service_seconds / self.slots, self.queue_timeout,
+                "The assistant is taking too long to respond. Please try again shortly."
+            )
+
+    def acquire(self, user):
+        """
+        Wait for a generation slot.
+
+        Args:
+            user: Key the request is queued under (e.g. the user id)
+
+        Returns:
+            Admission: Context manager that releases the slot on exit
+
+        Raises:
+            AdmissionRejected: If the request is shed
+        """
+        service_seconds = self._service_seconds()
+        ticket = self._enqueue(user, service_seconds)
+        if isinstance(ticket, Admission):
+            return ticket
+        ticket.wait(self.queue_timeout)
+        return self._finish_wait(ticket, service_seconds)
+
+    async def acquire_async(self, user):
+        """
+        Coroutine version of ``acquire`` that waits without holding a thread.
+
+        If the waiting coroutine is cancelled (e.g. the client disconnected),
+        the request leaves the queue, or passes on a slot granted meanwhile.
+        """
+        service_seconds = self._service_seconds()
+        ticket = self._enqueue(user, service_seconds, asyncio.get_running_loop())
+        if isinstance(ticket, Admission):
+            return ticket
+        try:
+            await ticket.wait_async(self.queue_timeout)
+        except BaseException:
+            with self._lock:
+                granted = ticket.granted
+                if not granted:
+                    self._dequeue(ticket)
+            if granted:
+                self.release()
+            raise
+        return self._finish_wait(ticket, service_seconds)
+
+    def release(self):
+        """Hand the slot to the next waiting user in turn, or free it."""
+        with self._lock:
+            if self._turns:
+                user = self._turns.popleft()
+                queue = self._queues[user]
+                ticket = queue.popleft()
+                if queue:
+                    self._turns.append(user)
+                else:
+                    del self._queues[user]
+                self._waiting -= 1
+                ticket.grant()
+            else:
+                self._in_flight -= 1
+            self._publish()
+
+    def _publish(self):
+        # Called with self._lock held
+        set_gauge('admission_queue_depth', self._waiting)
+        set_gauge('admission_in_flight', self._in_flight)
+
+    def stats(self):
+        """Return slot, queue and shed counts of this process."""
+        service_seconds = self._service_seconds()
+        with self._lock:
+            return {
+                'slots': self.slots,
+                'in_flight': self._in_flight,
+                'waiting': self._waiting,
+                'users_waiting': len(self._queues),
+                'estimated_wait': round(self._estimate_wait(None, service_seconds), 1),
+                'admitted': self._stats['admitted'],
+                'queued': self._stats['queued'],
+                'shed': dict(self._stats['shed']),
+            }
+
+
+class Admission:
+    """A held generation slot; releases it when the ``with`` block exits."""
+
+    def __init__(self, controller):
+        self._controller = controller
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._controller.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def get_admission_controller():
+    """Return this process's admission controller."""
+    global _controller
+    if _controller is None:
+        with _controller_lock:
+            if _controller is None:
+                _controller = AdmissionController()
+    return _controller
+
+
+def acquire_generation_slot(user):
+    """Shortcut for ``get_admission_controller().acquire(user)``."""
+    return get_admission_controller().acquire(user)
+
+
+async def acquire_generation_slot_async(user):
+    """Shortcut for ``get_admission_controller().acquire_async(user)``."""
+    return await get_admission_controller().acquire_async(user)
+
+
+def get_admission_stats():
+    """Return this process's admission statistics."""
+    return get_admission_controller().stats()
@@ -7,14 +7,23 @@ for the LLM service. It includes:
 1. Configuration for EC2 Auto Scaling Groups
 2. Functions to set up and manage a ECS cluster for horizontal scaling
 3. Functions to monitor and report on distributed inference performance
+
+Scaling decisions come from a pluggable policy (see scaling_policy.py)
+driven by queue depth, token throughput and p95 latency. On top of that,
+capacity is raised ahead of forecast traffic peaks (see traffic_forecast.py)
+by the measured instance cold-start time.
 """
 
 import boto3
+import numpy as np
 import os
 import json
 import time
 from threading import Thread
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+
+from .scaling_policy import get_scaling_policy, SCALING_TARGET_UTILIZATION
+from .traffic_forecast import TrafficForecaster, plan_capacity, apply_forecast, FORECAST_HISTORY_WEEKS
 
 class AWSScalingManager:
     """
@@ -32,8 +41,32 @@ class AWSScalingManager:
         self.ecs = boto3.client('ecs', region_name=self.region)
         self.cloudwatch = boto3.client('cloudwatch', region_name=self.region)
         
+        # Metrics published by the service itself (see monitoring.py)
+        self.service_namespace = 'AI/LLMService'
+        self.environment = os.environ.get('ENVIRONMENT', 'development')
+        # Append every evaluated sample and decision here (JSON lines) for offline replay
+        self.trace_file = os.environ.get('SCALING_TRACE_FILE')
+        
         # Store current metrics
         self.current_metrics = {}
+        self.policy = get_scaling_policy()
+        self.last_decision = None
+        self.last_sample = None
+        
+        # Predictive pre-scaling from historical traffic
+        self.predictive_enabled = os.environ.get('SCALING_PREDICTIVE_ENABLED', 'True').lower() == 'true'
+        # Log what pre-scaling would do without changing capacity
+        self.predictive_dry_run = os.environ.get('SCALING_PREDICTIVE_DRY_RUN', 'True').lower() == 'true'
+        self.forecast_refit_interval = int(os.environ.get('FORECAST_REFIT_INTERVAL', 6 * 3600))
+        # Used until a launch has been measured: instance boot plus model download and load
+        self.default_cold_start = float(os.environ.get('SCALING_COLD_START_SECONDS', 600))
+        # Added to measured ASG launch times, which end before the model is loaded
+        self.model_load_seconds = float(os.environ.get('SCALING_MODEL_LOAD_SECONDS', 180))
+        # Mean seconds one request occupies a generation slot, until measured locally
+        self.default_service_seconds = float(os.environ.get('SCALING_SERVICE_SECONDS', 15))
+        self.instance_slots = int(os.environ.get('SCALING_INSTANCE_SLOTS', 1))
+        self.forecaster = TrafficForecaster()
+        self.last_forecast = None
         
     def setup_auto_scaling_group(self):
         """
@@ -227,68 +260,232 @@ class AWSScalingManager:
         except Exception as e:
             print(f"Error getting LLM custom metrics: {str(e)}")
         
+        # Queue depth, throughput and latency published by every instance
+        service_metrics = (
+            ('QueueDepth', 'Average', 'queue_depth'),
+            ('TokensPerSecond', 'Average', 'tokens_per_sec'),
+            ('LatencyP95', 'Maximum', 'p95_latency'),
+        )
+        for metric_name, statistic, key in service_metrics:
+            try:
+                response = self.cloudwatch.get_metric_statistics(
+                    Namespace=self.service_namespace,
+                    MetricName=metric_name,
+                    Dimensions=[
+                        {
+                            'Name': 'Environment',
+                            'Value': self.environment
+                        }
+                    ],
+                    StartTime=start_time,
+                    EndTime=end_time,
+                    Period=60,
+                    Statistics=[statistic]
+                )
+                
+                if response['Datapoints']:
+                    latest_point = sorted(response['Datapoints'], key=lambda x: x['Timestamp'])[-1]
+                    metrics[key] = latest_point[statistic]
+            except Exception as e:
+                print(f"Error getting {metric_name} metrics: {str(e)}")
+        
         self.current_metrics.update(metrics)
         return metrics
     
-    def should_scale_out(self):
+    def get_scaling_sample(self):
         """
-        Determine if the service should scale out based on metrics
+        Build a scaling policy sample from the latest capacity and metrics.
         """
-        # Get latest metrics
-        self.get_current_capacity()
-        self.get_scaling_metrics()
+        metrics = self.current_metrics
+        if 'asg_desired_capacity' in metrics:
+            capacity = metrics['asg_desired_capacity']
+            min_capacity = metrics.get('asg_min_size')
+            max_capacity = metrics.get('asg_max_size')
+        else:
+            capacity = metrics.get('ecs_desired_count') or metrics.get('ecs_tasks') or 1
+            min_capacity = int(os.environ.get('ECS_MIN_CAPACITY', 2))
+            max_capacity = int(os.environ.get('ECS_MAX_CAPACITY', 10))
         
-        # Check CPU utilization
-        cpu_high = self.current_metrics.get('llm_cpu_utilization_avg', 0) > 70
+        return {
+            'timestamp': time.time(),
+            'capacity': capacity,
+            'min_capacity': min_capacity,
+            'max_capacity': max_capacity,
+            'pending': metrics.get('ecs_pending_count', 0) > 0,
+            'queue_depth': metrics.get('queue_depth'),
+            'tokens_per_sec': metrics.get('tokens_per_sec'),
+            'p95_latency': metrics.get('p95_latency'),
+            'cpu_utilization': metrics.get('llm_cpu_utilization_avg'),
+        }
+    
+    def measure_cold_start(self):
+        """
+        Estimate seconds from launching an instance to it serving requests.
         
-        # Check if we're already at maximum capacity
-        at_max_capacity = False
-        if self.asg_name and 'asg_desired_capacity' in self.current_metrics:
-            at_max_capacity = (self.current_metrics['asg_desired_capacity'] >= 
-                              self.current_metrics['asg_max_size'])
+        Uses the median duration of recent successful ASG launch activities
+        plus the model load time, or SCALING_COLD_START_SECONDS if none exist.
+        """
+        if not self.asg_name:
+            return self.default_cold_start
+        try:
+            response = self.autoscaling.describe_scaling_activities(
+                AutoScalingGroupName=self.asg_name,
+                MaxRecords=50
+            )
+            durations = [
+                (activity['EndTime'] - activity['StartTime']).total_seconds()
+                for activity in response.get('Activities', [])
+                if activity.get('StatusCode') == 'Successful'
+                and activity.get('EndTime')
+                and 'Launching' in activity.get('Description', '')
+            ]
+            if durations:
+                return float(np.median(durations)) + self.model_load_seconds
+        except Exception as e:
+            print(f"Error measuring instance cold start: {str(e)}")
+        return self.default_cold_start
+    
+    def fit_forecaster(self, now=None):
+        """
+        Refit the traffic forecaster on recent Chat creation times.
+        """
+        from .models import Chat
         
-        # Check if there are pending scaling actions
-        has_pending_actions = False
-        if self.ecs_cluster and self.ecs_service:
-            has_pending_actions = (self.current_metrics.get('ecs_pending_count', 0) > 0)
+        now = now or time.time()
+        since = datetime.fromtimestamp(now - FORECAST_HISTORY_WEEKS * 7 * 24 * 3600, tz=timezone.utc)
+        created = Chat.objects.filter(created_at__gte=since).values_list('created_at', flat=True)
+        timestamps = np.fromiter((c.timestamp() for c in created.iterator()), dtype=np.float64)
+        self.forecaster.fit(timestamps, now)
+        print(f"Fitted traffic forecast on {timestamps.size} requests, trend x{self.forecaster.trend:.2f}")
+        return self.forecaster
+    
+    def apply_forecast(self, decision):
+        """
+        Raise a policy decision to the capacity the traffic forecast needs.
         
-        # Decision logic
-        should_scale = cpu_high and not at_max_capacity and not has_pending_actions
+        Capacity that will be needed within one cold start from now has to
+        be requested now. The forecast only ever adds capacity or blocks
+        scale-in; it never removes instances. In dry-run mode the adjusted
+        decision is logged and the original one returned.
         
-        if should_scale:
-            print("Recommending scale out based on high CPU utilization")
+        Args:
+            decision: Decision from ``evaluate_scaling``
+            
+        Returns:
+            dict: The decision to act on
+        """
+        if not self.predictive_enabled or self.last_sample is None:
+            return decision
         
-        return should_scale
+        now = time.time()
+        try:
+            if self.forecaster.fitted_at is None or now - self.forecaster.fitted_at > self.forecast_refit_interval:
+                self.fit_forecaster(now)
+            
+            from .monitoring import get_generation_rates
+            service_seconds = get_generation_rates().get('generation_seconds') or self.default_service_seconds
+            plan = plan_capacity(
+                self.forecaster, now, self.measure_cold_start(), service_seconds,
+                slots=self.instance_slots, target_utilization=SCALING_TARGET_UTILIZATION
+            )
+        except Exception as e:
+            print(f"Error forecasting traffic: {str(e)}")
+            return decision
+        
+        sample = self.last_sample
+        self.last_forecast = plan
+        adjusted = apply_forecast(decision, plan, sample['min_capacity'], sample['max_capacity'])
+        if adjusted is decision:
+            return decision
+        
+        if self.predictive_dry_run:
+            if adjusted['action'] != decision['action']:
+                print(f"[dry run] Predictive scaling would {adjusted['action']} "
+                      f"{decision['capacity']} -> {adjusted['desired']} ({adjusted['reason']}) "
+                      f"instead of {decision['action']}")
+            return decision
+        if adjusted['action'] == 'scale_out':
+            print(f"Pre-scaling {decision['capacity']} -> {adjusted['desired']}: {adjusted['reason']}")
+        return adjusted
     
-    def should_scale_in(self):
+    def evaluate_scaling(self):
         """
-        Determine if the service should scale in based on metrics
+        Refresh metrics and run the scaling policy once.
+        
+        Returns:
+            dict: The policy decision (action, desired capacity, reason)
         """
-        # Get latest metrics
         self.get_current_capacity()
         self.get_scaling_metrics()
+        sample = self.get_scaling_sample()
+        decision = self.policy.evaluate(sample)
+        self.last_sample = sample
+        self.last_decision = decision
         
-        # Check CPU utilization (low for scale in)
-        cpu_low = self.current_metrics.get('llm_cpu_utilization_avg', 100) < 30
-        
-        # Check if we're already at minimum capacity
-        at_min_capacity = False
-        if self.asg_name and 'asg_desired_capacity' in self.current_metrics:
-            at_min_capacity = (self.current_metrics['asg_desired_capacity'] <= 
-                              self.current_metrics['asg_min_size'])
-        
-        # Check if there are pending scaling actions
-        has_pending_actions = False
-        if self.ecs_cluster and self.ecs_service:
-            has_pending_actions = (self.current_metrics.get('ecs_pending_count', 0) > 0)
+        if self.trace_file:
+            try:
+                with open(self.trace_file, 'a') as f:
+                    f.write(json.dumps({'sample': sample, 'decision': decision}) + "\n")
+            except Exception as e:
+                print(f"Error writing scaling trace: {str(e)}")
         
-        # Decision logic - don't scale in if at minimum or if already scaling
-        should_scale = cpu_low and not at_min_capacity and not has_pending_actions
+        if decision['action'] != 'hold':
+            print(f"Recommending {decision['action']} to {decision['desired']}: {decision['reason']}")
+        return decision
+    
+    def apply_scaling_decision(self, decision):
+        """
+        Set the ASG desired capacity or ECS desired count from a decision.
         
-        if should_scale:
-            print("Recommending scale in based on low CPU utilization")
+        Returns:
+            bool: True if a change was requested
+        """
+        if decision['action'] == 'hold':
+            return False
+        try:
+            if self.asg_name:
+                self.autoscaling.set_desired_capacity(
+                    AutoScalingGroupName=self.asg_name,
+                    DesiredCapacity=decision['desired'],
+                    HonorCooldown=False  # the policy applies its own cooldowns
+                )
+            elif self.ecs_cluster and self.ecs_service:
+                self.ecs.update_service(
+                    cluster=self.ecs_cluster,
+                    service=self.ecs_service,
+                    desiredCount=decision['desired']
+                )
+            else:
+                return False
+            print(f"Scaled {decision['capacity']} -> {decision['desired']}")
+            return True
+        except Exception as e:
+            print(f"Error applying scaling decision: {str(e)}")
+            return False
+    
+    def current_decision(self):
+        """
+        Return the policy decision of the latest scaling tick.
         
-        return should_scale
+        Evaluating again would advance the policy's cooldown and stability
+        state, so the cached decision is reused; the policy is only run here
+        if no tick has happened yet.
+        """
+        if self.last_decision is None:
+            return self.evaluate_scaling()
+        return self.last_decision
+    
+    def should_scale_out(self):
+        """
+        Determine if the service should scale out based on metrics
+        """
+        return self.current_decision()['action'] == 'scale_out'
+    
+    def should_scale_in(self):
+        """
+        Determine if the service should scale in based on metrics
+        """
+        return self.current_decision()['action'] == 'scale_in'
 
 # Create a global instance for use throughout the application
 aws_scaling_manager = AWSScalingManager()
@@ -299,13 +496,16 @@ def setup_aws_auto_scaling():
     """
     # This could be called during Django's AppConfig.ready() method
     manager = aws_scaling_manager
+    # Act on policy decisions instead of only logging them
+    apply_decisions = os.environ.get('SCALING_APPLY_DECISIONS', 'False').lower() == 'true'
     
     # Start a background thread to monitor and manage scaling
     def monitor_scaling():
         while True:
             try:
-                manager.get_current_capacity()
-                manager.get_scaling_metrics()
+                decision = manager.apply_forecast(manager.evaluate_scaling())
+                if apply_decisions:
+                    manager.apply_scaling_decision(decision)
                 
                 # Log current state
                 print(f"Current scaling state: {json.dumps(manager.current_metrics)}")
@@ -0,0 +1,121 @@
+"""
+Blob Store Module
+
+Lambda payloads above the 6 MB invocation limit are uploaded here and
+passed by reference instead of being truncated.
+
+Stores:
+1. S3BlobStore - objects in LAMBDA_PAYLOAD_BUCKET, readable by the Lambda
+   function
+2. LocalBlobStore - files in LAMBDA_PAYLOAD_DIR, a stand-in for running and
+   testing the offload path without AWS
+
+Both return a reference dict (``{"store": ..., "key": ...}``) that is put
+in the Lambda payload and resolved with the store's ``get(reference)``.
+"""
+
+import logging
+import os
+import tempfile
+import uuid
+import boto3
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+LAMBDA_PAYLOAD_BUCKET = getattr(settings, 'LAMBDA_PAYLOAD_BUCKET', None)
+LAMBDA_PAYLOAD_PREFIX = getattr(settings, 'LAMBDA_PAYLOAD_PREFIX', 'lambda-payloads/')
+LAMBDA_PAYLOAD_DIR = getattr(
+    settings, 'LAMBDA_PAYLOAD_DIR', os.path.join(tempfile.gettempdir(), 'lambda-payloads')
+)
+
+
+def _new_key(prefix=''):
+    return f"{prefix}{uuid.uuid4().hex}"
+
+
+class S3BlobStore:
+    """
+    Store blobs as S3 objects.
+
+    Objects should be expired by a bucket lifecycle rule; the Lambda
+    function may delete them once read.
+
+    Args:
+        client: boto3 ``s3`` client
+        bucket: Bucket name
+        prefix: Key prefix for payload objects
+    """
+
+    name = 's3'
+
+    def __init__(self, client, bucket, prefix=LAMBDA_PAYLOAD_PREFIX):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def put(self, data, content_type='application/octet-stream'):
+        key = _new_key(self.prefix)
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=data, ContentType=content_type)
+        return {'store': self.name, 'bucket': self.bucket, 'key': key, 'size': len(data)}
+
+    def get(self, reference):
+        response = self.client.get_object(Bucket=reference.get('bucket', self.bucket), Key=reference['key'])
+        return response['Body'].read()
+
+    def delete(self, reference):
+        self.client.delete_object(Bucket=reference.get('bucket', self.bucket), Key=reference['key'])
+
+
+class LocalBlobStore:
+    """
+    Store blobs as files in a local directory.
+
+    Args:
+        directory: Directory for blob files (created on first write)
+    """
+
+    name = 'local'
+
+    def __init__(self, directory=LAMBDA_PAYLOAD_DIR):
+        self.directory = directory
+
+    def _path(self, key):
+        # Keys are generated here, but never let a reference escape the directory
+        return os.path.join(self.directory, os.path.basename(key))
+
+    def put(self, data, content_type='application/octet-stream'):
+        os.makedirs(self.directory, exist_ok=True)
+        key = _new_key()
+        with open(self._path(key), 'wb') as f:
+            f.write(data)
+        return {'store': self.name, 'key': key, 'size': len(data)}
+
+    def get(self, reference):
+        with open(self._path(reference['key']), 'rb') as f:
+            return f.read()
+
+    def delete(self, reference):
+        try:
+            os.remove(self._path(reference['key']))
+        except FileNotFoundError:
+            pass
+
+
+_blob_store = None
+
+
+def get_blob_store():
+    """
+    Return the configured blob store: S3 if LAMBDA_PAYLOAD_BUCKET is set,
+    otherwise the local directory stand-in.
+    """
+    global _blob_store
+    if _blob_store is None:
+        if LAMBDA_PAYLOAD_BUCKET:
+            client = boto3.client('s3', region_name=getattr(settings, 'AWS_REGION', 'us-east-1'))
+            _blob_store = S3BlobStore(client, LAMBDA_PAYLOAD_BUCKET)
+        else:
+            _blob_store = LocalBlobStore()
+            logger.info(f"LAMBDA_PAYLOAD_BUCKET not set, storing large payloads in {LAMBDA_PAYLOAD_DIR}")
+    return _blob_store
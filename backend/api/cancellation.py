@@ -0,0 +1,144 @@
+"""
+Generation Cancellation Module
+
+Cooperative cancellation for generations nobody will read. A running
+generation holds a CancelToken; the decode loop in ``generate_response``
+checks it after every token and stops as soon as it is set. A token is set
+when:
+
+1. The client disconnects: the request's socket (``gunicorn.socket`` under
+   gunicorn) reads as closed, or the WebSocket / async view is torn down
+2. The client asks: ``request_cancel`` from the cancel API or a WebSocket
+   "cancel" frame
+3. The server deadline passes: GENERATION_DEADLINE_SECONDS after the request
+   arrived, just before the frontend's 60 s timeout gives up on it
+
+Generations are registered per (user, chat session). A cancel request also
+stores its time in the Django cache, so with a shared cache it reaches the
+generation whichever worker is running it; generations registered after
+the cancel ignore it. The socket and cache are polled at most every
+CANCEL_CHECK_INTERVAL seconds, not on every token.
+"""
+
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.cache import cache
+
+# Generations still running this long after the request arrived are stopped (seconds)
+GENERATION_DEADLINE_SECONDS = getattr(settings, 'GENERATION_DEADLINE_SECONDS', 55)
+CANCEL_CHECK_INTERVAL = getattr(settings, 'CANCEL_CHECK_INTERVAL', 0.25)  # seconds
+CANCEL_KEY_PREFIX = "generation_cancel:"
+CANCEL_FLAG_TTL = 120  # seconds
+
+CANCEL_REASONS = ('client', 'disconnect', 'deadline')
+
+_PEEK_FLAGS = socket.MSG_PEEK | getattr(socket, 'MSG_DONTWAIT', 0)
+
+
+def client_disconnected(sock):
+    """
+    Return True if the peer of ``sock`` has closed the connection.
+
+    The request body has been read by then, so a clean close reads as EOF.
+    Pipelined data or an unsupported socket (e.g. TLS) reads as connected.
+    """
+    try:
+        return sock.recv(1, _PEEK_FLAGS) == b''
+    except (BlockingIOError, InterruptedError, ValueError):
+        return False
+    except OSError:
+        return True
+
+
+class CancelToken:
+    """
+    Cancellation flag of one generation, checked with ``is_set``.
+
+    Args:
+        key: Registry key, also used for the shared cache flag (None for none)
+        timeout: Seconds from now after which the generation is stopped
+            (None for no deadline)
+        connection: Client socket to watch for a disconnect (None for none)
+    """
+
+    def __init__(self, key=None, timeout=None, connection=None):
+        self.key = key
+        self.deadline = time.monotonic() + timeout if timeout is not None else None
+        self.connection = connection
+        self.registered_at = time.time()
+        self.reason = None
+        self._event = threading.Event()
+        self._next_check = 0.0
+
+    def cancel(self, reason='client'):
+        """Ask the generation to stop; the first reason given is kept."""
+        if self.reason is None:
+            self.reason = reason
+        self._event.set()
+
+    def is_set(self):
+        """Return True once the generation should stop."""
+        if self._event.is_set():
+            return True
+        now = time.monotonic()
+        if self.deadline is not None and now >= self.deadline:
+            self.cancel('deadline')
+        elif now >= self._next_check:
+            self._next_check = now + CANCEL_CHECK_INTERVAL
+            if self.connection is not None and client_disconnected(self.connection):
+                self.cancel('disconnect')
+            elif self.key is not None and self._cancel_requested():
+                self.cancel('client')
+        return self._event.is_set()
+
+    def _cancel_requested(self):
+        requested_at = cache.get(f"{CANCEL_KEY_PREFIX}{self.key}")
+        return requested_at is not None and requested_at >= self.registered_at
+
+
+_active = {}  # key -> CancelToken of the running generation
+_active_lock = threading.Lock()
+
+
+def generation_key(user_id, chat_session):
+    """Registry key of a user's generation in a chat session."""
+    return f"{user_id}:{chat_session}"
+
+
+@contextmanager
+def cancellable_generation(user_id, chat_session, timeout=GENERATION_DEADLINE_SECONDS, connection=None):
+    """
+    Register a generation for cancellation while the ``with`` block runs.
+
+    Yields:
+        CancelToken: To pass to ``generate_response`` as ``cancel_event``
+    """
+    key = generation_key(user_id, chat_session)
+    token = CancelToken(key, timeout, connection)
+    with _active_lock:
+        _active[key] = token
+    try:
+        yield token
+    finally:
+        with _active_lock:
+            if _active.get(key) is token:
+                del _active[key]
+
+
+def request_cancel(user_id, chat_session):
+    """
+    Cancel a user's generation in a chat session, on whichever worker runs it.
+
+    Returns:
+        bool: True if the generation is running in this process
+    """
+    key = generation_key(user_id, chat_session)
+    cache.set(f"{CANCEL_KEY_PREFIX}{key}", time.time(), CANCEL_FLAG_TTL)
+    with _active_lock:
+        token = _active.get(key)
+    if token is not None:
+        token.cancel('client')
+    return token is not None
@@ -0,0 +1,216 @@
+"""
+Batched CloudWatch metric publishing.
+
+This module provides a single publisher for every CloudWatch metric the
+service emits. Instead of one ``put_metric_data`` call per request, samples
+are aggregated in a bounded in-memory buffer into statistic sets
+(SampleCount/Sum/Minimum/Maximum) per metric series and flushed by a
+background timer, up to 1000 datums per API call.
+
+When the buffer already holds the maximum number of series, samples for new
+series are dropped and counted rather than blocking the request path.
+"""
+
+import atexit
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+import boto3
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# PutMetricData accepts at most 1000 datums per call
+MAX_DATUMS_PER_CALL = 1000
+CLOUDWATCH_FLUSH_INTERVAL = getattr(settings, "CLOUDWATCH_FLUSH_INTERVAL", 60)  # seconds
+CLOUDWATCH_MAX_BUFFERED_SERIES = getattr(settings, "CLOUDWATCH_MAX_BUFFERED_SERIES", 5000)
+
+
+class _StatisticSet:
+    """Running SampleCount/Sum/Minimum/Maximum for one metric series."""
+
+    __slots__ = ("count", "total", "minimum", "maximum", "first_timestamp")
+
+    def __init__(self, value, timestamp):
+        self.count = 1
+        self.total = value
+        self.minimum = value
+        self.maximum = value
+        self.first_timestamp = timestamp
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value < self.minimum:
+            self.minimum = value
+        if value > self.maximum:
+            self.maximum = value
+
+
+class CloudWatchPublisher:
+    """
+    Buffers metric samples and publishes them to CloudWatch in batches.
+
+    Args:
+        client: A boto3 CloudWatch client (or compatible stub). Created
+            lazily from ``region_name`` when omitted.
+        region_name: AWS region for the lazily created client
+        flush_interval: Seconds between background flushes
+        max_series: Maximum number of distinct series held in the buffer
+    """
+
+    def __init__(self, client=None, region_name=None, flush_interval=CLOUDWATCH_FLUSH_INTERVAL,
+                 max_series=CLOUDWATCH_MAX_BUFFERED_SERIES):
+        self._client = client
+        self.region_name = region_name
+        self.flush_interval = flush_interval
+        self.max_series = max_series
+        self._buffer = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._timer_lock = threading.Lock()
+        self._timer = None
+        self._stop_event = threading.Event()
+        self._stats = {
+            "samples": 0,
+            "dropped": 0,
+            "datums_published": 0,
+            "datums_failed": 0,
+            "put_calls": 0,
+        }
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = boto3.client("cloudwatch", region_name=self.region_name)
+        return self._client
+
+    def put(self, namespace, metric_name, value, unit="None", dimensions=None):
+        """
+        Add one sample to the buffer.
+
+        Args:
+            namespace: CloudWatch namespace
+            metric_name: Metric name
+            value: Sample value
+            unit: CloudWatch unit (e.g. "Seconds", "Count", "Percent")
+            dimensions: List of ``{'Name': ..., 'Value': ...}`` dicts
+
+        Returns:
+            bool: False if the sample was dropped because the buffer is full
+        """
+        dimension_key = tuple(sorted((d["Name"], str(d["Value"])) for d in (dimensions or [])))
+        key = (namespace, metric_name, dimension_key, unit)
+        with self._lock:
+            statistic_set = self._buffer.get(key)
+            if statistic_set is not None:
+                statistic_set.add(value)
+            elif len(self._buffer) >= self.max_series:
+                self._stats["dropped"] += 1
+                return False
+            else:
+                self._buffer[key] = _StatisticSet(value, time.time())
+            self._stats["samples"] += 1
+        self._ensure_timer()
+        return True
+
+    def _drain(self):
+        with self._lock:
+            buffer, self._buffer = self._buffer, {}
+        return buffer
+
+    def _build_datums(self, buffer):
+        """Group buffered statistic sets into datums per namespace."""
+        datums_by_namespace = {}
+        for (namespace, metric_name, dimension_key, unit), statistic_set in buffer.items():
+            datums_by_namespace.setdefault(namespace, []).append({
+                "MetricName": metric_name,
+                "Dimensions": [{"Name": name, "Value": value} for name, value in dimension_key],
+                "Timestamp": datetime.fromtimestamp(statistic_set.first_timestamp, tz=timezone.utc),
+                "StatisticValues": {
+                    "SampleCount": statistic_set.count,
+                    "Sum": statistic_set.total,
+                    "Minimum": statistic_set.minimum,
+                    "Maximum": statistic_set.maximum,
+                },
+                "Unit": unit,
+            })
+        return datums_by_namespace
+
+    def flush(self):
+        """
+        Publish everything buffered so far.
+
+        Returns:
+            int: Number of datums published successfully
+        """
+        with self._flush_lock:
+            buffer = self._drain()
+            if not buffer:
+                return 0
+
+            published = 0
+            for namespace, datums in self._build_datums(buffer).items():
+                for start in range(0, len(datums), MAX_DATUMS_PER_CALL):
+                    chunk = datums[start:start + MAX_DATUMS_PER_CALL]
+                    try:
+                        self.client.put_metric_data(Namespace=namespace, MetricData=chunk)
+                        published += len(chunk)
+                    except Exception as e:
+                        logger.error(f"Error publishing {len(chunk)} metrics to CloudWatch: {str(e)}")
+                        with self._lock:
+                            self._stats["datums_failed"] += len(chunk)
+                    finally:
+                        with self._lock:
+                            self._stats["put_calls"] += 1
+
+            with self._lock:
+                self._stats["datums_published"] += published
+            return published
+
+    def _ensure_timer(self):
+        if self._timer is not None and self._timer.is_alive():
+            return
+        with self._timer_lock:
+            if self._timer is None or not self._timer.is_alive():
+                self._timer = threading.Thread(
+                    target=self._flush_loop, name="cloudwatch-publisher", daemon=True
+                )
+                self._timer.start()
+
+    def _flush_loop(self):
+        while not self._stop_event.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error in CloudWatch publisher: {str(e)}")
+
+    def stop(self):
+        """Stop the background timer and publish what is left."""
+        self._stop_event.set()
+        self.flush()
+
+    def get_stats(self):
+        """Return publisher counters plus the number of currently buffered series."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["buffered_series"] = len(self._buffer)
+        return stats
+
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+
+def get_cloudwatch_publisher():
+    """Return the process-wide publisher, creating it on first use."""
+    global _publisher
+    if _publisher is None:
+        with _publisher_lock:
+            if _publisher is None:
+                region = getattr(settings, "AWS_REGION", "us-east-1")
+                _publisher = CloudWatchPublisher(region_name=region)
+                atexit.register(_publisher.flush)
+    return _publisher
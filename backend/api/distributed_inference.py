@@ -6,25 +6,197 @@ allowing the LLM service to scale horizontally and handle higher throughput.
 
 Patterns implemented:
 1. Round-robin distribution to multiple LLM instances
-2. Load-based distribution based on server metrics
-3. Redundant inference with result comparison for critical workloads
+2. Load-aware node selection (power of two choices with circuit breaking)
+3. Hedged requests: a second copy is sent only when the first is slower than the observed p95
+4. Concurrent dispatch with per-node concurrency limits
+5. Session affinity via a consistent hash ring keyed by chat session ID
 """
 
 import boto3
 import json
 import time
-import random
 import threading
 import queue
+import heapq
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
 from functools import lru_cache
 from django.conf import settings
 from . import llm_handler  # Import the local LLM handler
+from .admission import AdmissionRejected, acquire_generation_slot, get_admission_stats
+from .monitoring import set_gauge
+from .load_balancer import LoadBalancer
+from .hash_ring import HashRing
+from .node_client import get_node_client
+from .rate_limit import RateLimited
+from .hedging import HedgePolicy, HEDGING_ENABLED, HEDGE_DEFAULT_DELAY
+from .service_discovery import NodeDiscovery, get_discovery_provider
+
+# How long a request's future stays retrievable by ID after it completes
+RESULT_TTL = getattr(settings, 'DISTRIBUTED_RESULT_TTL', 3600)  # seconds
+
+
+class ResultRegistry:
+    """
+    Registry of in-flight and completed request futures keyed by request ID.
+    
+    Each entry expires RESULT_TTL seconds after it was registered or
+    completed. Expiry times are kept in a min-heap, so cleanup only pops the
+    entries that are actually due instead of walking the whole registry.
+    """
+    def __init__(self, ttl=RESULT_TTL):
+        self.ttl = ttl
+        self._entries = {}  # request_id -> (future, expires_at)
+        self._expiry_heap = []  # (expires_at, request_id); may hold stale entries
+        self._lock = threading.Lock()
+    
+    def _set_expiry(self, request_id, future):
+        expires_at = time.time() + self.ttl
+        self._entries[request_id] = (future, expires_at)
+        heapq.heappush(self._expiry_heap, (expires_at, request_id))
+    
+    def _expire(self, now):
+        heap = self._expiry_heap
+        while heap and heap[0][0] <= now:
+            expires_at, request_id = heapq.heappop(heap)
+            entry = self._entries.get(request_id)
+            # Skip heap entries superseded by a later expiry
+            if entry is not None and entry[1] == expires_at:
+                del self._entries[request_id]
+    
+    def register(self, request_id):
+        """Create and register the future for a new request."""
+        future = Future()
+        future.request_id = request_id
+        with self._lock:
+            self._expire(time.time())
+            self._set_expiry(request_id, future)
+        return future
+    
+    def complete(self, request_id, future, result):
+        """Resolve a request's future and restart its TTL from now."""
+        with self._lock:
+            self._expire(time.time())
+            if request_id in self._entries:
+                self._set_expiry(request_id, future)
+        if not future.done():
+            future.set_result(result)
+    
+    def get(self, request_id):
+        """Return the future for a request ID, or None if unknown or expired."""
+        with self._lock:
+            entry = self._entries.get(request_id)
+            if entry is None or entry[1] <= time.time():
+                return None
+            return entry[0]
+    
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+# Dispatch concurrency: number of threads pulling from the request queue,
+# and how many requests may run on one remote node at the same time. Local
+# calls share the admission controller's generation slots with the chat views
+# (ADMISSION_CONCURRENCY, which defaults to DISTRIBUTED_LOCAL_CONCURRENCY).
+DISPATCH_WORKERS = getattr(settings, 'DISTRIBUTED_DISPATCH_WORKERS', 8)
+NODE_CONCURRENCY = getattr(settings, 'DISTRIBUTED_NODE_CONCURRENCY', 4)
+# Route every turn of a chat session to the same node so its prompt cache stays warm
+SESSION_AFFINITY = getattr(settings, 'DISTRIBUTED_SESSION_AFFINITY', True)
+
+
+class NodeSlots:
+    """
+    Per-node concurrency limits with queue-depth and in-flight tracking.
+    
+    Each node gets a semaphore sized to its concurrency limit. Callers wait
+    for a slot (counted as queued for that node) and then run (counted as in
+    flight). The counts are published as per-process gauges keyed by node.
+    """
+    def __init__(self, node_limit=NODE_CONCURRENCY):
+        self.node_limit = node_limit
+        self._semaphores = {}
+        self._queued = {}
+        self._in_flight = {}
+        self._lock = threading.Lock()
+    
+    def _semaphore(self, node_key):
+        semaphore = self._semaphores.get(node_key)
+        if semaphore is None:
+            semaphore = self._semaphores[node_key] = threading.BoundedSemaphore(max(1, self.node_limit))
+        return semaphore
+    
+    def _adjust(self, counter, node_key, delta):
+        # Called with self._lock held
+        counter[node_key] = counter.get(node_key, 0) + delta
+    
+    def _publish(self):
+        with self._lock:
+            queued = dict(self._queued)
+            in_flight = dict(self._in_flight)
+        set_gauge('inference_node_queue_depth', queued)
+        set_gauge('inference_node_in_flight', in_flight)
+    
+    @contextmanager
+    def slot(self, node_key, cancel_event=None):
+        """
+        Hold one concurrency slot on ``node_key`` for the duration of the block.
+        
+        Yields True once a slot is held, or False if ``cancel_event`` was set
+        while still waiting (the caller should then skip the call).
+        """
+        with self._lock:
+            semaphore = self._semaphore(node_key)
+            self._adjust(self._queued, node_key, 1)
+        self._publish()
+        
+        acquired = False
+        try:
+            while not acquired:
+                if cancel_event is not None and cancel_event.is_set():
+                    break
+                acquired = semaphore.acquire(timeout=0.5 if cancel_event is not None else None)
+        finally:
+            with self._lock:
+                self._adjust(self._queued, node_key, -1)
+                if acquired:
+                    self._adjust(self._in_flight, node_key, 1)
+            self._publish()
+        
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                with self._lock:
+                    self._adjust(self._in_flight, node_key, -1)
+                semaphore.release()
+                self._publish()
+    
+    def stats(self):
+        """Return ``{node_key: {'queued', 'in_flight', 'limit'}}`` for every node seen so far."""
+        with self._lock:
+            return {
+                node_key: {
+                    'queued': self._queued.get(node_key, 0),
+                    'in_flight': self._in_flight.get(node_key, 0),
+                    'limit': self.node_limit,
+                }
+                for node_key in self._semaphores
+            }
+
+
+def node_key(node):
+    """Return the key used to track a node ("local" or the node's ID/URL)."""
+    if node == "local":
+        return "local"
+    if isinstance(node, dict):
+        return node.get('id') or node.get('url', 'remote')
+    return "remote"
+
 
-# Cache of available inference nodes
-available_nodes = {}
-node_cache_lock = threading.Lock()
 request_queue = queue.Queue()
-response_registry = {}
+response_registry = ResultRegistry()
 
 class DistributedInference:
     """
@@ -41,60 +213,79 @@ class DistributedInference:
         self.sagemaker_runtime = boto3.client('sagemaker-runtime', region_name=self.region)
         self.cloudmap = boto3.client('servicediscovery', region_name=self.region)
         
-        # Set up a worker thread to process requests
-        self.worker_thread = threading.Thread(target=self._process_queue, daemon=True)
-        self.worker_thread.start()
+        self.node_slots = NodeSlots()
+        self.balancer = LoadBalancer()
+        self.hash_ring = HashRing()
+        self.hedge_policy = HedgePolicy()
+        
+        # Hedged calls run on their own pool so they never wait behind the
+        # dispatch threads that are waiting on them; each dispatch thread may
+        # have a primary and a hedge running at once
+        self.fanout_executor = ThreadPoolExecutor(
+            max_workers=max(2, 2 * DISPATCH_WORKERS), thread_name_prefix="inference-fanout"
+        )
+        
+        # Keep the node list fresh in the background
+        provider = get_discovery_provider(self.cloudmap)
+        self.discovery = NodeDiscovery(provider) if provider is not None else None
+        if self.discovery is not None:
+            self.discovery.add_listener(self._on_nodes_changed)
+            self.discovery.start()
+        
+        # Set up the dispatch threads that process requests
+        self.worker_threads = []
+        for i in range(max(1, DISPATCH_WORKERS)):
+            worker = threading.Thread(target=self._process_queue, name=f"inference-dispatch-{i}", daemon=True)
+            worker.start()
+            self.worker_threads.append(worker)
         
     def _get_inference_nodes(self):
         """
         Get a list of available inference nodes
-        """
-        # Check if we have a recent cache first
-        with node_cache_lock:
-            if available_nodes.get('last_updated', 0) > time.time() - 60:
-                return available_nodes.get('nodes', [])
         
-        nodes = []
+        The list is maintained by the background discovery refresher, so this
+        never calls the discovery service on the request path.
+        """
+        if self.discovery is None:
+            return []
+        return self.discovery.nodes
+    
+    def _on_nodes_changed(self, joined, left, nodes):
+        """Keep routing state in step with node membership."""
+        for node in left:
+            self.balancer.forget(node_key(node))
+        for node in joined:
+            # A rejoining node starts with a clean circuit
+            self.balancer.forget(node_key(node))
+        self.hash_ring.update(node_key(node) for node in nodes)
+    
+    def _uses_session_affinity(self, session_id):
+        # "default" is shared by every caller without a session; pinning it
+        # to one node would only create a hot spot
+        return SESSION_AFFINITY and bool(session_id) and session_id != 'default'
+    
+    def _session_nodes(self, nodes, session_id):
+        """
+        Order nodes by the hash ring's preference for a chat session
         
-        # If using service discovery, get nodes from AWS Cloud Map
-        if self.service_discovery_name:
-            try:
-                # First get the service ID from the service name
-                services = self.cloudmap.list_services()
-                service_id = None
-                for service in services.get('Services', []):
-                    if service['Name'] == self.service_discovery_name:
-                        service_id = service['Id']
-                        break
-                
-                if service_id:
-                    # Get instances registered with this service
-                    response = self.cloudmap.list_instances(ServiceId=service_id)
-                    for instance in response.get('Instances', []):
-                        instance_id = instance['Id']
-                        attributes = instance.get('Attributes', {})
-                        if 'AWS_INSTANCE_IPV4' in attributes:
-                            ip = attributes['AWS_INSTANCE_IPV4']
-                            port = attributes.get('AWS_INSTANCE_PORT', '8000')
-                            nodes.append({
-                                'id': instance_id,
-                                'ip': ip,
-                                'port': port,
-                                'url': f"http://{ip}:{port}/api/inference"
-                            })
-            except Exception as e:
-                print(f"Error getting inference nodes from service discovery: {str(e)}")
+        Returns:
+            list: Node dicts, session owner first, or [] if affinity does not apply
+        """
+        if not self._uses_session_affinity(session_id):
+            return []
         
-        # Update the cache
-        with node_cache_lock:
-            available_nodes['nodes'] = nodes
-            available_nodes['last_updated'] = time.time()
-            
-        return nodes
+        nodes_by_key = {node_key(node): node for node in nodes}
+        self.hash_ring.update(nodes_by_key)
+        return [nodes_by_key[key] for key in self.hash_ring.get_nodes(session_id) if key in nodes_by_key]
     
-    def select_inference_node(self, request_type="standard"):
+    def select_inference_node(self, request_type="standard", session_id=None):
         """
         Select an appropriate node for inference based on request type and metrics
+        
+        Standard requests with a chat session ID go to the session's node on
+        the hash ring, or the next healthy one along the ring if its circuit
+        is open. Other requests are load-balanced. Only one node is picked
+        here; a critical request's second node is picked when it is hedged.
         """
         nodes = self._get_inference_nodes()
         
@@ -102,18 +293,20 @@ class DistributedInference:
             print("No distributed inference nodes available, using local")
             return "local"
         
-        # For critical requests, we might use multiple nodes for redundancy
-        if request_type == "critical":
-            if len(nodes) >= 2:
-                # Return two nodes for redundant processing
-                return random.sample(nodes, 2)
-            elif len(nodes) == 1:
-                # Use the single node plus local
-                return [nodes[0], "local"]
+        if request_type != "critical":
+            session_nodes = self._session_nodes(nodes, session_id)
+            if session_nodes:
+                node = self.balancer.first_available(session_nodes, key=node_key)
+                if node is not None:
+                    return node
         
-        # For standard requests, use round-robin or load-based selection
-        # Here we just use random selection as a simple example
-        return random.choice(nodes)
+        # Power of two choices over healthy nodes (EWMA latency, in-flight, error rate)
+        chosen = self.balancer.choose(nodes, key=node_key)
+        if chosen:
+            return chosen[0]
+        
+        print("All distributed inference nodes are ejected, using local")
+        return "local"
     
     def _process_queue(self):
         """
@@ -123,72 +316,224 @@ class DistributedInference:
             try:
                 # Get a request from the queue with a timeout
                 request_item = request_queue.get(timeout=1)
-                
-                request_id = request_item['id']
-                request_data = request_item['data']
-                callback = request_item.get('callback')
-                
-                # Select a node for inference
-                node = self.select_inference_node(request_item.get('request_type', 'standard'))
-                
-                # Process based on node type
-                if node == "local":
-                    # Use local inference
-                    result = self._do_local_inference(request_data)
-                elif isinstance(node, list):
-                    # Redundant inference across multiple nodes
-                    results = []
-                    for n in node:
-                        if n == "local":
-                            results.append(self._do_local_inference(request_data))
-                        else:
-                            results.append(self._do_remote_inference(n, request_data))
-                    
-                    # Compare results and select the best one
-                    result = self._reconcile_results(results)
-                else:
-                    # Single remote node
-                    result = self._do_remote_inference(node, request_data)
-                
-                # Store the result in the registry
-                response_registry[request_id] = {
-                    'result': result,
-                    'timestamp': time.time()
-                }
-                
-                # If there's a callback, call it with the result
-                if callback:
-                    try:
-                        callback(result)
-                    except Exception as cb_error:
-                        print(f"Error in callback: {str(cb_error)}")
-                
-                request_queue.task_done()
             except queue.Empty:
                 # No requests to process, just continue
-                pass
+                continue
+            
+            set_gauge('inference_queue_depth', request_queue.qsize())
+            try:
+                result = self._run_request(request_item)
             except Exception as e:
                 print(f"Error processing inference request: {str(e)}")
-                time.sleep(1)
+                result = {
+                    'error': str(e),
+                    'response': 'Error processing your request'
+                }
+            
+            # Resolving the future wakes any waiters and runs callbacks
+            response_registry.complete(request_item['id'], request_item['future'], result)
+            request_queue.task_done()
+    
+    def _run_request(self, request_item):
+        """
+        Run one queued request on the selected node(s) and return its result
+        """
+        request_data = request_item['data']
+        request_type = request_item.get('request_type', 'standard')
+        session_id = request_data.get('session_id')
+        
+        # Select a node for inference
+        node = self.select_inference_node(request_type, session_id=session_id)
+        
+        if node == "local":
+            return self._dispatch(node, request_data)
+        if request_type == "critical":
+            # Critical request: always hedge if the first node is slow, to a
+            # second node or else the local model. The second node is only
+            # picked then, so a half-open one is not held as a probe for a
+            # copy that never gets sent.
+            return self._run_hedged(
+                node, request_data, lambda: self._hedge_target(node, None) or "local", budgeted=False
+            )
+        
+        result = self._run_hedged(node, request_data, lambda: self._hedge_target(node, session_id))
+        if 'error' in (result or {}):
+            # Session turn failed on its node: retry once on the next node along the ring
+            fallback = self._next_session_node(node, session_id)
+            if fallback is not None:
+                print(f"Retrying session {session_id} on fallback node {node_key(fallback)}")
+                result = self._dispatch(fallback, request_data)
+        return result
+    
+    def _next_session_node(self, failed_node, session_id):
+        """Return the next healthy node after ``failed_node`` in the session's ring order."""
+        session_nodes = self._session_nodes(self._get_inference_nodes(), session_id)
+        failed_key = node_key(failed_node)
+        keys = [node_key(node) for node in session_nodes]
+        if failed_key not in keys:
+            return None
+        remaining = session_nodes[keys.index(failed_key) + 1:]
+        return self.balancer.first_available(remaining, key=node_key)
+    
+    def _hedge_target(self, primary, session_id):
+        """Pick the node a hedge of a request to ``primary`` should go to."""
+        if self._uses_session_affinity(session_id):
+            # Session request: hedge to the next node along the ring
+            return self._next_session_node(primary, session_id)
+        primary_key = node_key(primary)
+        others = [n for n in self._get_inference_nodes() if node_key(n) != primary_key]
+        chosen = self.balancer.choose(others, key=node_key)
+        return chosen[0] if chosen else None
+    
+    def _dispatch(self, node, request_data, cancel_event=None):
+        """
+        Run a request on one node within that node's concurrency limit
+        
+        Local requests wait for a generation slot of the admission controller
+        instead, the same one the chat views use.
+        
+        Returns:
+            dict: The inference result, or None if cancelled before it started
+        """
+        if node == "local":
+            return self._do_local_inference(request_data, cancel_event)
+        key = node_key(node)
+        with self.node_slots.slot(key, cancel_event) as acquired:
+            if not acquired:
+                self.balancer.release(key)
+                return None
+            
+            self.balancer.start(key)
+            start_time = time.time()
+            result = None
+            try:
+                result = self._do_remote_inference(node, request_data)
+                return result
+            finally:
+                elapsed = time.time() - start_time
+                success = isinstance(result, dict) and 'error' not in result
+                self.balancer.finish(key, elapsed, success)
+                if success:
+                    self.hedge_policy.record(elapsed)
+    
+    def _run_hedged(self, primary, request_data, pick_alternate, budgeted=True):
+        """
+        Send a request to ``primary`` and hedge it if no answer arrives in time
+        
+        If the primary has not answered within the hedge delay (observed p95
+        of remote calls), a second copy goes to the node returned by
+        ``pick_alternate``; the first valid answer wins and the other copy is
+        cancelled (or, if already running, its result is discarded).
+        
+        Args:
+            primary: Node for the first copy
+            request_data (dict): The inference request parameters
+            pick_alternate (callable): Returns the hedge node, or None
+            budgeted (bool): Whether the hedge must fit in the hedge budget
+        """
+        policy = self.hedge_policy
+        policy.on_request()
+        # Without enough samples yet, only critical requests fall back to a default delay
+        delay = policy.delay() if budgeted else policy.delay(default=HEDGE_DEFAULT_DELAY)
+        if not HEDGING_ENABLED or delay is None:
+            return self._dispatch(primary, request_data)
+        
+        nodes = [primary]
+        cancel_events = [threading.Event()]
+        futures = [self.fanout_executor.submit(self._dispatch, primary, request_data, cancel_events[0])]
+        done, _ = wait(futures, timeout=delay)
+        if not done:
+            alternate = pick_alternate()
+            if alternate is not None:
+                if policy.try_hedge(budgeted):
+                    nodes.append(alternate)
+                    cancel_events.append(threading.Event())
+                    futures.append(
+                        self.fanout_executor.submit(self._dispatch, alternate, request_data, cancel_events[1])
+                    )
+                elif alternate != "local":
+                    self.balancer.release(node_key(alternate))
+        
+        result, winner = self._first_valid(futures, cancel_events, nodes)
+        if winner == 1:
+            policy.on_hedge_won()
+        return result
     
-    def _do_local_inference(self, request_data):
+    def _first_valid(self, futures, cancel_events, nodes):
+        """
+        Wait for the first valid result among parallel copies of a request
+        
+        Copies still pending are cancelled; ones already running are left to
+        finish and their results are discarded. A remote copy cancelled before
+        it started releases its node, in case it was held as a half-open probe.
+        
+        Returns:
+            tuple: (result, index of the winning copy or None if all failed)
+        """
+        results = []
+        winner = None
+        result = None
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {
+                    'error': str(e),
+                    'response': 'Error processing your request'
+                }
+            if result is None:
+                continue
+            if 'error' not in result:
+                winner = futures.index(future)
+                break
+            results.append(result)
+        
+        for future, event, node in zip(futures, cancel_events, nodes):
+            if not future.done():
+                event.set()
+                if future.cancel() and node != "local":
+                    self.balancer.release(node_key(node))
+        
+        if winner is not None:
+            return result, winner
+        # Every copy failed; fall back to the usual reconciliation
+        return self._reconcile_results(results), None
+    
+    def _do_local_inference(self, request_data, cancel_event=None):
         """
         Perform inference locally
+        
+        The generation goes through the admission queue and, for requests
+        with a ``user_id``, that user's token rate limit, like a chat request.
+        
+        Returns:
+            dict: The inference result, or None if cancelled before it started
         """
         try:
             # Extract parameters from request data
             user_input = request_data.get('input', '')
             chat_session_id = request_data.get('session_id', 'default')
             model_mode = request_data.get('model_mode', 'auto')
+            user_id = request_data.get('user_id')
             
-            # Call the local LLM handler
-            result = llm_handler.generate_response(
-                user_input=user_input,
-                chat_session_id=chat_session_id,
-                model_mode=model_mode
-            )
-            
-            return result
+            with acquire_generation_slot(user_id if user_id is not None else 'distributed'):
+                if cancel_event is not None and cancel_event.is_set():
+                    return None
+                # Call the local LLM handler
+                return llm_handler.generate_response(
+                    user_input=user_input,
+                    chat_session_id=chat_session_id,
+                    model_mode=model_mode,
+                    rate_limit_key=user_id,
+                    cancel_event=cancel_event
+                )
+        except (RateLimited, AdmissionRejected) as refused:
+            print(f"Local inference refused: {str(refused)}")
+            return {
+                'error': str(refused),
+                'retry_after': refused.retry_after,
+                'response': 'The server is busy. Please try again shortly.'
+            }
         except Exception as e:
             print(f"Error in local inference: {str(e)}")
             return {
@@ -200,27 +545,18 @@ class DistributedInference:
         """
         Perform inference on a remote node
         """
-        import requests
-        
         try:
             if isinstance(node, dict) and 'url' in node:
-                # HTTP request to another Django instance
-                url = node['url']
-                headers = {'Content-Type': 'application/json'}
-                
-                response = requests.post(
-                    url, 
-                    headers=headers,
-                    json=request_data,
-                    timeout=30  # 30 second timeout
-                )
+                # HTTP request to another Django instance over the shared
+                # keep-alive pool (split connect/read timeouts, safe retries)
+                status, body = get_node_client().post_json(node['url'], request_data)
                 
-                if response.status_code == 200:
-                    return response.json()
+                if status == 200 and isinstance(body, dict):
+                    return body
                 else:
-                    print(f"Error from remote node: {response.status_code} - {response.text}")
+                    print(f"Error from remote node: {status} - {body}")
                     return {
-                        'error': f"HTTP {response.status_code}",
+                        'error': f"HTTP {status}",
                         'response': 'Error processing your request on remote node'
                     }
             elif self.lambda_function:
@@ -256,6 +592,30 @@ class DistributedInference:
                 'response': 'Error processing your request on remote node'
             }
     
+    def stream_remote_inference(self, node, request_data, chunk_size=1024):
+        """
+        Stream a remote node's response body through as it is generated
+        
+        Args:
+            node (dict): Node with a 'url'
+            request_data (dict): The inference request parameters
+            chunk_size (int): Maximum bytes per yielded chunk
+            
+        Yields:
+            bytes: Raw response chunks from the node
+        """
+        key = node_key(node)
+        self.balancer.start(key)
+        start_time = time.time()
+        success = False
+        try:
+            with self.node_slots.slot(key):
+                for chunk in get_node_client().stream(node['url'], dict(request_data, stream=True), chunk_size):
+                    yield chunk
+            success = True
+        finally:
+            self.balancer.finish(key, time.time() - start_time, success)
+    
     def _reconcile_results(self, results):
         """
         Compare results from multiple inference sources and select the best one
@@ -290,19 +650,31 @@ class DistributedInference:
             request_type (str): "standard" or "critical" - determines redundancy level
             
         Returns:
-            str: Request ID for tracking
+            Future: Completed with the result dict by the worker; its
+            ``request_id`` attribute can be passed to ``get_result``
         """
-        request_id = f"req_{int(time.time())}_{random.randint(1000, 9999)}"
+        request_id = f"req_{int(time.time())}_{uuid.uuid4().hex[:12]}"
+        future = response_registry.register(request_id)
+        
+        if callback:
+            future.add_done_callback(lambda f: self._run_callback(callback, f))
         
         # Put the request in the queue
         request_queue.put({
             'id': request_id,
             'data': request_data,
-            'callback': callback,
+            'future': future,
             'request_type': request_type
         })
+        set_gauge('inference_queue_depth', request_queue.qsize())
         
-        return request_id
+        return future
+    
+    def _run_callback(self, callback, future):
+        try:
+            callback(future.result())
+        except Exception as cb_error:
+            print(f"Error in callback: {str(cb_error)}")
     
     def get_result(self, request_id, wait=False, timeout=30):
         """
@@ -316,42 +688,42 @@ class DistributedInference:
         Returns:
             dict: The inference result or None if not available
         """
-        start_time = time.time()
+        future = response_registry.get(request_id)
+        if future is None:
+            return None
         
-        while True:
-            if request_id in response_registry:
-                result = response_registry[request_id]['result']
-                
-                # Clean up old results periodically
-                self._cleanup_old_results()
-                
-                return result
-            
-            if not wait or (time.time() - start_time > timeout):
-                return None
-            
-            # Wait a bit before checking again
-            time.sleep(0.1)
-    
-    def _cleanup_old_results(self):
-        """
-        Clean up old results from the registry
-        """
-        # Keep results for 1 hour
-        cutoff = time.time() - 3600
-        
-        to_remove = []
-        for req_id, data in response_registry.items():
-            if data['timestamp'] < cutoff:
-                to_remove.append(req_id)
+        if not wait:
+            return future.result() if future.done() else None
         
-        for req_id in to_remove:
-            del response_registry[req_id]
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            return None
 
 # Create a singleton instance
 distributed_inference = DistributedInference()
 
-def submit_inference_request(user_input, chat_session_id="default", model_mode="auto", critical=False):
+def get_dispatch_stats():
+    """
+    Get per-node dispatch statistics for this process
+    
+    Returns:
+        dict: Request queue depth, queued/in-flight/limit per remote node,
+        the local admission queue, the balancer's health signals per node,
+        hedging counters and the discovery refresher's state
+    """
+    return {
+        'queue_depth': request_queue.qsize(),
+        'dispatch_workers': len(distributed_inference.worker_threads),
+        'nodes': distributed_inference.node_slots.stats(),
+        'local': get_admission_stats(),
+        'health': distributed_inference.balancer.stats(),
+        'hedging': distributed_inference.hedge_policy.stats(),
+        'discovery': distributed_inference.discovery.stats() if distributed_inference.discovery else None,
+    }
+
+def submit_inference_request(user_input, chat_session_id="default", model_mode="auto", critical=False,
+                             user_id=None):
     """
     Helper function to submit an inference request
     
@@ -360,24 +732,28 @@ def submit_inference_request(user_input, chat_session_id="default", model_mode="
         chat_session_id (str): The chat session ID
         model_mode (str): The model mode ("auto", "default", or "math")
         critical (bool): Whether this is a critical request requiring redundancy
+        user_id: User to queue and rate limit a local generation under
         
     Returns:
-        tuple: (request_id, None) - The result will be retrieved later
+        tuple: (request_id, future) - The result can be retrieved later by ID
+        or awaited on the future
     """
     request_data = {
         'input': user_input,
         'session_id': chat_session_id,
         'model_mode': model_mode
     }
+    if user_id is not None:
+        request_data['user_id'] = user_id
     
     request_type = "critical" if critical else "standard"
     
-    request_id = distributed_inference.submit_request(
+    future = distributed_inference.submit_request(
         request_data=request_data,
         request_type=request_type
     )
     
-    return request_id, None
+    return future.request_id, future
 
 def get_inference_result(request_id, wait=True, timeout=60):
     """
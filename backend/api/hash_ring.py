@@ -0,0 +1,121 @@
+"""
+Consistent Hash Ring Module
+
+This module maps keys (chat session IDs) to inference nodes with a consistent
+hash ring. Each node is placed on the ring at many pseudo-random points
+("virtual nodes") so keys spread evenly, and a key belongs to the first node
+clockwise from its own hash.
+
+When a node joins or leaves, only the keys in the ring segments it gains or
+loses move, i.e. roughly 1/N of all keys, so every other session keeps
+landing on the node that already holds its warm prompt cache.
+"""
+
+import bisect
+import hashlib
+import threading
+from django.conf import settings
+
+# Points per node on the ring; more points give a more even spread
+VIRTUAL_NODES = getattr(settings, 'HASH_RING_VIRTUAL_NODES', 160)
+
+
+def _hash(value):
+    """Stable 64-bit hash of a string (Python's hash() is salted per process)."""
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """
+    Consistent hash ring with virtual nodes.
+
+    Args:
+        node_ids: Initial node IDs
+        virtual_nodes: Points placed on the ring per node
+    """
+
+    def __init__(self, node_ids=(), virtual_nodes=VIRTUAL_NODES):
+        self.virtual_nodes = virtual_nodes
+        self._nodes = set()
+        self._points = []  # sorted ring positions
+        self._owners = []  # node ID owning the position at the same index
+        self._lock = threading.Lock()
+        self.update(node_ids)
+
+    def _rebuild(self):
+        # Called with self._lock held
+        ring = sorted(
+            (_hash(f"{node_id}#{replica}"), node_id)
+            for node_id in self._nodes
+            for replica in range(self.virtual_nodes)
+        )
+        self._points = [point for point, _ in ring]
+        self._owners = [node_id for _, node_id in ring]
+
+    def add_node(self, node_id):
+        with self._lock:
+            if node_id not in self._nodes:
+                self._nodes.add(node_id)
+                self._rebuild()
+
+    def remove_node(self, node_id):
+        with self._lock:
+            if node_id in self._nodes:
+                self._nodes.discard(node_id)
+                self._rebuild()
+
+    def update(self, node_ids):
+        """
+        Make the ring contain exactly ``node_ids``.
+
+        Returns:
+            bool: True if membership changed
+        """
+        node_ids = set(node_ids)
+        with self._lock:
+            if node_ids == self._nodes:
+                return False
+            self._nodes = node_ids
+            self._rebuild()
+            return True
+
+    @property
+    def nodes(self):
+        with self._lock:
+            return set(self._nodes)
+
+    def get_nodes(self, key, count=None):
+        """
+        Get the preference list for a key: distinct nodes in ring order.
+
+        The first entry owns the key; the following ones are the fallbacks
+        used when it is unavailable.
+
+        Args:
+            key: Routing key (e.g. a chat session ID)
+            count: Maximum number of nodes to return (default: all)
+
+        Returns:
+            list: Node IDs
+        """
+        with self._lock:
+            points, owners = self._points, self._owners
+            total = len(self._nodes)
+        if not points:
+            return []
+        count = total if count is None else min(count, total)
+
+        preference = []
+        index = bisect.bisect(points, _hash(str(key)))
+        for offset in range(len(points)):
+            node_id = owners[(index + offset) % len(points)]
+            if node_id not in preference:
+                preference.append(node_id)
+                if len(preference) == count:
+                    break
+        return preference
+
+    def get_node(self, key):
+        """Return the node ID that owns ``key``, or None if the ring is empty."""
+        nodes = self.get_nodes(key, 1)
+        return nodes[0] if nodes else None
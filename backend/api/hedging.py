@@ -0,0 +1,110 @@
+"""
+Hedged Request Policy Module
+
+A hedged request is sent to one node first. If no answer has come back
+by the time most requests would have finished (the observed p95 latency),
+a second copy goes to another node, whichever answers first wins, and the
+other copy is cancelled.
+
+This cuts tail latency for a small amount of extra work. To keep that work
+bounded, hedges draw from a budget: each primary request adds
+HEDGE_BUDGET_PERCENT / 100 of a token, and each hedge spends a whole token.
+"""
+
+import threading
+from django.conf import settings
+
+from .latency_histogram import LatencyHistogram
+
+HEDGING_ENABLED = getattr(settings, 'DISTRIBUTED_HEDGING_ENABLED', True)
+# Maximum share of requests that may be hedged
+HEDGE_BUDGET_PERCENT = getattr(settings, 'DISTRIBUTED_HEDGE_BUDGET_PERCENT', 5)
+# Percentile of observed remote latency after which a hedge is sent
+HEDGE_PERCENTILE = getattr(settings, 'DISTRIBUTED_HEDGE_PERCENTILE', 95)
+# Samples needed before the percentile is trusted
+HEDGE_MIN_SAMPLES = getattr(settings, 'DISTRIBUTED_HEDGE_MIN_SAMPLES', 20)
+# Hedge delay used before enough samples exist (seconds); None disables it
+HEDGE_DEFAULT_DELAY = getattr(settings, 'DISTRIBUTED_HEDGE_DEFAULT_DELAY', 10.0)
+# Samples per window; the delay is computed over the current and previous window
+HEDGE_WINDOW = getattr(settings, 'DISTRIBUTED_HEDGE_WINDOW', 1000)
+# Largest unspent budget that can accumulate (in hedges)
+HEDGE_BUDGET_BURST = 10
+
+
+class HedgePolicy:
+    """
+    Tracks remote latency and decides when (and whether) to hedge.
+
+    Latency is kept in two rotating histogram windows so the delay follows
+    recent behaviour instead of the whole process lifetime.
+    """
+
+    def __init__(self, budget_percent=HEDGE_BUDGET_PERCENT, percentile=HEDGE_PERCENTILE,
+                 min_samples=HEDGE_MIN_SAMPLES, window=HEDGE_WINDOW):
+        self.budget_ratio = budget_percent / 100.0
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.window = window
+        self._current = LatencyHistogram()
+        self._previous = LatencyHistogram()
+        self._budget = 0.0
+        self._lock = threading.Lock()
+        self._stats = {'requests': 0, 'hedges_sent': 0, 'hedges_won': 0, 'hedges_denied': 0}
+
+    def record(self, latency):
+        """Record the latency (seconds) of a successful remote call."""
+        with self._lock:
+            self._current.record(latency * 1000)
+            if self._current.count >= self.window:
+                self._previous, self._current = self._current, LatencyHistogram()
+
+    def delay(self, default=HEDGE_DEFAULT_DELAY):
+        """
+        Seconds to wait for the primary before hedging.
+
+        Returns:
+            float: The observed percentile latency, or ``default`` while
+            there are too few samples (may be None)
+        """
+        with self._lock:
+            combined = LatencyHistogram().merge(self._previous).merge(self._current)
+        if combined.count < self.min_samples:
+            return default
+        return combined.percentile(self.percentile) / 1000.0
+
+    def on_request(self):
+        """Count a primary request and earn its share of hedge budget."""
+        with self._lock:
+            self._stats['requests'] += 1
+            self._budget = min(self._budget + self.budget_ratio, HEDGE_BUDGET_BURST)
+
+    def try_hedge(self, budgeted=True):
+        """
+        Spend budget on a hedge.
+
+        Args:
+            budgeted: False for requests that may always hedge (critical)
+
+        Returns:
+            bool: Whether the hedge may be sent
+        """
+        with self._lock:
+            if budgeted:
+                if self._budget < 1.0:
+                    self._stats['hedges_denied'] += 1
+                    return False
+                self._budget -= 1.0
+            self._stats['hedges_sent'] += 1
+            return True
+
+    def on_hedge_won(self):
+        with self._lock:
+            self._stats['hedges_won'] += 1
+
+    def stats(self):
+        """Return hedge counters, remaining budget and the current delay."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['budget'] = round(self._budget, 2)
+        stats['delay_seconds'] = self.delay()
+        return stats
@@ -3,23 +3,104 @@ AWS Lambda handler for serverless LLM processing.
 
 This module provides functions for offloading LLM processing to AWS Lambda
 when the local system is under heavy load or for specific types of requests.
+
+Requests can be offloaded synchronously (``process_via_lambda``) or as
+asynchronous jobs (``submit_lambda_job``): the function is invoked with
+``InvocationType='Event'``, the caller gets a job id at once, and the
+function reports its result to the job callback endpoint, from where
+clients poll it.
 """
 
 import json
 import base64
+import gzip
 import time
 import os
+import threading
+import uuid
 import boto3
 import logging
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from django.conf import settings
+from django.core.cache import cache
+
+from .admission import get_admission_stats
+from .blob_store import get_blob_store
+from .cloudwatch_publisher import get_cloudwatch_publisher
+from .latency_histogram import LatencyHistogram
+from .metrics_exposition import shared_cache_configured
+from .monitoring import get_generation_rates
 
 logger = logging.getLogger(__name__)
+# One JSON line per offload decision (and per offloaded outcome), for offline
+# evaluation of the policy; route this logger to a file in LOGGING to keep them
+decision_logger = logging.getLogger("api.offload_decisions")
 
 # Lambda function settings
 LAMBDA_FUNCTION_NAME = os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "ai-llm-processor")
 LAMBDA_REGION = os.environ.get("AWS_REGION", "us-east-1")
 MAX_LAMBDA_PAYLOAD_SIZE = 6 * 1024 * 1024  # 6MB, Lambda limit is 6MB
 
+# Payload encoding settings
+# "gzip" (compressed, base64 in the JSON envelope) or "identity"
+LAMBDA_PAYLOAD_ENCODING = getattr(settings, 'LAMBDA_PAYLOAD_ENCODING', 'gzip')
+# Payloads smaller than this are sent uncompressed
+LAMBDA_COMPRESSION_MIN_BYTES = getattr(settings, 'LAMBDA_COMPRESSION_MIN_BYTES', 4096)
+# Encoded payloads larger than this go to the blob store (headroom for the envelope)
+LAMBDA_INLINE_PAYLOAD_LIMIT = MAX_LAMBDA_PAYLOAD_SIZE - 64 * 1024
+# Token budget for conversation history sent with an offloaded request
+LAMBDA_HISTORY_TOKEN_BUDGET = getattr(settings, 'LAMBDA_HISTORY_TOKEN_BUDGET', 3000)
+PAYLOAD_METRICS_NAMESPACE = "AI/LLMService"
+
+# Payload size and encode time statistics for this process
+_payload_stats = {
+    'payloads': 0,
+    'compressed': 0,
+    'blob_references': 0,
+    'raw_bytes': 0,
+    'encoded_bytes': 0,
+    'history_messages_dropped': 0,
+}
+_encode_times = LatencyHistogram()
+_payload_stats_lock = threading.Lock()
+
+# Offload policy settings
+# Remote latency assumed before any Lambda call has been measured (seconds, cold start included)
+LAMBDA_DEFAULT_LATENCY = getattr(settings, 'OFFLOAD_LAMBDA_DEFAULT_LATENCY', 20.0)
+# Offload only if the remote estimate beats the local one by this fraction
+OFFLOAD_LATENCY_MARGIN = getattr(settings, 'OFFLOAD_LATENCY_MARGIN', 0.2)
+# Completion length assumed before any local generation has been measured
+DEFAULT_COMPLETION_TOKENS = 300
+REMOTE_LATENCY_ALPHA = 0.2
+
+# Smoothed observed Lambda round-trip latency (seconds)
+_remote_latency = {'ewma': None, 'samples': 0}
+_remote_latency_lock = threading.Lock()
+
+# Asynchronous job settings
+# Most async Lambda jobs this process keeps outstanding; beyond this, submissions are refused
+LAMBDA_ASYNC_MAX_OUTSTANDING = getattr(settings, 'LAMBDA_ASYNC_MAX_OUTSTANDING', 16)
+# A job with no result after this long is marked as failed (seconds)
+LAMBDA_ASYNC_TIMEOUT = getattr(settings, 'LAMBDA_ASYNC_TIMEOUT', 300)
+# URL the function posts results to (the lambda-job-result endpoint)
+LAMBDA_CALLBACK_URL = getattr(settings, 'LAMBDA_CALLBACK_URL', None)
+LAMBDA_JOB_KEY_PREFIX = "lambda_job:"
+LAMBDA_JOB_TTL = 60 * 60  # completed results are kept for an hour
+LAMBDA_JOB_POLL_INTERVAL = 0.5  # seconds between client polls of a pending job
+# With a shared cache, the result may be posted to another worker; a waiting
+# job thread re-reads the cache this often (seconds)
+LAMBDA_JOB_SHARED_CHECK_INTERVAL = 5
+
+# Each outstanding job holds one slot and one pool thread (invoke, then
+# wait for the result), so the pool size is the cap on outstanding calls
+_job_slots = threading.BoundedSemaphore(LAMBDA_ASYNC_MAX_OUTSTANDING)
+_job_executor = ThreadPoolExecutor(max_workers=LAMBDA_ASYNC_MAX_OUTSTANDING, thread_name_prefix="lambda-job")
+# job id -> Future resolved with the job state when this process finishes the job
+_job_futures = {}
+_job_futures_lock = threading.Lock()
+_job_stats = {'submitted': 0, 'refused': 0, 'completed': 0, 'failed': 0, 'timed_out': 0}
+_job_stats_lock = threading.Lock()
+
 # Configure AWS Lambda client
 lambda_client = boto3.client('lambda', region_name=LAMBDA_REGION)
 
@@ -35,6 +116,139 @@ def is_offloading_enabled():
         settings.SERVERLESS_OFFLOADING_ENABLED
     )
 
+def estimate_prompt_tokens(request_data):
+    """
+    Estimate the prompt size of a request in tokens, history included.
+    
+    Uses ``prompt_tokens`` from the request if the caller already knows it,
+    otherwise the model's tokenizer over the session history plus the new
+    input. If the model is not loaded (tokenizing would load it), falls
+    back to roughly four characters per token.
+    
+    Args:
+        request_data: Dict with ``user_input`` and optionally ``chat_session_id``
+        
+    Returns:
+        int: Estimated prompt tokens
+    """
+    if request_data.get('prompt_tokens'):
+        return int(request_data['prompt_tokens'])
+    
+    user_input = request_data.get('user_input', '')
+    chat_session_id = request_data.get('chat_session_id')
+    try:
+        from .llm_handler import LlamaModel
+        llama_model = LlamaModel()
+        if llama_model.is_initialized():
+            history = llama_model.conversation_history.get(chat_session_id, []) if chat_session_id else []
+            return llama_model.estimate_prompt_tokens(history, user_input)
+    except Exception as e:
+        logger.warning(f"Falling back to character-based token estimate: {str(e)}")
+    
+    history_chars = sum(len(m.get('content', '')) for m in request_data.get('history', []))
+    return (len(user_input) + history_chars) // 4 + 1
+
+def record_remote_latency(latency):
+    """Record the observed round-trip latency (seconds) of a Lambda call."""
+    with _remote_latency_lock:
+        previous = _remote_latency['ewma']
+        _remote_latency['ewma'] = latency if previous is None else (
+            (1 - REMOTE_LATENCY_ALPHA) * previous + REMOTE_LATENCY_ALPHA * latency
+        )
+        _remote_latency['samples'] += 1
+
+def estimate_remote_latency():
+    """Smoothed observed Lambda latency, or the configured default before any call."""
+    with _remote_latency_lock:
+        return _remote_latency['ewma'] if _remote_latency['ewma'] is not None else LAMBDA_DEFAULT_LATENCY
+
+def estimate_local_latency(prompt_tokens, rates=None, admission=None):
+    """
+    Estimate how long the request would take on this worker.
+    
+    Expected time = wait for the generations ahead of it + prefill of this
+    prompt + decode of a typical completion, using the measured prefill and
+    decode rates. The generations ahead are the ones running plus the ones
+    waiting in the admission queue, each taking the smoothed generation
+    time, spread over the generation slots.
+    
+    Args:
+        prompt_tokens: Prompt size in tokens
+        rates: Generation rates (defaults to ``get_generation_rates()``)
+        admission: Admission queue stats (defaults to ``get_admission_stats()``)
+        
+    Returns:
+        float: Seconds, or None if no local generation has been measured yet
+    """
+    rates = rates or get_generation_rates()
+    if not rates.get('prefill_tokens_per_sec') or not rates.get('decode_tokens_per_sec'):
+        return None
+    admission = admission or get_admission_stats()
+    completion_tokens = rates.get('completion_tokens') or DEFAULT_COMPLETION_TOKENS
+    own_time = prompt_tokens / rates['prefill_tokens_per_sec'] + completion_tokens / rates['decode_tokens_per_sec']
+    ahead = rates.get('in_flight', 0) + admission.get('waiting', 0)
+    queue_wait = ahead * (rates.get('generation_seconds') or own_time) / max(1, admission.get('slots', 1))
+    return queue_wait + own_time
+
+def decide_offload(request_data, system_metrics=None):
+    """
+    Decide whether a request should be offloaded to Lambda and log why.
+    
+    The request is offloaded when the Lambda path is expected to answer
+    sooner than the local model (by OFFLOAD_LATENCY_MARGIN). Configured
+    model modes are always offloaded, and memory pressure forces offloading
+    to protect the worker. Before the local rates have been measured, large
+    prompts (OFFLOAD_TOKEN_THRESHOLD tokens) are offloaded.
+    
+    Args:
+        request_data: Dict containing request information
+        system_metrics: Dict containing CPU, memory usage info
+        
+    Returns:
+        dict: ``offload`` (bool), ``reason`` and the inputs of the decision
+    """
+    decision = {
+        'decision_id': uuid.uuid4().hex,
+        'timestamp': time.time(),
+        'model_mode': request_data.get('model_mode'),
+    }
+    
+    if not is_offloading_enabled():
+        decision.update(offload=False, reason='disabled')
+        return decision
+    
+    memory_threshold = getattr(settings, 'OFFLOAD_MEMORY_THRESHOLD', 85)
+    if system_metrics and system_metrics.get('memory_percent', 0) > memory_threshold:
+        decision.update(offload=True, reason='memory_pressure', memory_percent=system_metrics.get('memory_percent'))
+    elif request_data.get('model_mode') in getattr(settings, 'ALWAYS_OFFLOAD_MODELS', []):
+        decision.update(offload=True, reason='model_mode')
+    else:
+        prompt_tokens = estimate_prompt_tokens(request_data)
+        rates = get_generation_rates()
+        admission = get_admission_stats()
+        local_estimate = estimate_local_latency(prompt_tokens, rates, admission)
+        remote_estimate = estimate_remote_latency()
+        decision.update(
+            prompt_tokens=prompt_tokens,
+            local_in_flight=rates.get('in_flight', 0),
+            local_waiting=admission.get('waiting', 0),
+            local_slots=admission.get('slots', 1),
+            local_estimate=local_estimate,
+            remote_estimate=remote_estimate,
+        )
+        if local_estimate is None:
+            token_threshold = getattr(settings, 'OFFLOAD_TOKEN_THRESHOLD', 2000)
+            offload = prompt_tokens > token_threshold
+            decision.update(offload=offload, reason='large_prompt_unmeasured' if offload else 'local_unmeasured')
+        else:
+            offload = remote_estimate * (1 + OFFLOAD_LATENCY_MARGIN) < local_estimate
+            decision.update(offload=offload, reason='remote_faster' if offload else 'local_faster')
+    
+    decision_logger.info(json.dumps(decision))
+    if decision['offload']:
+        logger.info(f"Offloading request ({decision['reason']})")
+    return decision
+
 def should_offload_request(request_data, system_metrics=None):
     """
     Determine if a request should be offloaded to Lambda.
@@ -46,44 +260,165 @@ def should_offload_request(request_data, system_metrics=None):
     Returns:
         bool: True if the request should be offloaded, False otherwise
     """
-    if not is_offloading_enabled():
-        return False
+    return decide_offload(request_data, system_metrics)['offload']
+
+def _count_tokens_function():
+    """Return the model tokenizer's count function if loaded, else a chars/4 estimate."""
+    try:
+        from .llm_handler import LlamaModel
+        llama_model = LlamaModel()
+        if llama_model.is_initialized():
+            return llama_model.count_tokens
+    except Exception as e:
+        logger.warning(f"Falling back to character-based token counts: {str(e)}")
+    return lambda text: len(text) // 4 + 1
+
+def pack_history(history, max_tokens=LAMBDA_HISTORY_TOKEN_BUDGET, count_tokens=None):
+    """
+    Keep the most recent history messages that fit in a token budget.
+    
+    Messages are dropped whole, oldest first, so the remote model sees the
+    same recent context the local model would, never a cut-off message.
+    
+    Args:
+        history: List of ``{"role", "content"}`` messages, oldest first
+        max_tokens: Token budget for the history
+        count_tokens: Function returning the token count of a string
         
-    # Get thresholds from settings or use defaults
-    cpu_threshold = getattr(settings, 'OFFLOAD_CPU_THRESHOLD', 80)
-    memory_threshold = getattr(settings, 'OFFLOAD_MEMORY_THRESHOLD', 85)
+    Returns:
+        tuple: (packed messages, number of messages dropped)
+    """
+    count_tokens = count_tokens or _count_tokens_function()
+    packed = []
+    used = 0
+    for message in reversed(history):
+        tokens = count_tokens(message.get('content', ''))
+        if used + tokens > max_tokens:
+            break
+        packed.append(message)
+        used += tokens
+    packed.reverse()
+    return packed, len(history) - len(packed)
+
+def _record_payload_stats(raw_size, encoded_size, encode_ms, compressed, referenced, history_dropped):
+    with _payload_stats_lock:
+        _payload_stats['payloads'] += 1
+        _payload_stats['compressed'] += int(compressed)
+        _payload_stats['blob_references'] += int(referenced)
+        _payload_stats['raw_bytes'] += raw_size
+        _payload_stats['encoded_bytes'] += encoded_size
+        _payload_stats['history_messages_dropped'] += history_dropped
+        _encode_times.record(encode_ms)
     
-    # Check system resource usage
-    if system_metrics and (
-        system_metrics.get('cpu_percent', 0) > cpu_threshold or
-        system_metrics.get('memory_percent', 0) > memory_threshold
-    ):
-        logger.info(f"Offloading request due to resource constraints: CPU {system_metrics.get('cpu_percent')}%, Memory {system_metrics.get('memory_percent')}%")
-        return True
+    if getattr(settings, 'CLOUDWATCH_METRICS_ENABLED', False):
+        publisher = get_cloudwatch_publisher()
+        publisher.put(PAYLOAD_METRICS_NAMESPACE, 'LambdaPayloadRawBytes', raw_size, 'Bytes')
+        publisher.put(PAYLOAD_METRICS_NAMESPACE, 'LambdaPayloadEncodedBytes', encoded_size, 'Bytes')
+        publisher.put(PAYLOAD_METRICS_NAMESPACE, 'LambdaPayloadEncodeTime', encode_ms, 'Milliseconds')
+
+def get_payload_stats():
+    """
+    Get Lambda payload statistics for this process.
     
-    # Check for specific model modes that should always be offloaded
-    if request_data.get('model_mode') in getattr(settings, 'ALWAYS_OFFLOAD_MODELS', []):
-        logger.info(f"Offloading request for model mode: {request_data.get('model_mode')}")
-        return True
+    Returns:
+        dict: Payload counts, byte totals, compression ratio and encode time percentiles
+    """
+    with _payload_stats_lock:
+        stats = dict(_payload_stats)
+        stats['encode_time'] = _encode_times.summary()
+    stats['compression_ratio'] = (
+        round(stats['raw_bytes'] / stats['encoded_bytes'], 2) if stats['encoded_bytes'] else None
+    )
+    return stats
+
+def encode_payload(payload, encoding=LAMBDA_PAYLOAD_ENCODING, blob_store=None):
+    """
+    Serialize a payload into a Lambda invocation envelope.
+    
+    The payload is serialized once. If it is large enough it is gzipped and
+    base64-encoded into ``body`` with ``content_encoding`` set to
+    ``"gzip"``; small payloads are sent as plain JSON (``"identity"``). If
+    the result would still exceed the Lambda limit, the encoded bytes are
+    uploaded to the blob store and ``body_ref`` carries the reference.
+    
+    Args:
+        payload: JSON-serializable dict
+        encoding: "gzip" or "identity"
+        blob_store: Store for oversized payloads (defaults to ``get_blob_store()``)
         
-    # Check request size - offload larger requests
-    input_length = len(request_data.get('user_input', ''))
-    large_request_threshold = getattr(settings, 'OFFLOAD_TOKEN_THRESHOLD', 2000)
-    if input_length > large_request_threshold:
-        logger.info(f"Offloading large request with {input_length} characters")
-        return True
+    Returns:
+        tuple: (envelope dict, stats dict with raw/encoded sizes and encode time)
+    """
+    start = time.perf_counter()
+    raw = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    
+    content_encoding = 'identity'
+    body = raw
+    if encoding == 'gzip' and len(raw) >= LAMBDA_COMPRESSION_MIN_BYTES:
+        body = gzip.compress(raw, compresslevel=6)
+        content_encoding = 'gzip'
+    
+    envelope = {'content_encoding': content_encoding, 'metadata': payload.get('metadata', {})}
+    # Base64 grows the body by a third
+    if (len(body) + 2) // 3 * 4 <= LAMBDA_INLINE_PAYLOAD_LIMIT:
+        envelope['body'] = base64.b64encode(body).decode('ascii')
+        referenced = False
+    else:
+        store = blob_store or get_blob_store()
+        envelope['body_ref'] = store.put(body)
+        referenced = True
+        logger.info(f"Payload of {len(raw)} bytes sent by reference ({envelope['body_ref']['store']})")
+    
+    stats = {
+        'raw_size': len(raw),
+        'encoded_size': len(body),
+        'encode_ms': (time.perf_counter() - start) * 1000,
+        'compressed': content_encoding == 'gzip',
+        'referenced': referenced,
+    }
+    return envelope, stats
+
+def decode_payload(envelope, blob_store=None):
+    """
+    Inverse of ``encode_payload`` (used by the Lambda function, and for
+    responses the function returns in an envelope).
+    
+    Args:
+        envelope: Dict with ``content_encoding`` and ``body`` or ``body_ref``
+        blob_store: Store to resolve ``body_ref`` (defaults to ``get_blob_store()``)
         
-    return False
+    Returns:
+        dict: The original payload
+        
+    Raises:
+        ValueError: For an unknown content encoding
+    """
+    if 'body_ref' in envelope:
+        body = (blob_store or get_blob_store()).get(envelope['body_ref'])
+    else:
+        body = base64.b64decode(envelope['body'])
+    
+    content_encoding = envelope.get('content_encoding', 'identity')
+    if content_encoding == 'gzip':
+        body = gzip.decompress(body)
+    elif content_encoding != 'identity':
+        raise ValueError(f"Unsupported payload content encoding: {content_encoding}")
+    return json.loads(body)
 
 def prepare_lambda_payload(request_data):
     """
     Prepare a request payload for Lambda invocation.
     
+    Conversation history (``history``, or the session's history if the
+    model is loaded) is packed to LAMBDA_HISTORY_TOKEN_BUDGET tokens, and
+    the payload is compressed into an envelope. Oversized payloads are sent
+    by blob store reference rather than truncated.
+    
     Args:
         request_data: Dict containing the request data
         
     Returns:
-        Dict: Lambda-compatible payload
+        Dict: Lambda-compatible payload envelope
     """
     # Create a copy of the request data
     payload = request_data.copy()
@@ -95,36 +430,42 @@ def prepare_lambda_payload(request_data):
         'version': getattr(settings, 'APP_VERSION', '1.0.0')
     }
     
-    # Check payload size
-    payload_json = json.dumps(payload)
-    payload_size = len(payload_json.encode('utf-8'))
-    
-    if payload_size > MAX_LAMBDA_PAYLOAD_SIZE:
-        # Truncate user input if needed
-        logger.warning(f"Payload size ({payload_size} bytes) exceeds Lambda limit")
-        
-        # If the input is very large, we need to truncate it
-        if 'user_input' in payload and len(payload['user_input']) > 1000:
-            # Truncate to a safe size, preserving start and end context
-            max_input_size = 1000  # This is a heuristic
-            input_text = payload['user_input']
-            half_size = max_input_size // 2
-            payload['user_input'] = input_text[:half_size] + "..." + input_text[-half_size:]
-            payload['truncated'] = True
-            
-            # Recalculate size
-            payload_json = json.dumps(payload)
-            payload_size = len(payload_json.encode('utf-8'))
-            
-            if payload_size > MAX_LAMBDA_PAYLOAD_SIZE:
-                # If still too large, use a simplified payload
-                logger.error("Payload still too large after truncation")
-                return {
-                    'error': 'Request too large for Lambda processing',
-                    'metadata': payload['metadata']
-                }
+    history = payload.get('history')
+    count_tokens = None
+    if history is None and payload.get('chat_session_id'):
+        count_tokens = _count_tokens_function()
+        try:
+            from .llm_handler import LlamaModel
+            llama_model = LlamaModel()
+            if llama_model.is_initialized():
+                history = list(llama_model.conversation_history.get(payload['chat_session_id'], []))
+        except Exception as e:
+            logger.warning(f"Could not read session history for Lambda payload: {str(e)}")
+    
+    history_dropped = 0
+    if history:
+        payload['history'], history_dropped = pack_history(history, count_tokens=count_tokens)
+        if history_dropped:
+            payload['history_dropped'] = history_dropped
     
-    return payload
+    try:
+        envelope, stats = encode_payload(payload)
+    except Exception as e:
+        logger.exception(f"Failed to encode Lambda payload: {str(e)}")
+        return {
+            'error': 'Request could not be prepared for Lambda processing',
+            'metadata': payload['metadata']
+        }
+    
+    _record_payload_stats(
+        stats['raw_size'], stats['encoded_size'], stats['encode_ms'],
+        stats['compressed'], stats['referenced'], history_dropped
+    )
+    logger.debug(
+        f"Lambda payload {stats['raw_size']} -> {stats['encoded_size']} bytes "
+        f"({envelope['content_encoding']}) in {stats['encode_ms']:.1f}ms"
+    )
+    return envelope
 
 def invoke_lambda_function(payload):
     """
@@ -141,11 +482,13 @@ def invoke_lambda_function(payload):
         response = lambda_client.invoke(
             FunctionName=LAMBDA_FUNCTION_NAME,
             InvocationType='RequestResponse',  # Synchronous
-            Payload=json.dumps(payload)
+            Payload=json.dumps(payload, separators=(',', ':'))
         )
         
-        # Parse the response
+        # Parse the response (the function may reply in the same envelope format)
         response_payload = json.loads(response['Payload'].read().decode('utf-8'))
+        if isinstance(response_payload, dict) and 'content_encoding' in response_payload:
+            response_payload = decode_payload(response_payload)
         
         # Check for Lambda execution errors
         if 'FunctionError' in response:
@@ -164,20 +507,30 @@ def invoke_lambda_function(payload):
             'message': str(e)
         }
 
-def process_via_lambda(request_data, system_metrics=None):
+def process_via_lambda(request_data, system_metrics=None, asynchronous=False, owner=None):
     """
     Process an LLM request via AWS Lambda.
     
     Args:
         request_data: Dict containing the request data
         system_metrics: Dict containing system resource usage
+        asynchronous: Submit a job and return its id instead of waiting
+        owner: Id of the user allowed to read an asynchronous result
         
     Returns:
-        Dict: Response from Lambda processing
+        Dict: Response from Lambda processing, or ``job_id`` and
+        ``status`` "pending" for an asynchronous job
     """
     # Check if we should offload
-    if not should_offload_request(request_data, system_metrics):
-        return {'offloaded': False, 'reason': 'Offloading not required'}
+    decision = decide_offload(request_data, system_metrics)
+    if not decision['offload']:
+        return {'offloaded': False, 'reason': 'Offloading not required', 'decision': decision['reason']}
+    
+    if asynchronous:
+        job_id = submit_lambda_job(request_data, owner=owner, decision_id=decision['decision_id'])
+        if job_id is None:
+            return {'offloaded': False, 'reason': 'Lambda job could not be submitted'}
+        return {'offloaded': True, 'job_id': job_id, 'status': 'pending'}
     
     # Prepare the payload
     payload = prepare_lambda_payload(request_data)
@@ -195,5 +548,242 @@ def process_via_lambda(request_data, system_metrics=None):
     response['offloaded'] = True
     response['processing_time'] = processing_time
     
+    if 'error' not in response:
+        record_remote_latency(processing_time)
+    # Log the outcome next to the decision so the estimate can be checked offline
+    decision_logger.info(json.dumps({
+        'decision_id': decision['decision_id'],
+        'outcome': 'error' if 'error' in response else 'ok',
+        'remote_latency': processing_time,
+    }))
+    
     logger.info(f"Lambda processing completed in {processing_time:.2f}s")
-    return response 
\ No newline at end of file
+    return response 
+
+def _job_key(job_id):
+    return f"{LAMBDA_JOB_KEY_PREFIX}{job_id}"
+
+def _count_job(stat):
+    with _job_stats_lock:
+        _job_stats[stat] += 1
+
+def get_lambda_job(job_id):
+    """
+    Get the state of an asynchronous Lambda job.
+    
+    Returns:
+        dict: ``status`` ("pending", "complete" or "error"), ``owner``,
+        ``submitted_at`` and, once finished, ``result`` or ``error``;
+        None if the job is unknown or expired
+    """
+    return cache.get(_job_key(job_id))
+
+def _finish_lambda_job(job_id, **fields):
+    """
+    Move a pending job to its final state, exactly once.
+    
+    The first caller to add the job's ``:finished`` marker wins (``cache.add``
+    is atomic, also across workers with a shared cache), so a late failure or
+    timeout can never overwrite a stored result, nor a duplicate callback a
+    failure. The job thread waiting in this process is woken at once.
+    
+    Returns:
+        bool: True if this call finished the job
+    """
+    job = get_lambda_job(job_id)
+    if job is None or job['status'] != 'pending':
+        return False
+    if not cache.add(f"{_job_key(job_id)}:finished", True, LAMBDA_ASYNC_TIMEOUT + LAMBDA_JOB_TTL):
+        return False
+    
+    job.update(fields, completed_at=time.time())
+    cache.set(_job_key(job_id), job, LAMBDA_JOB_TTL)
+    with _job_futures_lock:
+        future = _job_futures.pop(job_id, None)
+    if future is not None:
+        future.set_result(job)
+    return True
+
+def complete_lambda_job(job_id, result):
+    """
+    Store the result of an asynchronous job (called from the callback view).
+    
+    The result may be in the payload envelope format. Results for unknown
+    or already finished jobs are ignored.
+    
+    Args:
+        job_id: Job id
+        result: Dict returned by the Lambda function
+        
+    Returns:
+        bool: True if the result was stored
+    """
+    job = get_lambda_job(job_id)
+    if job is None or job['status'] != 'pending':
+        return False
+    
+    if isinstance(result, dict) and 'content_encoding' in result:
+        result = decode_payload(result)
+    
+    if isinstance(result, dict) and 'error' in result:
+        return _finish_lambda_job(job_id, status='error', error=result['error'])
+    return _finish_lambda_job(job_id, status='complete', result=result)
+
+def _fail_lambda_job(job_id, error):
+    return _finish_lambda_job(job_id, status='error', error=error)
+
+def _wait_for_lambda_job(job_id, future, timeout):
+    """
+    Wait for a job to finish, or ``timeout`` seconds.
+    
+    A result posted to this process resolves ``future`` straight away. With
+    a shared cache the callback may reach another worker instead, so the
+    cache is also read every LAMBDA_JOB_SHARED_CHECK_INTERVAL seconds.
+    
+    Returns:
+        dict: The job state (still "pending" after a timeout), or None if it expired
+    """
+    check_interval = LAMBDA_JOB_SHARED_CHECK_INTERVAL if shared_cache_configured() else None
+    deadline = time.time() + timeout
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return get_lambda_job(job_id)
+        try:
+            return future.result(remaining if check_interval is None else min(remaining, check_interval))
+        except FutureTimeoutError:
+            if check_interval is not None:
+                job = get_lambda_job(job_id)
+                if job is None or job['status'] != 'pending':
+                    return job
+
+def invoke_lambda_function_async(payload):
+    """
+    Invoke the Lambda function without waiting for it to run.
+    
+    Args:
+        payload: Payload envelope (with a ``job`` entry telling the function
+            where to report its result)
+        
+    Returns:
+        Dict: Empty on success, or ``error``/``message`` if the invocation was rejected
+    """
+    try:
+        response = lambda_client.invoke(
+            FunctionName=LAMBDA_FUNCTION_NAME,
+            InvocationType='Event',  # Asynchronous, Lambda queues the event
+            Payload=json.dumps(payload, separators=(',', ':'))
+        )
+        if response.get('StatusCode') != 202:
+            return {
+                'error': 'Lambda did not accept the event',
+                'message': f"StatusCode {response.get('StatusCode')}"
+            }
+        return {}
+    except Exception as e:
+        logger.exception(f"Error invoking Lambda function asynchronously: {str(e)}")
+        return {
+            'error': 'Failed to submit request to Lambda',
+            'message': str(e)
+        }
+
+def _run_lambda_job(job_id, payload, decision_id=None):
+    """Invoke the function for a job, then hold its slot until the result arrives."""
+    start_time = time.time()
+    future = Future()
+    with _job_futures_lock:
+        _job_futures[job_id] = future
+    try:
+        invoke_result = invoke_lambda_function_async(payload)
+        if 'error' in invoke_result:
+            _fail_lambda_job(job_id, invoke_result['message'])
+            outcome = 'error'
+        else:
+            job = _wait_for_lambda_job(job_id, future, LAMBDA_ASYNC_TIMEOUT)
+            if job is not None and job['status'] == 'pending' and _fail_lambda_job(
+                job_id, 'Timed out waiting for the Lambda result'
+            ):
+                _count_job('timed_out')
+                outcome = 'timeout'
+            else:
+                # The result may have been stored just as the wait timed out
+                job = get_lambda_job(job_id)
+                outcome = 'ok' if job is not None and job['status'] == 'complete' else 'error'
+        
+        processing_time = time.time() - start_time
+        if outcome == 'ok':
+            _count_job('completed')
+            record_remote_latency(processing_time)
+        else:
+            _count_job('failed')
+        if decision_id:
+            decision_logger.info(json.dumps({
+                'decision_id': decision_id,
+                'outcome': outcome,
+                'remote_latency': processing_time,
+            }))
+    except Exception as e:
+        logger.exception(f"Error running Lambda job {job_id}: {str(e)}")
+        _fail_lambda_job(job_id, str(e))
+        _count_job('failed')
+    finally:
+        with _job_futures_lock:
+            _job_futures.pop(job_id, None)
+        _job_slots.release()
+
+def submit_lambda_job(request_data, owner=None, decision_id=None):
+    """
+    Offload a request to Lambda as an asynchronous job.
+    
+    Returns as soon as the job is queued; the invocation itself happens on
+    the job pool. The function reports its result by posting to the
+    ``callback_url`` in the payload's ``job`` entry (or, if it shares the
+    cache, by writing the job's ``result_key`` directly).
+    
+    Args:
+        request_data: Dict containing the request data
+        owner: Id of the user allowed to read the result
+        decision_id: Offload decision id, to log the outcome against
+        
+    Returns:
+        str: Job id, or None if too many jobs are outstanding or the
+        payload could not be prepared (the caller should run it locally)
+    """
+    if not _job_slots.acquire(blocking=False):
+        _count_job('refused')
+        logger.warning(f"{LAMBDA_ASYNC_MAX_OUTSTANDING} Lambda jobs outstanding, not offloading")
+        return None
+    
+    try:
+        payload = prepare_lambda_payload(request_data)
+        if 'error' in payload:
+            _job_slots.release()
+            return None
+        
+        job_id = uuid.uuid4().hex
+        payload['job'] = {
+            'job_id': job_id,
+            'callback_url': LAMBDA_CALLBACK_URL,
+            'result_key': _job_key(job_id),
+        }
+        cache.set(_job_key(job_id), {
+            'status': 'pending',
+            'owner': owner,
+            'submitted_at': time.time(),
+        }, LAMBDA_ASYNC_TIMEOUT + LAMBDA_JOB_TTL)
+        _job_executor.submit(_run_lambda_job, job_id, payload, decision_id)
+    except Exception as e:
+        _job_slots.release()
+        logger.exception(f"Failed to submit Lambda job: {str(e)}")
+        return None
+    
+    _count_job('submitted')
+    return job_id
+
+def get_lambda_job_stats():
+    """Return async job counters for this process."""
+    with _job_stats_lock:
+        stats = dict(_job_stats)
+    # BoundedSemaphore keeps its counter in _value
+    stats['outstanding'] = LAMBDA_ASYNC_MAX_OUTSTANDING - _job_slots._value
+    return stats
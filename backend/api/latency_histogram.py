@@ -0,0 +1,201 @@
+"""
+Mergeable latency histograms.
+
+This module provides an HDR-style histogram with log-linear buckets stored in
+a flat integer array. Every power-of-two range of latencies is split into a
+fixed number of linear sub-buckets, which bounds the relative error of any
+reported percentile (at most 1/16, about 6%, with the default precision)
+while keeping the whole histogram to a few hundred counters.
+
+Histograms from different threads or worker processes are combined by adding
+their bucket arrays, so percentiles stay exact with respect to the bucketing
+no matter how many workers contributed.
+"""
+
+import math
+from array import array
+
+# Number of bits of sub-bucket precision. Values below 2**5 = 32 get a bucket
+# each; every power-of-two range above that is split into 16 linear
+# sub-buckets. A reported percentile is the exclusive upper end of its
+# bucket, so it overstates the true value by at most 1/16 (~6%).
+PRECISION_BITS = 5
+SUB_BUCKET_COUNT = 1 << PRECISION_BITS
+HALF_SUB_BUCKET_COUNT = SUB_BUCKET_COUNT >> 1
+
+# Highest trackable latency in milliseconds (1 hour); larger values are clamped.
+MAX_TRACKABLE_MS = 60 * 60 * 1000
+
+
+def _bucket_index(value):
+    """Map a non-negative integer value to its bucket index."""
+    if value < SUB_BUCKET_COUNT:
+        return value
+    shift = value.bit_length() - PRECISION_BITS
+    sub_bucket = value >> shift
+    return SUB_BUCKET_COUNT + (shift - 1) * HALF_SUB_BUCKET_COUNT + (sub_bucket - HALF_SUB_BUCKET_COUNT)
+
+
+def _bucket_upper_bound(index):
+    """Return the highest value that maps to the given bucket index."""
+    if index < SUB_BUCKET_COUNT:
+        return index
+    offset = index - SUB_BUCKET_COUNT
+    shift = offset // HALF_SUB_BUCKET_COUNT + 1
+    sub_bucket = offset % HALF_SUB_BUCKET_COUNT + HALF_SUB_BUCKET_COUNT
+    return ((sub_bucket + 1) << shift) - 1
+
+
+BUCKET_COUNT = _bucket_index(MAX_TRACKABLE_MS) + 1
+
+
+class LatencyHistogram:
+    """
+    Log-linear latency histogram in milliseconds.
+
+    It can also hold other non-negative values (token counts, tokens/sec) at a
+    resolution of one unit; the ``*_ms`` attribute names then refer to that unit.
+
+    The histogram is not thread-safe on its own; callers that share one
+    instance between threads must serialize access (the monitoring module
+    keeps one histogram per thread shard and merges them on flush).
+    """
+
+    __slots__ = ("counts", "count", "total_ms", "min_ms", "max_ms")
+
+    def __init__(self):
+        self.counts = array("Q", bytes(8 * BUCKET_COUNT))
+        self.count = 0
+        self.total_ms = 0.0
+        self.min_ms = None
+        self.max_ms = 0.0
+
+    def record(self, latency_ms):
+        """
+        Record a single latency.
+
+        Args:
+            latency_ms: Latency in milliseconds
+        """
+        latency_ms = max(float(latency_ms), 0.0)
+        value = min(int(latency_ms), MAX_TRACKABLE_MS)
+        self.counts[_bucket_index(value)] += 1
+        self.count += 1
+        self.total_ms += latency_ms
+        if self.min_ms is None or latency_ms < self.min_ms:
+            self.min_ms = latency_ms
+        if latency_ms > self.max_ms:
+            self.max_ms = latency_ms
+
+    def merge(self, other):
+        """Add all samples of ``other`` into this histogram."""
+        if not other.count:
+            return self
+        counts = self.counts
+        for index, bucket_count in enumerate(other.counts):
+            if bucket_count:
+                counts[index] += bucket_count
+        self.count += other.count
+        self.total_ms += other.total_ms
+        if self.min_ms is None or (other.min_ms is not None and other.min_ms < self.min_ms):
+            self.min_ms = other.min_ms
+        self.max_ms = max(self.max_ms, other.max_ms)
+        return self
+
+    def percentile(self, percent):
+        """
+        Get the latency at the given percentile.
+
+        Args:
+            percent: Percentile between 0 and 100
+
+        Returns:
+            float: Latency in milliseconds (upper bound of the matching bucket,
+            capped at the largest recorded value), or 0 when empty
+        """
+        if not self.count:
+            return 0.0
+        target = min(max(1, math.ceil(self.count * percent / 100.0)), self.count)
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            if not bucket_count:
+                continue
+            seen += bucket_count
+            if seen >= target:
+                return float(min(_bucket_upper_bound(index) + 1, self.max_ms))
+        return float(self.max_ms)
+
+    def cumulative_count(self, upper_bound):
+        """
+        Count samples whose bucket lies entirely at or below ``upper_bound``.
+
+        Used to project the fine-grained buckets onto coarse exposition
+        boundaries (e.g. Prometheus ``le`` buckets). A bucket that straddles the
+        boundary is attributed to the next boundary.
+        """
+        total = 0
+        for index, bucket_count in enumerate(self.counts):
+            if bucket_count:
+                if _bucket_upper_bound(index) + 1 > upper_bound:
+                    break
+                total += bucket_count
+        return total
+
+    def summary(self, suffix="_ms"):
+        """
+        Return count, mean and p50/p90/p99/max.
+
+        Args:
+            suffix: Unit suffix for the keys; pass ``""`` when the histogram
+                holds non-latency values such as token counts
+        """
+        return {
+            "count": self.count,
+            f"mean{suffix}": round(self.total_ms / self.count, 2) if self.count else 0,
+            f"p50{suffix}": round(self.percentile(50), 2),
+            f"p90{suffix}": round(self.percentile(90), 2),
+            f"p99{suffix}": round(self.percentile(99), 2),
+            f"max{suffix}": round(self.max_ms, 2),
+        }
+
+    def to_dict(self):
+        """
+        Encode the histogram compactly for JSON storage.
+
+        Only non-empty buckets are stored, as a flat ``[index, count, ...]`` list.
+        """
+        buckets = []
+        for index, bucket_count in enumerate(self.counts):
+            if bucket_count:
+                buckets.extend((index, bucket_count))
+        return {
+            "b": buckets,
+            "n": self.count,
+            "sum": self.total_ms,
+            "min": self.min_ms,
+            "max": self.max_ms,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Decode a histogram produced by ``to_dict``."""
+        histogram = cls()
+        if not data:
+            return histogram
+        buckets = data.get("b", [])
+        for position in range(0, len(buckets) - 1, 2):
+            index = int(buckets[position])
+            if 0 <= index < BUCKET_COUNT:
+                histogram.counts[index] += int(buckets[position + 1])
+        histogram.count = int(data.get("n", 0))
+        histogram.total_ms = float(data.get("sum", 0.0))
+        histogram.min_ms = data.get("min")
+        histogram.max_ms = float(data.get("max", 0.0))
+        return histogram
+
+    @classmethod
+    def coerce(cls, value):
+        """Return ``value`` as a histogram, decoding it if it is an encoded dict."""
+        if isinstance(value, cls):
+            return value
+        return cls.from_dict(value)
@@ -10,13 +10,35 @@ import tempfile
 import psutil
 import time
 import json
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+from .monitoring import (
+    trace_span, annotate_trace, set_gauge, record_generation, local_generation, record_cancelled_generation,
+    record_max_tokens_hit
+)
+from .cloudwatch_publisher import get_cloudwatch_publisher
+from .rate_limit import RateLimited, get_rate_limiter
+from .admission import ADMISSION_CONCURRENCY
+from .token_budget import TokenBudgetEstimator
+
+# Per-thread details of the generation in progress (e.g. final prompt size)
+_generation_local = threading.local()
+
 # Constants for resource monitoring and scaling
 CPU_THRESHOLD = 80  # CPU usage percentage to trigger offloading
 MEMORY_THRESHOLD = 80  # Memory usage percentage to trigger offloading
 METRICS_COLLECTION_INTERVAL = 60  # Seconds between metrics collection
 CACHE_SIZE_GB = 2  # Size of RAM cache in GB
+GENERATION_MAX_TOKENS = 2000  # Increased from 1000 to use more of the available context
+# Picks each request's max_tokens (at most GENERATION_MAX_TOKENS) from past answer lengths
+token_budget = TokenBudgetEstimator(GENERATION_MAX_TOKENS)
+
+# Generations started from async code (async views, WebSockets) run on these
+# threads so the event loop never blocks on the model. Admission control
+# bounds concurrent generations, so no more threads than slots are needed.
+ASYNC_INFERENCE_WORKERS = getattr(settings, 'ASYNC_INFERENCE_WORKERS', ADMISSION_CONCURRENCY)
+inference_executor = ThreadPoolExecutor(max_workers=ASYNC_INFERENCE_WORKERS, thread_name_prefix="async-inference")
 
 def format_math_response(text):
     """Adds $$ delimiters around VERY basic math patterns."""
@@ -88,6 +110,7 @@ class LlamaModel:
     
     def _collect_metrics(self):
         """Collect system resource metrics periodically"""
+        process = psutil.Process()
         while True:
             try:
                 # Collect CPU and memory metrics
@@ -95,14 +118,27 @@ class LlamaModel:
                 memory = psutil.virtual_memory()
                 memory_percent = memory.percent
                 
+                # Collect this worker process's own usage
+                process_memory = process.memory_info()
+                process_cpu = process.cpu_times()
+                
                 # Store metrics
                 self._resource_metrics = {
                     'timestamp': datetime.now().isoformat(),
                     'cpu_percent': cpu_percent,
                     'memory_percent': memory_percent,
-                    'memory_available_gb': memory.available / (1024 * 1024 * 1024)
+                    'memory_available_gb': memory.available / (1024 * 1024 * 1024),
+                    'process_rss_bytes': process_memory.rss,
+                    'process_cpu_seconds': process_cpu.user + process_cpu.system
                 }
                 
+                # Publish as per-process gauges for the /metrics endpoint
+                set_gauge('process_resident_memory_bytes', process_memory.rss)
+                set_gauge('process_cpu_seconds_total', process_cpu.user + process_cpu.system)
+                set_gauge('system_cpu_percent', cpu_percent)
+                set_gauge('system_memory_percent', memory_percent)
+                set_gauge('model_loaded', 1 if hasattr(self, 'llm') else 0)
+                
                 # Determine if we should offload to serverless
                 should_offload = (cpu_percent > CPU_THRESHOLD or 
                                  memory_percent > MEMORY_THRESHOLD)
@@ -127,42 +163,22 @@ class LlamaModel:
                 time.sleep(10)  # Sleep longer if there was an error
     
     def _push_metrics_to_cloudwatch(self):
-        """Push collected metrics to AWS CloudWatch"""
+        """Queue collected metrics for the batched CloudWatch publisher"""
         try:
-            cloudwatch = boto3.client('cloudwatch')
-            instance_id = self._get_instance_id()
+            publisher = get_cloudwatch_publisher()
+            dimensions = [
+                {
+                    'Name': 'InstanceId',
+                    'Value': self._get_instance_id()
+                }
+            ]
             
-            # Put CPU usage metric
-            cloudwatch.put_metric_data(
-                Namespace='LLM/Resources',
-                MetricData=[
-                    {
-                        'MetricName': 'CPUUtilization',
-                        'Value': self._resource_metrics['cpu_percent'],
-                        'Unit': 'Percent',
-                        'Dimensions': [
-                            {
-                                'Name': 'InstanceId',
-                                'Value': instance_id
-                            }
-                        ]
-                    },
-                    {
-                        'MetricName': 'MemoryUtilization',
-                        'Value': self._resource_metrics['memory_percent'],
-                        'Unit': 'Percent',
-                        'Dimensions': [
-                            {
-                                'Name': 'InstanceId',
-                                'Value': instance_id
-                            }
-                        ]
-                    }
-                ]
-            )
-            print("Pushed metrics to CloudWatch")
+            publisher.put('LLM/Resources', 'CPUUtilization',
+                          self._resource_metrics['cpu_percent'], 'Percent', dimensions)
+            publisher.put('LLM/Resources', 'MemoryUtilization',
+                          self._resource_metrics['memory_percent'], 'Percent', dimensions)
         except Exception as e:
-            print(f"Error pushing metrics to CloudWatch: {str(e)}")
+            print(f"Error queueing metrics for CloudWatch: {str(e)}")
     
     def _get_instance_id(self):
         """Get the EC2 instance ID if running on EC2"""
@@ -247,6 +263,7 @@ class LlamaModel:
 
                         # Add RAM cache to improve performance
                         self._setup_model_cache()
+                        set_gauge('model_loaded', 1)
 
                         print(f"Model loaded successfully from S3 with context window of {self.context_size} tokens!")
                         return True
@@ -454,19 +471,31 @@ class LlamaModel:
             # Return a conservative estimate
             return 1500  # A high estimate to trigger trimming
 
-    def trim_history_to_fit_context(self, chat_session_id, current_input):
-        """Trim conversation history to fit within context window"""
+    def trim_history_to_fit_context(self, chat_session_id, current_input, max_prompt_tokens=None):
+        """
+        Trim conversation history to fit within context window.
+
+        ``max_prompt_tokens`` defaults to the context size minus the full
+        response reservation; a smaller response budget leaves more to history.
+        """
+        with trace_span("trim_history"):
+            return self._trim_history_to_fit_context(
+                chat_session_id, current_input, max_prompt_tokens or self.max_prompt_tokens
+            )
+
+    def _trim_history_to_fit_context(self, chat_session_id, current_input, max_prompt_tokens):
+        history = []
         try:
             history = self.get_conversation_history(chat_session_id)
             estimated_tokens = self.estimate_prompt_tokens(history, current_input)
 
             # If we're already within the limit, no need to trim - return the full history
-            if estimated_tokens <= self.max_prompt_tokens:
-                print(f"History fits within context window ({estimated_tokens}/{self.max_prompt_tokens} tokens) - no trimming needed")
+            if estimated_tokens <= max_prompt_tokens:
+                print(f"History fits within context window ({estimated_tokens}/{max_prompt_tokens} tokens) - no trimming needed")
                 return history
 
             # We need to trim history to fit within context window
-            print(f"History exceeds context window ({estimated_tokens}/{self.max_prompt_tokens} tokens). Starting trimming process.")
+            print(f"History exceeds context window ({estimated_tokens}/{max_prompt_tokens} tokens). Starting trimming process.")
 
             # Strategy for maximizing context with the 8192 token window:
             # 1. Always keep the most recent exchanges (recency is crucial)
@@ -487,11 +516,11 @@ class LlamaModel:
 
                     # Recalculate token count after bulk trimming
                     estimated_tokens = self.estimate_prompt_tokens(history, current_input)
-                    print(f"After bulk trimming: {estimated_tokens}/{self.max_prompt_tokens} tokens")
+                    print(f"After bulk trimming: {estimated_tokens}/{max_prompt_tokens} tokens")
 
             # If still too large, remove older messages iteratively until we fit
             removal_count = 0
-            while estimated_tokens > self.max_prompt_tokens and len(history) > 6:  # Keep at least 3 exchanges (6 messages)
+            while estimated_tokens > max_prompt_tokens and len(history) > 6:  # Keep at least 3 exchanges (6 messages)
                 # Remove messages from the middle, preserving the first exchange and recent messages
                 if len(history) >= 10:  # When we have at least 5 exchanges
                     # Keep first 2 messages (system + first user) and the most recent messages
@@ -511,13 +540,13 @@ class LlamaModel:
 
                 # Log less frequently to reduce console spam
                 if removal_count % 4 == 0:
-                    print(f"Removed {removal_count} {removal_type} messages, current tokens: {estimated_tokens}/{self.max_prompt_tokens}")
+                    print(f"Removed {removal_count} {removal_type} messages, current tokens: {estimated_tokens}/{max_prompt_tokens}")
 
             # Update the conversation history
             self.conversation_history[chat_session_id] = history
 
             # Final log with token counts and percentages
-            token_percentage = (estimated_tokens / self.max_prompt_tokens) * 100
+            token_percentage = (estimated_tokens / max_prompt_tokens) * 100
             print(f"Trimming complete: {len(history)} messages retained ({estimated_tokens} tokens, {token_percentage:.1f}% of available context)")
             print(f"Removed a total of {removal_count} messages to fit within context window")
 
@@ -604,8 +633,13 @@ class LlamaModel:
 
         return False
 
-    def build_prompt_with_history(self, chat_session_id, user_input):
-        """Build a prompt that includes conversation history, ensuring it fits within context window"""
+    def build_prompt_with_history(self, chat_session_id, user_input, max_response_tokens=None):
+        """
+        Build a prompt that includes conversation history, ensuring it fits within context window.
+
+        The history may use everything but ``max_response_tokens`` (default:
+        the full response reservation) of the context window.
+        """
         try:
             # Determine mode and system prompt based on the LATEST user input
             is_math = self.is_math_query(user_input)
@@ -636,7 +670,8 @@ class LlamaModel:
             prompt = system_prompt
 
             # Trim history to fit within context window limits
-            history = self.trim_history_to_fit_context(chat_session_id, user_input)
+            max_prompt_tokens = self.context_size - max_response_tokens if max_response_tokens else None
+            history = self.trim_history_to_fit_context(chat_session_id, user_input, max_prompt_tokens)
 
             # Add conversation history with the appropriate mode tags
             for message in history:
@@ -661,8 +696,11 @@ class LlamaModel:
                 prompt += f"GPT4 Correct User: {user_input}<|end_of_turn|>\nGPT4 Correct Assistant:"
 
             # Final verification
-            token_count = self.count_tokens(prompt)
+            with trace_span("tokenize_prompt"):
+                token_count = self.count_tokens(prompt)
             print(f"Final prompt token count: {token_count} (using {mode} mode)")
+            annotate_trace(prompt_tokens=token_count)
+            _generation_local.prompt_tokens = token_count
 
             # Check if we're still within limits
             if token_count > self.context_size:
@@ -681,7 +719,21 @@ class LlamaModel:
             # Last resort fallback with default mode
             return f"GPT4 Correct User: {user_input}<|end_of_turn|>\nGPT4 Correct Assistant:"
 
-def generate_response(user_input, chat_session_id="default", model_mode="auto"):
+def estimate_generation_tokens(user_input, model_mode="auto"):
+    """
+    Tokens a generation is expected to reserve, for the rate limit pre-check.
+
+    The message (estimated at 4 characters a token, without running the
+    tokenizer) plus its answer budget; for "auto", the larger budget of the
+    two modes, as the mode is detected later. History in the prompt is not
+    counted, so ``generate_response`` may still reserve more.
+    """
+    input_tokens = len(user_input) // 4 + 1
+    modes = {"math": ["Math Correct"], "default": ["GPT4 Correct"]}.get(model_mode, ["Math Correct", "GPT4 Correct"])
+    return input_tokens + max(token_budget.budget(mode, input_tokens) for mode in modes)
+
+def generate_response(user_input, chat_session_id="default", model_mode="auto", rate_limit_key=None,
+                      on_token=None, cancel_event=None):
     """
     Generate a response from the Llama model for the given user input,
     maintaining conversation context for the specific chat session.
@@ -690,14 +742,27 @@ def generate_response(user_input, chat_session_id="default", model_mode="auto"):
         user_input (str): The user's message
         chat_session_id (str): Identifier for the chat session
         model_mode (str): Model mode setting - "auto", "default", or "math"
+        rate_limit_key: If set, the prompt and completion tokens are charged
+            to this key's token bucket (reserved before prefill)
+        on_token (callable): Called with each piece of text as it is generated
+        cancel_event: ``threading.Event`` or ``CancelToken``; when set,
+            decoding stops after the current token and the partial response
+            is returned. If it is set before prefill, the model is not run.
 
     Returns:
-        dict: Contains the AI's response and mode information
+        dict: Contains the AI's response and mode information, and whether
+        the generation was cancelled
+
+    Raises:
+        RateLimited: If ``rate_limit_key``'s bucket cannot cover the prompt
+            plus the answer budget
     """
+    reservation = None
     try:
         print(f"Generating response for input: '{user_input[:50]}...' (Session: {chat_session_id}, Mode: {model_mode})")
 
         llama_model = LlamaModel()
+        _generation_local.prompt_tokens = 0
         if not llama_model.is_initialized():
             print("Model not initialized, initializing now...")
             llama_model.initialize_model()
@@ -724,26 +789,126 @@ def generate_response(user_input, chat_session_id="default", model_mode="auto"):
         # Add user input to conversation history with appropriate mode
         llama_model.add_to_history(chat_session_id, "user", user_input, mode)
 
+        # Budget the answer from similar past answers; the rest of the context is left to history
+        input_tokens = llama_model.count_tokens(user_input)
+        max_tokens = token_budget.budget(mode, input_tokens)
+
         # Build the prompt with conversation history
-        prompt = llama_model.build_prompt_with_history(chat_session_id, user_input)
+        with trace_span("build_prompt"):
+            prompt = llama_model.build_prompt_with_history(chat_session_id, user_input, max_tokens)
+        prompt_tokens = getattr(_generation_local, 'prompt_tokens', 0)
+
+        if cancel_event is not None and cancel_event.is_set():
+            # Cancelled while waiting for a slot: nobody is waiting for the answer
+            history = llama_model.get_conversation_history(chat_session_id)
+            if history and history[-1]["role"] == "user" and history[-1]["content"] == user_input:
+                history.pop()
+            record_cancelled_generation(getattr(cancel_event, 'reason', None) or 'client', 0)
+            return {"response": "", "mode": mode, "is_automatic": is_automatic, "cancelled": True}
+
+        # Charge the user before prefill; the unused completion budget is refunded below
+        limiter = get_rate_limiter() if rate_limit_key is not None else None
+        if limiter is not None:
+            try:
+                reservation = limiter.reserve(rate_limit_key, prompt_tokens + max_tokens)
+            except RateLimited:
+                # Not answered, so not part of the conversation either
+                history = llama_model.get_conversation_history(chat_session_id)
+                if history and history[-1]["role"] == "user" and history[-1]["content"] == user_input:
+                    history.pop()
+                raise
 
-        # Generate response with context, using more tokens from the larger context window
+        # Generate response with context, using more tokens from the larger context window.
+        # Streaming lets us split the call into prefill (time to first token) and decode.
         print(f"Generating response with prompt length: {len(prompt)} characters")
-        output = llama_model.llm(
-            prompt,
-            max_tokens=2000,    # Increased from 1000 to use more of the available context
-            stop=["<|end_of_turn|>"],
-            echo=False
+        with trace_span("llm_call"), local_generation():
+            generation_start = time.time()
+            first_token_time = None
+            chunks = []
+            decoded = 0
+            cancelled = False
+            # An answer that reaches its budget continues up to the hard limit (and the context window)
+            limit = min(GENERATION_MAX_TOKENS, llama_model.context_size - prompt_tokens)
+            request_tokens = max(1, min(max_tokens, limit))
+            hit_budget = hit_limit = False
+            while True:
+                stream = llama_model.llm(
+                    prompt + "".join(chunks),
+                    max_tokens=request_tokens,
+                    stop=["<|end_of_turn|>"],
+                    echo=False,
+                    stream=True
+                )
+                finish_reason = None
+                try:
+                    for chunk in stream:
+                        if first_token_time is None:
+                            first_token_time = time.time()
+                        choice = chunk["choices"][0]
+                        finish_reason = choice.get("finish_reason")
+                        text = choice["text"]
+                        if text:
+                            decoded += 1
+                            chunks.append(text)
+                            if on_token is not None:
+                                on_token(text)
+                        if cancel_event is not None and cancel_event.is_set():
+                            cancelled = True
+                            break
+                finally:
+                    # Ends llama.cpp's decode loop, freeing the model for the next request
+                    stream.close()
+                if cancelled or finish_reason != "length":
+                    break
+                if decoded >= limit:
+                    hit_limit = True
+                    break
+                # Out of budget but not finished: an unusually long answer, so continue where it
+                # stopped (the prompt is still in the KV cache) with the rest of the hard limit
+                hit_budget = True
+                request_tokens = limit - decoded
+            generation_end = time.time()
+        response = "".join(chunks).strip()
+        print(f"Generated response length: {len(response)} characters{' (cancelled)' if cancelled else ''}")
+
+        first_token_time = first_token_time or generation_end
+        decode_seconds = generation_end - first_token_time
+        completion_tokens = llama_model.count_tokens(response) if response else 0
+        if reservation is not None:
+            reservation.settle(prompt_tokens + completion_tokens)
+        if cancelled:
+            record_cancelled_generation(getattr(cancel_event, 'reason', None) or 'client', completion_tokens)
+        else:
+            # Cancelled answers are cut short, so they would bias the budget down
+            token_budget.record(mode, input_tokens, completion_tokens, hit_cap=hit_budget or hit_limit)
+        if hit_budget:
+            record_max_tokens_hit("budget")
+        if hit_limit:
+            record_max_tokens_hit("limit")
+        record_generation(
+            prompt_tokens,
+            completion_tokens,
+            first_token_time - generation_start,
+            decode_seconds
+        )
+        annotate_trace(
+            max_tokens=max_tokens,
+            completion_tokens=completion_tokens,
+            prefill_ms=(first_token_time - generation_start) * 1000,
+            decode_tokens_per_sec=completion_tokens / decode_seconds if decode_seconds > 0 else 0
         )
-        response = output["choices"][0]["text"].strip()
-        print(f"Generated response length: {len(response)} characters")
 
         # --- Log the RAW response BEFORE formatting ---
         print(f"\n--- RAW AI Response --- \n{response}\n--- END RAW AI Response ---\n")
         # --- End logging ---
 
-        # Add AI response to conversation history
-        llama_model.add_to_history(chat_session_id, "assistant", response, mode)
+        # Add AI response to conversation history (a cancelled one only if it got anywhere)
+        if response or not cancelled:
+            llama_model.add_to_history(chat_session_id, "assistant", response, mode)
+        else:
+            history = llama_model.get_conversation_history(chat_session_id)
+            if history and history[-1]["role"] == "user" and history[-1]["content"] == user_input:
+                history.pop()
 
         # --- REMOVE THE REDUNDANT FORMATTING CALL ---
         # formatted_response = format_math_response(response)
@@ -753,11 +918,16 @@ def generate_response(user_input, chat_session_id="default", model_mode="auto"):
         return {
             "response": response, # Return RAW response from AI
             "mode": mode,
-            "is_automatic": is_automatic
+            "is_automatic": is_automatic,
+            "cancelled": cancelled
         }
+    except RateLimited:
+        raise
     except Exception as e:
         print(f"Error generating response: {str(e)}")
         traceback.print_exc()
+        if reservation is not None:
+            reservation.cancel()
 
         # Fallback response mode - return a simple message without using the model
         fallback_response = {
@@ -831,10 +1001,11 @@ def load_history_from_database(user, chat_session_id):
         if chat_session_id in llama_model.conversation_history:
             del llama_model.conversation_history[chat_session_id]
 
-        # Load history from the database
-        chat_history = Chat.objects.filter(user=user, session_id=chat_session_id).order_by('timestamp')
+        # Load history from the database; each row is one exchange
+        chat_history = Chat.objects.filter(user=user, chat_session=chat_session_id).order_by('created_at')
         for chat in chat_history:
-            llama_model.add_to_history(chat_session_id, chat.role, chat.content, chat.mode)
+            llama_model.add_to_history(chat_session_id, "user", chat.message, chat.model_mode)
+            llama_model.add_to_history(chat_session_id, "assistant", chat.response, chat.model_mode)
 
         return True
     except Exception as e:
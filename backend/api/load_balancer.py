@@ -0,0 +1,232 @@
+"""
+Load-aware Node Selection Module
+
+This module picks inference nodes using live health signals instead of a
+uniform random choice. For every node it tracks:
+
+1. An exponentially weighted moving average (EWMA) of request latency
+2. The number of requests currently in flight
+3. An EWMA of the error rate
+
+Selection uses "power of two choices": two healthy candidates are drawn at
+random and the one with the lower expected cost wins. This spreads load
+almost as well as checking every node while avoiding the herding that comes
+from always sending to the single "best" node.
+
+Each node also has a circuit breaker. After repeated failures the node is
+ejected (open) for a cooldown period, then a single probe request is let
+through (half-open); a successful probe closes the circuit again.
+"""
+
+import random
+import threading
+import time
+from django.conf import settings
+
+# EWMA smoothing factor: weight of the newest sample
+EWMA_ALPHA = getattr(settings, 'LOAD_BALANCER_EWMA_ALPHA', 0.3)
+# Latency assumed for nodes without samples yet (seconds)
+DEFAULT_LATENCY = getattr(settings, 'LOAD_BALANCER_DEFAULT_LATENCY', 1.0)
+# Consecutive failures that open a node's circuit
+FAILURE_THRESHOLD = getattr(settings, 'LOAD_BALANCER_FAILURE_THRESHOLD', 5)
+# Error-rate EWMA above which the circuit opens (with enough samples)
+ERROR_RATE_THRESHOLD = getattr(settings, 'LOAD_BALANCER_ERROR_RATE_THRESHOLD', 0.5)
+# Seconds an open circuit waits before letting a probe through
+OPEN_COOLDOWN = getattr(settings, 'LOAD_BALANCER_OPEN_COOLDOWN', 30)
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
+
+class NodeHealth:
+    """Health signals and circuit state of a single node."""
+
+    __slots__ = ("ewma_latency", "error_rate", "in_flight", "samples",
+                 "consecutive_failures", "state", "opened_at", "probe_in_flight")
+
+    def __init__(self):
+        self.ewma_latency = None
+        self.error_rate = 0.0
+        self.in_flight = 0
+        self.samples = 0
+        self.consecutive_failures = 0
+        self.state = CIRCUIT_CLOSED
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+
+    def to_dict(self):
+        return {
+            'ewma_latency_ms': round(self.ewma_latency * 1000, 2) if self.ewma_latency is not None else None,
+            'error_rate': round(self.error_rate, 4),
+            'in_flight': self.in_flight,
+            'samples': self.samples,
+            'consecutive_failures': self.consecutive_failures,
+            'circuit': self.state,
+        }
+
+
+class LoadBalancer:
+    """
+    Tracks node health and selects nodes with power of two choices.
+
+    Callers report each request with ``start(key)`` before sending it and
+    ``finish(key, latency, success)`` afterwards.
+
+    Args:
+        alpha: EWMA smoothing factor
+        failure_threshold: Consecutive failures that open a circuit
+        error_rate_threshold: Error-rate EWMA that opens a circuit
+        open_cooldown: Seconds before an open circuit is probed
+        clock: Time source (replaceable for simulations)
+        rng: Random generator (replaceable for reproducible simulations)
+    """
+
+    def __init__(self, alpha=EWMA_ALPHA, failure_threshold=FAILURE_THRESHOLD,
+                 error_rate_threshold=ERROR_RATE_THRESHOLD, open_cooldown=OPEN_COOLDOWN,
+                 clock=time.monotonic, rng=None):
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self.error_rate_threshold = error_rate_threshold
+        self.open_cooldown = open_cooldown
+        self.clock = clock
+        self.rng = rng or random.Random()
+        self._health = {}
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        # Called with self._lock held
+        health = self._health.get(key)
+        if health is None:
+            health = self._health[key] = NodeHealth()
+        return health
+
+    def _available(self, health, now):
+        """Return True if the node may receive a request right now."""
+        if health.state == CIRCUIT_CLOSED:
+            return True
+        if health.state == CIRCUIT_OPEN and now - health.opened_at >= self.open_cooldown:
+            health.state = CIRCUIT_HALF_OPEN
+            health.probe_in_flight = False
+        # Half-open nodes take exactly one probe at a time
+        return health.state == CIRCUIT_HALF_OPEN and not health.probe_in_flight
+
+    def _cost(self, health):
+        """Expected cost of sending one more request to a node."""
+        latency = health.ewma_latency if health.ewma_latency is not None else DEFAULT_LATENCY
+        return latency * (health.in_flight + 1) / max(1.0 - health.error_rate, 0.05)
+
+    def choose(self, nodes, key=lambda node: node, count=1):
+        """
+        Pick up to ``count`` distinct nodes.
+
+        Args:
+            nodes: Candidate nodes
+            key: Function mapping a node to its health key
+            count: Number of nodes to return
+
+        Returns:
+            list: Selected nodes, best first; empty if every circuit is open
+        """
+        now = self.clock()
+        with self._lock:
+            candidates = [node for node in nodes if self._available(self._get(key(node)), now)]
+            chosen = []
+            while candidates and len(chosen) < count:
+                if len(candidates) == 1:
+                    pick = candidates[0]
+                else:
+                    first, second = self.rng.sample(candidates, 2)
+                    if self._cost(self._get(key(second))) < self._cost(self._get(key(first))):
+                        pick = second
+                    else:
+                        pick = first
+                candidates.remove(pick)
+                chosen.append(pick)
+                health = self._get(key(pick))
+                if health.state == CIRCUIT_HALF_OPEN:
+                    health.probe_in_flight = True
+        return chosen
+
+    def first_available(self, nodes, key=lambda node: node):
+        """
+        Pick the first node in ``nodes`` whose circuit lets a request through.
+
+        Used for ordered preference lists (e.g. session affinity) where load
+        must not override the order.
+
+        Returns:
+            The node, or None if every circuit is open
+        """
+        now = self.clock()
+        with self._lock:
+            for node in nodes:
+                health = self._get(key(node))
+                if self._available(health, now):
+                    if health.state == CIRCUIT_HALF_OPEN:
+                        health.probe_in_flight = True
+                    return node
+        return None
+
+    def start(self, key):
+        """Record that a request was sent to ``key``."""
+        with self._lock:
+            self._get(key).in_flight += 1
+
+    def release(self, key):
+        """Release a node that was chosen but never sent a request (e.g. a cancelled probe)."""
+        with self._lock:
+            self._get(key).probe_in_flight = False
+
+    def finish(self, key, latency, success):
+        """
+        Record the outcome of a request sent to ``key``.
+
+        Args:
+            key: Node health key
+            latency: Request duration in seconds
+            success: Whether the node returned a valid result
+        """
+        now = self.clock()
+        with self._lock:
+            health = self._get(key)
+            health.in_flight = max(health.in_flight - 1, 0)
+            health.samples += 1
+            alpha = self.alpha
+            health.error_rate = (1 - alpha) * health.error_rate + alpha * (0.0 if success else 1.0)
+
+            if success:
+                if health.ewma_latency is None:
+                    health.ewma_latency = latency
+                else:
+                    health.ewma_latency = (1 - alpha) * health.ewma_latency + alpha * latency
+                health.consecutive_failures = 0
+                if health.state != CIRCUIT_CLOSED:
+                    # Successful probe: put the node back in rotation
+                    health.state = CIRCUIT_CLOSED
+                    health.error_rate = 0.0
+                health.probe_in_flight = False
+                return
+
+            health.consecutive_failures += 1
+            if health.state == CIRCUIT_HALF_OPEN:
+                # Failed probe: back to open for another cooldown
+                health.state = CIRCUIT_OPEN
+                health.opened_at = now
+                health.probe_in_flight = False
+            elif health.state == CIRCUIT_CLOSED and (
+                health.consecutive_failures >= self.failure_threshold
+                or (health.samples >= self.failure_threshold and health.error_rate >= self.error_rate_threshold)
+            ):
+                health.state = CIRCUIT_OPEN
+                health.opened_at = now
+
+    def forget(self, key):
+        """Drop all health state of a node (it left; if it rejoins it starts fresh)."""
+        with self._lock:
+            self._health.pop(key, None)
+
+    def stats(self):
+        """Return the health signals of every known node."""
+        with self._lock:
+            return {key: health.to_dict() for key, health in self._health.items()}
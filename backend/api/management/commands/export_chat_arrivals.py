@@ -0,0 +1,42 @@
+"""
+Export chat request arrivals for the autoscaling simulator.
+
+Writes one ``epoch_seconds,completion_tokens`` line per Chat row, oldest
+first. Completion tokens are estimated from the stored response length
+(about four characters per token).
+
+Usage:
+    python manage.py export_chat_arrivals --since 2024-01-01 > arrivals.csv
+    python benchmarks/autoscaling_sim.py --trace arrivals.csv
+"""
+
+from datetime import datetime, timezone
+
+from django.core.management.base import BaseCommand
+
+from api.models import Chat
+
+
+class Command(BaseCommand):
+    help = "Export Chat.created_at timestamps (and estimated response tokens) as CSV"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help='Only chats created on or after this date (YYYY-MM-DD)')
+        parser.add_argument('--until', help='Only chats created before this date (YYYY-MM-DD)')
+
+    def handle(self, *args, **options):
+        chats = Chat.objects.order_by('created_at')
+        if options['since']:
+            chats = chats.filter(created_at__gte=self._parse_date(options['since']))
+        if options['until']:
+            chats = chats.filter(created_at__lt=self._parse_date(options['until']))
+
+        count = 0
+        for created_at, response in chats.values_list('created_at', 'response').iterator():
+            self.stdout.write(f"{created_at.timestamp():.3f},{len(response or '') // 4 + 1}")
+            count += 1
+        self.stderr.write(f"Exported {count} arrivals")
+
+    @staticmethod
+    def _parse_date(value):
+        return datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=timezone.utc)
@@ -0,0 +1,238 @@
+"""
+OpenMetrics exposition for the LLM service.
+
+This module renders the metrics collected by the monitoring module in the
+OpenMetrics text format so a local Prometheus can scrape the service without
+any AWS dependency.
+
+Counters and histograms come from the shared metrics blob in the Django cache,
+which every worker process merges its deltas into, so with a shared cache
+backend (Redis, Memcached, database) one scrape of any worker reports
+service-wide totals. With a per-process cache (LocMem, the default) each
+worker only sees its own totals, so every series gets a ``pid`` label and
+Prometheus must scrape each worker. Gauges (queue depth, model state, RSS,
+CPU) are always per process and are exported with a ``pid`` label.
+"""
+
+import logging
+import os
+
+from django.conf import settings
+
+from .latency_histogram import LatencyHistogram
+from .monitoring import get_raw_metrics, get_process_gauges
+from .cache_management import get_cache_stats
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+METRIC_PREFIX = "llm"
+
+# Exposition bucket boundaries in seconds; chat generation runs from well
+# under a second (cache hits) to over a minute (long math derivations).
+LATENCY_BUCKETS_SECONDS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+# Per-process gauges published by the workers: name -> (type, help).
+# A gauge whose value is a dict is exported once per key with a ``node`` label.
+PROCESS_GAUGES = {
+    "inference_queue_depth": ("gauge", "Requests waiting in the distributed inference queue"),
+    "inference_node_queue_depth": ("gauge", "Dispatched requests waiting for a concurrency slot on a node"),
+    "inference_node_in_flight": ("gauge", "Requests currently running on a node"),
+    "admission_queue_depth": ("gauge", "Chat requests waiting for a local generation slot"),
+    "admission_in_flight": ("gauge", "Chat requests holding a local generation slot"),
+    "model_loaded": ("gauge", "Whether the LLM is loaded in this worker (1) or not (0)"),
+    "process_resident_memory_bytes": ("gauge", "Resident memory of the worker process"),
+    "process_cpu_seconds_total": ("counter", "CPU time consumed by the worker process"),
+    "system_cpu_percent": ("gauge", "Host CPU utilisation sampled by the worker"),
+    "system_memory_percent": ("gauge", "Host memory utilisation sampled by the worker"),
+}
+
+
+def shared_cache_configured():
+    """Return True if the default cache is shared between worker processes."""
+    backend = settings.CACHES.get("default", {}).get("BACKEND", "")
+    return not backend.endswith(("LocMemCache", "DummyCache"))
+
+
+def _escape(value):
+    """Escape a label value."""
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if value == float("inf"):
+            return "+Inf"
+        return repr(value)
+    return str(value)
+
+
+class _Writer:
+    """Accumulates metric families, emitting each family's metadata once."""
+
+    def __init__(self, base_labels=None):
+        self.lines = []
+        self._declared = set()
+        self.base_labels = base_labels or {}
+
+    def declare(self, name, metric_type, help_text, unit=None):
+        if name in self._declared:
+            return
+        self._declared.add(name)
+        self.lines.append(f"# TYPE {name} {metric_type}")
+        if unit:
+            self.lines.append(f"# UNIT {name} {unit}")
+        self.lines.append(f"# HELP {name} {help_text}")
+
+    def sample(self, name, value, labels=None):
+        if self.base_labels:
+            labels = dict(self.base_labels, **(labels or {}))
+        self.lines.append(f"{name}{_labels(labels)} {_format_value(value)}")
+
+    def histogram(self, name, histogram, labels=None):
+        """Write one histogram, projecting its buckets onto LATENCY_BUCKETS_SECONDS."""
+        labels = dict(labels or {})
+        for bound in LATENCY_BUCKETS_SECONDS:
+            self.sample(f"{name}_bucket", histogram.cumulative_count(bound * 1000),
+                        dict(labels, le=_format_value(float(bound))))
+        self.sample(f"{name}_bucket", histogram.count, dict(labels, le="+Inf"))
+        self.sample(f"{name}_count", histogram.count, labels)
+        self.sample(f"{name}_sum", histogram.total_ms / 1000.0, labels)
+
+    def render(self):
+        return "\n".join(self.lines + ["# EOF"]) + "\n"
+
+
+def _write_request_metrics(writer, metrics):
+    name = f"{METRIC_PREFIX}_requests"
+    writer.declare(name, "counter", "LLM requests handled")
+    writer.sample(f"{name}_total", metrics.get("total_requests", 0))
+
+    name = f"{METRIC_PREFIX}_request_errors"
+    writer.declare(name, "counter", "LLM requests that raised an error")
+    writer.sample(f"{name}_total", metrics.get("errors", 0))
+
+    name = f"{METRIC_PREFIX}_cached_responses"
+    writer.declare(name, "counter", "LLM requests answered from the response cache")
+    writer.sample(f"{name}_total", metrics.get("cached_responses", 0))
+
+    name = f"{METRIC_PREFIX}_lambda_offloaded"
+    writer.declare(name, "counter", "LLM requests offloaded to Lambda")
+    writer.sample(f"{name}_total", metrics.get("lambda_offloaded", 0))
+
+    name = f"{METRIC_PREFIX}_shed_requests"
+    writer.declare(name, "counter", "Chat requests shed by admission control")
+    for reason, count in sorted(metrics.get("shed_requests", {}).items()):
+        writer.sample(f"{name}_total", count, {"reason": reason})
+
+    name = f"{METRIC_PREFIX}_cancelled_generations"
+    writer.declare(name, "counter", "Generations stopped before they finished")
+    for reason, count in sorted(metrics.get("cancelled_generations", {}).items()):
+        writer.sample(f"{name}_total", count, {"reason": reason})
+
+    name = f"{METRIC_PREFIX}_wasted_tokens"
+    writer.declare(name, "counter", "Completion tokens decoded by generations that were stopped")
+    for reason, count in sorted(metrics.get("wasted_tokens", {}).items()):
+        writer.sample(f"{name}_total", count, {"reason": reason})
+
+    name = f"{METRIC_PREFIX}_max_tokens_hits"
+    writer.declare(name, "counter", "Answers that reached their max_tokens (budget: continued, limit: cut off)")
+    for cap, count in sorted(metrics.get("max_tokens_hits", {}).items()):
+        writer.sample(f"{name}_total", count, {"cap": cap})
+
+    name = f"{METRIC_PREFIX}_requests_by_model"
+    writer.declare(name, "counter", "LLM requests per model")
+    for model_name, count in sorted(metrics.get("requests_by_model", {}).items()):
+        writer.sample(f"{name}_total", count, {"model": model_name})
+
+
+def _write_token_metrics(writer, metrics):
+    token_usage = metrics.get("token_usage", {})
+    name = f"{METRIC_PREFIX}_tokens"
+    writer.declare(name, "counter", "Tokens processed; rate() gives token throughput")
+    writer.sample(f"{name}_total", token_usage.get("prompt", 0), {"kind": "prompt"})
+    writer.sample(f"{name}_total", token_usage.get("completion", 0), {"kind": "completion"})
+
+    generation = metrics.get("generation_histograms", {})
+    if "decode_tokens_per_sec" in generation:
+        histogram = LatencyHistogram.from_dict(generation["decode_tokens_per_sec"])
+        name = f"{METRIC_PREFIX}_decode_tokens_per_second"
+        writer.declare(name, "gauge", "Decode throughput of traced requests (percentiles over all requests)")
+        for percentile in (50, 90, 99):
+            writer.sample(name, histogram.percentile(percentile), {"percentile": f"p{percentile}"})
+
+
+def _write_latency_metrics(writer, metrics):
+    name = f"{METRIC_PREFIX}_request_latency_seconds"
+    writer.declare(name, "histogram", "LLM request latency", unit="seconds")
+    for key, encoded in sorted(metrics.get("latency_histograms", {}).items()):
+        histogram = LatencyHistogram.from_dict(encoded)
+        if key == "all":
+            labels = {}
+        else:
+            label, _, value = key.partition(":")
+            labels = {"endpoint" if label == "endpoint" else "model_mode": value}
+        writer.histogram(name, histogram, labels)
+
+    name = f"{METRIC_PREFIX}_stage_latency_seconds"
+    writer.declare(name, "histogram", "Time spent per generation pipeline stage", unit="seconds")
+    for stage, encoded in sorted(metrics.get("stage_histograms", {}).items()):
+        writer.histogram(name, LatencyHistogram.from_dict(encoded), {"stage": stage})
+
+
+def _write_cache_metrics(writer):
+    try:
+        cache_stats = get_cache_stats()
+    except Exception as e:
+        logger.error(f"Error reading cache stats for exposition: {str(e)}")
+        return
+    name = f"{METRIC_PREFIX}_response_cache_hits"
+    writer.declare(name, "counter", "Response cache hits")
+    writer.sample(f"{name}_total", cache_stats.get("cache_hits", 0))
+    name = f"{METRIC_PREFIX}_response_cache_misses"
+    writer.declare(name, "counter", "Response cache misses")
+    writer.sample(f"{name}_total", cache_stats.get("cache_misses", 0))
+    name = f"{METRIC_PREFIX}_response_cache_evictions"
+    writer.declare(name, "counter", "Response cache evictions")
+    writer.sample(f"{name}_total", cache_stats.get("evictions", 0))
+
+
+def _write_process_gauges(writer):
+    gauges_by_pid = get_process_gauges()
+    for gauge, (metric_type, help_text) in PROCESS_GAUGES.items():
+        samples = [(pid, gauges[gauge]) for pid, gauges in sorted(gauges_by_pid.items()) if gauge in gauges]
+        if not samples:
+            continue
+        name = f"{METRIC_PREFIX}_{gauge}"
+        family = name[:-len("_total")] if metric_type == "counter" else name
+        writer.declare(family, metric_type, help_text)
+        for pid, value in samples:
+            if isinstance(value, dict):
+                for node, node_value in sorted(value.items()):
+                    writer.sample(name, node_value, {"pid": pid, "node": node})
+            else:
+                writer.sample(name, value, {"pid": pid})
+
+
+def render_openmetrics():
+    """
+    Render all service metrics in the OpenMetrics text format.
+
+    Returns:
+        str: The exposition body, terminated by ``# EOF``
+    """
+    # Per-process totals must not be mistaken for one service-wide series
+    writer = _Writer() if shared_cache_configured() else _Writer({"pid": os.getpid()})
+    metrics = get_raw_metrics()
+    _write_request_metrics(writer, metrics)
+    _write_token_metrics(writer, metrics)
+    _write_latency_metrics(writer, metrics)
+    _write_cache_metrics(writer)
+    _write_process_gauges(writer)
+    return writer.render()
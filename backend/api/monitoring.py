@@ -10,12 +10,16 @@ import logging
 import psutil
 import json
 import threading
+import atexit
+import os
+import functools
 from django.conf import settings
 from django.core.cache import cache
-import boto3
 from datetime import datetime, timedelta
 from contextlib import contextmanager
-from collections import defaultdict
+
+from .latency_histogram import LatencyHistogram
+from .cloudwatch_publisher import get_cloudwatch_publisher
 
 logger = logging.getLogger(__name__)
 
@@ -26,33 +30,328 @@ METRICS_LOCK_KEY = "llm_metrics_lock"
 CLOUDWATCH_NAMESPACE = "AI/LLMService"
 CLOUDWATCH_REGION = settings.AWS_REGION if hasattr(settings, "AWS_REGION") else "us-east-1"
 
+METRICS_FLUSH_INTERVAL = getattr(settings, "METRICS_FLUSH_INTERVAL", 10)  # seconds
+PROCESS_GAUGES_KEY_PREFIX = "llm_process_gauges:"
+PROCESS_GAUGES_INDEX_KEY = "llm_process_gauges_index"
+PROCESS_GAUGES_TTL = METRICS_FLUSH_INTERVAL * 3  # a dead worker drops out after ~3 missed flushes
+
+# CloudWatch publishing goes through the shared batched publisher
+cloudwatch_enabled = getattr(settings, "CLOUDWATCH_METRICS_ENABLED", False)
+
 # Thread lock for metrics updates
 _metrics_lock = threading.Lock()
 
-# Performance metrics storage
-_performance_metrics = {
-    "total_requests": 0,
-    "total_latency": 0,  # in seconds
-    "cached_responses": 0,
-    "errors": 0,
-    "token_usage": {
-        "prompt": 0,
-        "completion": 0,
-        "total": 0
-    },
-    "requests_by_model": defaultdict(int),
-    "last_reset": datetime.now().isoformat()
-}
+def _empty_metrics():
+    """Return a zeroed metrics structure (used for both totals and deltas)."""
+    return {
+        "total_requests": 0,
+        "total_latency": 0,  # in seconds
+        "cached_responses": 0,
+        "lambda_offloaded": 0,
+        "errors": 0,
+        "token_usage": {
+            "prompt": 0,
+            "completion": 0,
+            "total": 0,
+            "by_model": {}
+        },
+        "requests_by_model": {},
+        # Requests turned away by admission control, by reason
+        "shed_requests": {},
+        # Generations stopped early, and the completion tokens they had decoded, by reason
+        "cancelled_generations": {},
+        "wasted_tokens": {},
+        # Answers that reached their max_tokens: "budget" (adaptive, continued) or "limit" (cut off)
+        "max_tokens_hits": {},
+        # Encoded LatencyHistogram per key: "all", "endpoint:<name>", "mode:<model mode>"
+        "latency_histograms": {},
+        # Encoded LatencyHistogram per generation pipeline stage (ms)
+        "stage_histograms": {},
+        # Encoded histograms of per-request generation values (token counts,
+        # prefill ms, decode tokens/sec, DB ms)
+        "generation_histograms": {},
+    }
 
-# Initialize CloudWatch client if enabled
-cloudwatch_enabled = getattr(settings, "CLOUDWATCH_METRICS_ENABLED", False)
-cloudwatch_client = None
-if cloudwatch_enabled:
-    try:
-        cloudwatch_client = boto3.client("cloudwatch", region_name=CLOUDWATCH_REGION)
-    except Exception as e:
-        logger.error(f"Failed to initialize CloudWatch client: {str(e)}")
-        cloudwatch_enabled = False
+# Counters keyed by reason in the metrics structure
+_REASON_COUNTERS = ("shed_requests", "cancelled_generations", "wasted_tokens", "max_tokens_hits")
+
+# Histogram groups in the metrics structure, merged bucket-wise
+_HISTOGRAM_GROUPS = ("latency_histograms", "stage_histograms", "generation_histograms")
+
+def _merge_metrics(target, delta):
+    """
+    Add the counters in ``delta`` into ``target`` in place.
+
+    Both arguments use the structure returned by ``_empty_metrics``; keys that
+    are missing from ``target`` (e.g. an older blob in the cache) are created.
+    """
+    for key in ("total_requests", "total_latency", "cached_responses", "lambda_offloaded", "errors"):
+        target[key] = target.get(key, 0) + delta.get(key, 0)
+
+    token_usage = target.setdefault("token_usage", {})
+    delta_tokens = delta.get("token_usage", {})
+    for key in ("prompt", "completion", "total"):
+        token_usage[key] = token_usage.get(key, 0) + delta_tokens.get(key, 0)
+    by_model = token_usage.setdefault("by_model", {})
+    for model_name, count in delta_tokens.get("by_model", {}).items():
+        by_model[model_name] = by_model.get(model_name, 0) + count
+
+    requests_by_model = target.setdefault("requests_by_model", {})
+    for model_name, count in delta.get("requests_by_model", {}).items():
+        requests_by_model[model_name] = requests_by_model.get(model_name, 0) + count
+
+    for key in _REASON_COUNTERS:
+        counters = target.setdefault(key, {})
+        for reason, count in delta.get(key, {}).items():
+            counters[reason] = counters.get(reason, 0) + count
+
+    for group in _HISTOGRAM_GROUPS:
+        histograms = target.setdefault(group, {})
+        for key, histogram in delta.get(group, {}).items():
+            merged = LatencyHistogram.from_dict(histograms.get(key))
+            merged.merge(LatencyHistogram.coerce(histogram))
+            histograms[key] = merged.to_dict()
+    return target
+
+def _has_data(metrics):
+    """Return True if a delta holds anything worth writing to the shared store."""
+    return bool(
+        metrics["total_requests"]
+        or metrics["token_usage"]["total"]
+        or any(metrics[key] for key in _REASON_COUNTERS)
+        or any(metrics.get(group) for group in _HISTOGRAM_GROUPS)
+    )
+
+def _histogram_keys(endpoint=None, model_mode=None):
+    """Return the histogram keys a request with these labels is recorded under."""
+    keys = ["all"]
+    if endpoint:
+        keys.append(f"endpoint:{endpoint}")
+    if model_mode:
+        keys.append(f"mode:{model_mode}")
+    return keys
+
+# Point-in-time gauges of this process (queue depth, model state, RSS, ...).
+# Unlike counters they are not summed across workers; each process publishes
+# its own set under PROCESS_GAUGES_KEY_PREFIX + pid.
+_process_gauges = {}
+_process_gauges_lock = threading.Lock()
+
+# Performance metrics storage (shared totals as last seen in the cache)
+_performance_metrics = _empty_metrics()
+_performance_metrics["last_reset"] = datetime.now().isoformat()
+
+class _MetricsShard:
+    """
+    Per-thread metric deltas.
+
+    Each request thread only ever touches its own shard, so the shard lock is
+    uncontended except for the brief moment the flusher drains it.
+    """
+    __slots__ = ("lock", "delta", "thread")
+
+    def __init__(self, thread):
+        self.lock = threading.Lock()
+        self.delta = _empty_metrics()
+        self.thread = thread
+
+    def drain(self):
+        """Swap out the accumulated delta and return it."""
+        with self.lock:
+            delta, self.delta = self.delta, _empty_metrics()
+        return delta
+
+class MetricsAggregator:
+    """
+    In-process metrics aggregator.
+
+    Recording a request only bumps counters in a thread-local shard. A single
+    background flusher thread periodically drains every shard and merges the
+    combined delta into the shared cache blob, so the cache lock is taken once
+    per flush interval per process instead of once per request.
+    """
+
+    def __init__(self, flush_interval=METRICS_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()
+        # Delta that was drained but could not be written (e.g. lock timeout);
+        # it is retried on the next flush rather than dropped.
+        self._unflushed = _empty_metrics()
+        self._flush_lock = threading.Lock()
+        self._flusher = None
+        self._stop_event = threading.Event()
+        self._last_flush = time.time()
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = _MetricsShard(threading.current_thread())
+            with self._shards_lock:
+                self._shards.append(shard)
+            self._local.shard = shard
+            self._ensure_flusher()
+        return shard
+
+    def _ensure_flusher(self):
+        if self._flusher is not None and self._flusher.is_alive():
+            return
+        with self._shards_lock:
+            if self._flusher is None or not self._flusher.is_alive():
+                self._flusher = threading.Thread(
+                    target=self._flush_loop, name="metrics-flusher", daemon=True
+                )
+                self._flusher.start()
+
+    def record_request(self, latency, model_name=None, is_cached=False, offloaded=False, error_occurred=False,
+                       endpoint=None, model_mode=None):
+        """Record a single measured operation in the calling thread's shard."""
+        latency_ms = latency * 1000
+        shard = self._shard()
+        with shard.lock:
+            delta = shard.delta
+            delta["total_requests"] += 1
+            delta["total_latency"] += latency
+            histograms = delta["latency_histograms"]
+            for key in _histogram_keys(endpoint, model_mode):
+                histogram = histograms.get(key)
+                if histogram is None:
+                    histogram = histograms[key] = LatencyHistogram()
+                histogram.record(latency_ms)
+            if is_cached:
+                delta["cached_responses"] += 1
+            if offloaded:
+                delta["lambda_offloaded"] += 1
+            if error_occurred:
+                delta["errors"] += 1
+            if model_name:
+                delta["requests_by_model"][model_name] = delta["requests_by_model"].get(model_name, 0) + 1
+        if cloudwatch_enabled:
+            _push_metrics_to_cloudwatch(latency, model_name, is_cached, offloaded, error_occurred)
+
+    def record_tokens(self, prompt_tokens=0, completion_tokens=0, model_name=None):
+        """Record token usage in the calling thread's shard."""
+        total = prompt_tokens + completion_tokens
+        shard = self._shard()
+        with shard.lock:
+            token_usage = shard.delta["token_usage"]
+            token_usage["prompt"] += prompt_tokens
+            token_usage["completion"] += completion_tokens
+            token_usage["total"] += total
+            if model_name:
+                token_usage["by_model"][model_name] = token_usage["by_model"].get(model_name, 0) + total
+        if cloudwatch_enabled:
+            _push_token_usage_to_cloudwatch(total, model_name)
+
+    def record_shed(self, reason):
+        """Count a request shed by admission control in the calling thread's shard."""
+        shard = self._shard()
+        with shard.lock:
+            shed_requests = shard.delta["shed_requests"]
+            shed_requests[reason] = shed_requests.get(reason, 0) + 1
+
+    def record_cancellation(self, reason, wasted_tokens):
+        """Count a cancelled generation and its decoded tokens in the calling thread's shard."""
+        shard = self._shard()
+        with shard.lock:
+            cancelled = shard.delta["cancelled_generations"]
+            cancelled[reason] = cancelled.get(reason, 0) + 1
+            wasted = shard.delta["wasted_tokens"]
+            wasted[reason] = wasted.get(reason, 0) + wasted_tokens
+
+    def record_max_tokens_hit(self, cap):
+        """Count an answer that reached its max_tokens in the calling thread's shard."""
+        shard = self._shard()
+        with shard.lock:
+            hits = shard.delta["max_tokens_hits"]
+            hits[cap] = hits.get(cap, 0) + 1
+
+    def record_trace(self, trace):
+        """Record the stage timings and generation values of a finished request trace."""
+        values = trace.generation_values()
+        shard = self._shard()
+        with shard.lock:
+            for group, samples in (("stage_histograms", trace.stages), ("generation_histograms", values)):
+                histograms = shard.delta[group]
+                for key, value in samples.items():
+                    histogram = histograms.get(key)
+                    if histogram is None:
+                        histogram = histograms[key] = LatencyHistogram()
+                    histogram.record(value)
+        prompt_tokens = int(values.get("prompt_tokens", 0))
+        completion_tokens = int(values.get("completion_tokens", 0))
+        if prompt_tokens or completion_tokens:
+            self.record_tokens(prompt_tokens, completion_tokens, trace.model_name)
+
+    def _drain_shards(self):
+        """Drain all shards, dropping those whose thread has exited."""
+        combined = _empty_metrics()
+        with self._shards_lock:
+            shards = list(self._shards)
+        for shard in shards:
+            _merge_metrics(combined, shard.drain())
+        with self._shards_lock:
+            self._shards = [s for s in self._shards if s.thread.is_alive()]
+        return combined
+
+    def pending(self):
+        """Return the not-yet-flushed delta of this process without draining it."""
+        combined = _empty_metrics()
+        with self._shards_lock:
+            shards = list(self._shards)
+        for shard in shards:
+            with shard.lock:
+                _merge_metrics(combined, shard.delta)
+        with self._flush_lock:
+            _merge_metrics(combined, self._unflushed)
+        return combined
+
+    def discard(self):
+        """Throw away any pending deltas (used when metrics are reset)."""
+        self._drain_shards()
+        with self._flush_lock:
+            self._unflushed = _empty_metrics()
+
+    def flush(self):
+        """Merge all pending deltas into the shared cache blob."""
+        delta = self._drain_shards()
+        now = time.time()
+        interval, self._last_flush = now - self._last_flush, now
+        if cloudwatch_enabled:
+            _push_scaling_signals_to_cloudwatch(delta, interval)
+
+        with self._flush_lock:
+            _merge_metrics(self._unflushed, delta)
+            if _has_data(self._unflushed):
+                if _acquire_metrics_lock(timeout=1):
+                    try:
+                        with _metrics_lock:
+                            _load_metrics_from_cache()
+                            merged = _merge_metrics(json.loads(json.dumps(_performance_metrics)), self._unflushed)
+                            # Written directly so a failed write keeps the delta for the next flush
+                            cache.set(METRICS_CACHE_KEY, json.dumps(merged), METRICS_CACHE_TTL)
+                            _performance_metrics.clear()
+                            _performance_metrics.update(merged)
+                        self._unflushed = _empty_metrics()
+                    except Exception as e:
+                        logger.error(f"Error flushing metrics: {str(e)}")
+                    finally:
+                        _release_metrics_lock()
+                else:
+                    logger.warning("Could not acquire metrics lock, deferring flush")
+
+        _publish_process_gauges()
+
+    def _flush_loop(self):
+        while not self._stop_event.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error in metrics flusher: {str(e)}")
+
+_aggregator = MetricsAggregator()
+atexit.register(_aggregator.flush)
 
 def get_system_metrics():
     """
@@ -122,7 +421,7 @@ def _release_metrics_lock():
     cache.delete(METRICS_LOCK_KEY)
 
 @contextmanager
-def record_latency(model_name=None, is_cached=False, offloaded=False):
+def record_latency(model_name=None, is_cached=False, offloaded=False, endpoint=None, model_mode=None):
     """
     Context manager to record latency for an LLM operation.
     
@@ -130,83 +429,282 @@ def record_latency(model_name=None, is_cached=False, offloaded=False):
         model_name: Name of the LLM model being used
         is_cached: Whether the response is from cache
         offloaded: Whether the request was offloaded to Lambda
+        endpoint: Name of the API endpoint, used to key the latency histogram
+        model_mode: Model mode ("Math Correct" / "GPT4 Correct"), used to key
+            the latency histogram
         
     Yields:
-        None
+        dict: Labels for this measurement; the caller may fill in
+        ``model_mode`` (or other labels) once they are known
     """
+    labels = {"endpoint": endpoint, "model_mode": model_mode}
     start_time = time.time()
     error_occurred = False
     
     try:
-        yield
+        yield labels
     except Exception:
         error_occurred = True
         raise
     finally:
         latency = time.time() - start_time
-        threading.Thread(
-            target=_update_metrics,
-            args=(latency, model_name, is_cached, offloaded, error_occurred),
-            daemon=True
-        ).start()
+        _aggregator.record_request(
+            latency, model_name, is_cached, offloaded, error_occurred,
+            endpoint=labels.get("endpoint"), model_mode=labels.get("model_mode")
+        )
 
-def _update_metrics(latency, model_name, is_cached, offloaded, error_occurred):
+class RequestTrace:
     """
-    Update metrics with information from a request.
+    Timing breakdown of a single request through the generation pipeline.
+
+    Stage durations (ms) are accumulated by ``trace_span``; per-request values
+    such as token counts are attached with ``annotate_trace``.
+    """
+
+    def __init__(self, endpoint=None, model_name=None):
+        self.endpoint = endpoint
+        self.model_name = model_name
+        self.stages = {}
+        self.values = {}
+        self.start_time = time.time()
+
+    def add_stage(self, name, duration_ms):
+        self.stages[name] = self.stages.get(name, 0.0) + duration_ms
+
+    def generation_values(self):
+        """Return the recorded values plus DB time summed over ``db_*`` stages."""
+        values = dict(self.values)
+        db_ms = sum(ms for name, ms in self.stages.items() if name.startswith("db_"))
+        if db_ms:
+            values["db_ms"] = db_ms
+        return values
+
+_trace_local = threading.local()
+
+def get_current_trace():
+    """Return the request trace active on this thread, or None."""
+    return getattr(_trace_local, "trace", None)
+
+@contextmanager
+def request_trace(endpoint=None, model_name=None):
+    """
+    Context manager that collects a stage breakdown for one request.
+    
+    Spans opened on the same thread while the trace is active are attributed
+    to it. When the trace ends its stages and values are recorded in the
+    aggregator together with a "total" stage.
     
     Args:
-        latency: Request latency in seconds
-        model_name: Name of the LLM model
-        is_cached: Whether the response was from cache
-        offloaded: Whether the request was offloaded
-        error_occurred: Whether an error occurred
+        endpoint: Name of the API endpoint being traced
+        model_name: Name of the LLM model, used for token accounting
+        
+    Yields:
+        RequestTrace: The active trace
     """
-    # Try to acquire lock for updating metrics
-    if not _acquire_metrics_lock():
-        logger.warning("Could not acquire metrics lock, skipping update")
+    parent = get_current_trace()
+    if parent is not None:
+        # Nested call (e.g. a view calling another traced helper): reuse the outer trace
+        yield parent
         return
 
+    trace = RequestTrace(endpoint, model_name)
+    _trace_local.trace = trace
     try:
-        # Load latest metrics
-        _load_metrics_from_cache()
-        
-        # Update counters
-        _performance_metrics["total_requests"] += 1
-        _performance_metrics["total_latency"] += latency
-        
-        if is_cached:
-            _performance_metrics["cached_responses"] += 1
-        
-        if offloaded:
-            _performance_metrics["lambda_offloaded"] += 1
-            
-        if error_occurred:
-            _performance_metrics["errors"] += 1
-            
-        # Update token usage
-        _performance_metrics["token_usage"]["prompt"] += 0  # Assuming no prompt tokens for now
-        _performance_metrics["token_usage"]["completion"] += 0  # Assuming no completion tokens for now
-        _performance_metrics["token_usage"]["total"] += 0  # Assuming no total tokens for now
-        
-        # Update model-specific stats
-        if model_name:
-            _performance_metrics["requests_by_model"][model_name] += 1
-        
-        # Save updated metrics to cache
-        _save_metrics_to_cache()
-        
-        # Submit to CloudWatch if enabled
-        if cloudwatch_enabled and cloudwatch_client:
-            _push_metrics_to_cloudwatch(latency, model_name, is_cached, offloaded, error_occurred)
-            
-    except Exception as e:
-        logger.error(f"Error updating metrics: {str(e)}")
+        yield trace
     finally:
-        _release_metrics_lock()
+        _trace_local.trace = None
+        trace.add_stage("total", (time.time() - trace.start_time) * 1000)
+        try:
+            _aggregator.record_trace(trace)
+        except Exception as e:
+            logger.error(f"Error recording request trace: {str(e)}")
+
+def traced_request(endpoint):
+    """Decorator form of ``request_trace`` for view methods and functions."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with request_trace(endpoint=endpoint):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+@contextmanager
+def trace_span(name):
+    """
+    Time a pipeline stage of the current request trace.
+    
+    This is a no-op (apart from one thread-local lookup) when no trace is
+    active, so it is safe to use in code that also runs outside requests.
+    
+    Args:
+        name: Stage name; stages starting with ``db_`` count towards DB time
+    """
+    trace = get_current_trace()
+    if trace is None:
+        yield
+        return
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        trace.add_stage(name, (time.time() - start_time) * 1000)
+
+def annotate_trace(**values):
+    """
+    Attach per-request values (e.g. ``prompt_tokens=..., prefill_ms=...``)
+    to the current request trace, if any.
+    """
+    trace = get_current_trace()
+    if trace is not None:
+        trace.values.update(values)
+
+# Smoothed local generation performance, used to predict how long a new
+# request would take on this worker (e.g. for offload decisions)
+GENERATION_RATE_ALPHA = 0.2
+_generation_rates = {
+    "samples": 0,
+    "prefill_tokens_per_sec": None,
+    "decode_tokens_per_sec": None,
+    "completion_tokens": None,
+    "generation_seconds": None,
+}
+_local_generations = 0
+_generation_lock = threading.Lock()
+
+def _ewma(previous, value, alpha=GENERATION_RATE_ALPHA):
+    return value if previous is None else (1 - alpha) * previous + alpha * value
+
+def record_generation(prompt_tokens, completion_tokens, prefill_seconds, decode_seconds):
+    """
+    Record one local generation in the smoothed rate estimates.
+    
+    Args:
+        prompt_tokens: Tokens in the prompt
+        completion_tokens: Tokens generated
+        prefill_seconds: Time to the first token
+        decode_seconds: Time from the first to the last token
+    """
+    with _generation_lock:
+        rates = _generation_rates
+        rates["samples"] += 1
+        if prompt_tokens and prefill_seconds > 0:
+            rates["prefill_tokens_per_sec"] = _ewma(rates["prefill_tokens_per_sec"], prompt_tokens / prefill_seconds)
+        if completion_tokens and decode_seconds > 0:
+            rates["decode_tokens_per_sec"] = _ewma(rates["decode_tokens_per_sec"], completion_tokens / decode_seconds)
+        rates["completion_tokens"] = _ewma(rates["completion_tokens"], completion_tokens)
+        rates["generation_seconds"] = _ewma(rates["generation_seconds"], prefill_seconds + decode_seconds)
+
+def get_generation_rates():
+    """
+    Get the smoothed local generation rates of this process.
+    
+    Returns:
+        dict: samples, prefill/decode tokens per second, mean completion
+        tokens, mean generation seconds (rates are None until measured), and
+        the number of generations currently running
+    """
+    with _generation_lock:
+        rates = dict(_generation_rates)
+        rates["in_flight"] = _local_generations
+    return rates
+
+@contextmanager
+def local_generation():
+    """Count a local model generation as in flight for the duration of the block."""
+    global _local_generations
+    with _generation_lock:
+        _local_generations += 1
+        in_flight = _local_generations
+    set_gauge("local_generations_in_flight", in_flight)
+    try:
+        yield
+    finally:
+        with _generation_lock:
+            _local_generations -= 1
+            in_flight = _local_generations
+        set_gauge("local_generations_in_flight", in_flight)
+
+def set_gauge(name, value):
+    """
+    Set a point-in-time gauge for this worker process.
+    
+    Gauges are published to the shared cache on every flush so the metrics
+    endpoint can report them for all live workers.
+    
+    Args:
+        name: Gauge name (e.g. "inference_queue_depth")
+        value: Current numeric value
+    """
+    with _process_gauges_lock:
+        _process_gauges[name] = value
+    _aggregator._ensure_flusher()
+
+def _publish_process_gauges():
+    """Write this process's gauges to the shared cache and register its pid."""
+    with _process_gauges_lock:
+        gauges = dict(_process_gauges)
+    if not gauges:
+        return
+    pid = os.getpid()
+    try:
+        cache.set(f"{PROCESS_GAUGES_KEY_PREFIX}{pid}", json.dumps(gauges), PROCESS_GAUGES_TTL)
+        index = cache.get(PROCESS_GAUGES_INDEX_KEY) or []
+        if pid not in index:
+            # Index updates are rare (once per worker), so a best-effort
+            # read-modify-write is enough; stale pids are pruned on read.
+            cache.set(PROCESS_GAUGES_INDEX_KEY, index + [pid], None)
+    except Exception as e:
+        logger.error(f"Failed to publish process gauges: {str(e)}")
+
+def get_process_gauges():
+    """
+    Get the latest gauges of every live worker process.
+    
+    Returns:
+        dict: Mapping of pid to a dict of gauge values
+    """
+    result = {}
+    try:
+        index = cache.get(PROCESS_GAUGES_INDEX_KEY) or []
+        keys = {f"{PROCESS_GAUGES_KEY_PREFIX}{pid}": pid for pid in index}
+        found = cache.get_many(list(keys)) if keys else {}
+        for key, encoded in found.items():
+            result[keys[key]] = json.loads(encoded)
+        live = [pid for pid in index if f"{PROCESS_GAUGES_KEY_PREFIX}{pid}" in found]
+        if len(live) != len(index):
+            cache.set(PROCESS_GAUGES_INDEX_KEY, live, None)
+    except Exception as e:
+        logger.error(f"Failed to load process gauges: {str(e)}")
+
+    # Always report this process's current values, even before its first flush
+    with _process_gauges_lock:
+        if _process_gauges:
+            result[os.getpid()] = dict(_process_gauges)
+    return result
+
+def _cloudwatch_dimensions(model_name=None):
+    """Build the standard CloudWatch dimensions for service metrics."""
+    dimensions = [
+        {
+            'Name': 'Environment',
+            'Value': getattr(settings, 'ENVIRONMENT', 'development')
+        }
+    ]
+    
+    if model_name:
+        dimensions.append({
+            'Name': 'Model',
+            'Value': model_name
+        })
+    return dimensions
 
 def _push_metrics_to_cloudwatch(latency, model_name, is_cached, offloaded, error_occurred):
     """
-    Push metrics to CloudWatch.
+    Queue request metrics for CloudWatch.
+    
+    Samples are aggregated into statistic sets by the shared publisher and
+    sent in batches on its timer, never on the request thread.
     
     Args:
         latency: Request latency in seconds
@@ -216,160 +714,191 @@ def _push_metrics_to_cloudwatch(latency, model_name, is_cached, offloaded, error
         error_occurred: Whether an error occurred
     """
     try:
-        dimensions = [
-            {
-                'Name': 'Environment',
-                'Value': settings.ENVIRONMENT
-            }
-        ]
+        publisher = get_cloudwatch_publisher()
+        dimensions = _cloudwatch_dimensions(model_name)
         
-        if model_name:
-            dimensions.append({
-                'Name': 'Model',
-                'Value': model_name
-            })
-            
-        metrics_data = [
-            {
-                'MetricName': 'Latency',
-                'Dimensions': dimensions,
-                'Value': latency,
-                'Unit': 'Seconds'
-            },
-            {
-                'MetricName': 'RequestCount',
-                'Dimensions': dimensions,
-                'Value': 1,
-                'Unit': 'Count'
-            }
-        ]
+        publisher.put(CLOUDWATCH_NAMESPACE, 'Latency', latency, 'Seconds', dimensions)
+        publisher.put(CLOUDWATCH_NAMESPACE, 'RequestCount', 1, 'Count', dimensions)
         
         # Add cache metrics
         if is_cached:
-            metrics_data.append({
-                'MetricName': 'CacheHit',
-                'Dimensions': dimensions,
-                'Value': 1,
-                'Unit': 'Count'
-            })
+            publisher.put(CLOUDWATCH_NAMESPACE, 'CacheHit', 1, 'Count', dimensions)
             
         # Add offload metrics
         if offloaded:
-            metrics_data.append({
-                'MetricName': 'LambdaOffloaded',
-                'Dimensions': dimensions,
-                'Value': 1,
-                'Unit': 'Count'
-            })
+            publisher.put(CLOUDWATCH_NAMESPACE, 'LambdaOffloaded', 1, 'Count', dimensions)
             
         # Add error metrics
         if error_occurred:
-            metrics_data.append({
-                'MetricName': 'Error',
-                'Dimensions': dimensions,
-                'Value': 1,
-                'Unit': 'Count'
-            })
-            
-        # Push metrics
-        cloudwatch_client.put_metric_data(
-            Namespace=CLOUDWATCH_NAMESPACE,
-            MetricData=metrics_data
+            publisher.put(CLOUDWATCH_NAMESPACE, 'Error', 1, 'Count', dimensions)
+        
+    except Exception as e:
+        logger.error(f"Error queueing metrics for CloudWatch: {str(e)}")
+
+def _push_token_usage_to_cloudwatch(tokens_used, model_name):
+    """
+    Queue token usage for CloudWatch.
+    
+    Args:
+        tokens_used: Number of tokens used in request
+        model_name: Name of the LLM model
+    """
+    try:
+        get_cloudwatch_publisher().put(
+            CLOUDWATCH_NAMESPACE, 'TokenUsage', tokens_used, 'Count', _cloudwatch_dimensions(model_name)
         )
+    except Exception as e:
+        logger.error(f"Error queueing token usage for CloudWatch: {str(e)}")
+
+def _push_scaling_signals_to_cloudwatch(delta, interval):
+    """
+    Queue this process's autoscaling signals for CloudWatch.
+    
+    Called on every metrics flush with the delta drained since the previous
+    one. AWSScalingManager averages QueueDepth and TokensPerSecond over the
+    fleet and takes the maximum LatencyP95 (percentiles cannot be rebuilt
+    from the aggregated statistic sets, so each process reports its own).
+    
+    Args:
+        delta: Metrics drained in this interval (``_empty_metrics`` structure)
+        interval: Seconds since the previous flush
+    """
+    try:
+        publisher = get_cloudwatch_publisher()
+        dimensions = _cloudwatch_dimensions()
+        with _process_gauges_lock:
+            queued = _process_gauges.get("inference_queue_depth", 0) + _process_gauges.get("admission_queue_depth", 0)
+        with _generation_lock:
+            running = _local_generations
+        publisher.put(CLOUDWATCH_NAMESPACE, 'QueueDepth', queued + running, 'Count', dimensions)
+        
+        if interval > 0:
+            tokens_per_sec = delta["token_usage"]["completion"] / interval
+            publisher.put(CLOUDWATCH_NAMESPACE, 'TokensPerSecond', tokens_per_sec, 'Count/Second', dimensions)
         
+        latency = LatencyHistogram.coerce(delta["latency_histograms"].get("all"))
+        if latency.count:
+            publisher.put(CLOUDWATCH_NAMESPACE, 'LatencyP95', latency.percentile(95) / 1000.0, 'Seconds', dimensions)
     except Exception as e:
-        logger.error(f"Error pushing metrics to CloudWatch: {str(e)}")
+        logger.error(f"Error queueing scaling signals for CloudWatch: {str(e)}")
+
+def flush_metrics():
+    """
+    Flush this process's pending metric deltas to the shared cache now.
+    
+    The background flusher does this every ``METRICS_FLUSH_INTERVAL`` seconds;
+    call this explicitly when fresher numbers are needed (e.g. in tests).
+    """
+    _aggregator.flush()
+
+def get_raw_metrics():
+    """
+    Get the merged metrics with latency histograms still encoded.
+    
+    Combines the shared totals from the cache (all workers) with this
+    process's unflushed deltas. Used by exporters that need bucket data.
+    
+    Returns:
+        dict: Metrics in the structure of ``_empty_metrics`` plus ``last_reset``
+    """
+    with _metrics_lock:
+        _load_metrics_from_cache()
+        metrics_copy = json.loads(json.dumps(_performance_metrics))
+    return _merge_metrics(metrics_copy, _aggregator.pending())
 
 def get_performance_metrics():
     """
     Get a copy of the current performance metrics.
     
+    The result combines the shared totals from the cache (all workers) with
+    this process's deltas that have not been flushed yet. Latency histograms
+    are reported as ``latency_percentiles`` (count, mean and p50/p90/p99/max
+    in milliseconds) keyed by "all", "endpoint:<name>" and "mode:<model mode>".
+    The per-stage breakdown of traced requests is reported under ``pipeline``.
+    When CloudWatch is enabled, this process's publisher counters are
+    included under ``cloudwatch_publisher``.
+    
     Returns:
         dict: Current performance metrics
     """
-    with _metrics_lock:
-        # Convert defaultdict to regular dict for serialization
-        metrics_copy = _performance_metrics.copy()
-        metrics_copy["requests_by_model"] = dict(metrics_copy["requests_by_model"])
-        return metrics_copy
+    metrics_copy = get_raw_metrics()
+
+    # Replace the encoded histograms with their percentile summaries
+    histograms = metrics_copy.pop("latency_histograms", {})
+    metrics_copy["latency_percentiles"] = {
+        key: LatencyHistogram.from_dict(encoded).summary()
+        for key, encoded in sorted(histograms.items())
+    }
+    stage_histograms = metrics_copy.pop("stage_histograms", {})
+    generation_histograms = metrics_copy.pop("generation_histograms", {})
+    metrics_copy["pipeline"] = {
+        "stages": {
+            key: LatencyHistogram.from_dict(encoded).summary()
+            for key, encoded in sorted(stage_histograms.items())
+        },
+        "generation": {
+            key: LatencyHistogram.from_dict(encoded).summary(suffix="_ms" if key.endswith("_ms") else "")
+            for key, encoded in sorted(generation_histograms.items())
+        },
+    }
+    if cloudwatch_enabled:
+        # Per-process publisher counters (dropped samples, failed datums, ...)
+        metrics_copy["cloudwatch_publisher"] = get_cloudwatch_publisher().get_stats()
+    return metrics_copy
 
 def reset_metrics():
     """
     Reset all performance metrics to their initial values.
     """
+    global _performance_metrics
+    _aggregator.discard()
     with _metrics_lock:
-        _performance_metrics["total_requests"] = 0
-        _performance_metrics["total_latency"] = 0
-        _performance_metrics["cached_responses"] = 0
-        _performance_metrics["errors"] = 0
-        _performance_metrics["token_usage"] = {
-            "prompt": 0,
-            "completion": 0,
-            "total": 0
-        }
-        _performance_metrics["requests_by_model"] = defaultdict(int)
+        _performance_metrics = _empty_metrics()
         _performance_metrics["last_reset"] = datetime.now().isoformat()
+        _save_metrics_to_cache()
     
     logger.info("Performance metrics have been reset")
 
-def track_token_usage(tokens_used, model_name=None):
+def track_token_usage(tokens_used, model_name=None, prompt_tokens=None):
     """
     Track token usage for billing and monitoring.
     
     Args:
         tokens_used: Number of tokens used in request
         model_name: Name of the LLM model
+        prompt_tokens: Optional number of ``tokens_used`` that were prompt tokens
     """
-    if not _acquire_metrics_lock():
-        logger.warning("Could not acquire metrics lock for token tracking")
-        return
-        
-    try:
-        _load_metrics_from_cache()
-        
-        # Update total token usage
-        _performance_metrics["token_usage"]["total"] += tokens_used
-        
-        # Update model-specific token usage if needed
-        if model_name and hasattr(_performance_metrics["token_usage"], "by_model"):
-            if model_name not in _performance_metrics["token_usage"]["by_model"]:
-                _performance_metrics["token_usage"]["by_model"][model_name] = tokens_used
-            else:
-                _performance_metrics["token_usage"]["by_model"][model_name] += tokens_used
-                
-        _save_metrics_to_cache()
-        
-        # Push to CloudWatch if enabled
-        if cloudwatch_enabled and cloudwatch_client:
-            dimensions = [
-                {
-                    'Name': 'Environment',
-                    'Value': settings.ENVIRONMENT
-                }
-            ]
-            
-            if model_name:
-                dimensions.append({
-                    'Name': 'Model',
-                    'Value': model_name
-                })
-                
-            cloudwatch_client.put_metric_data(
-                Namespace=CLOUDWATCH_NAMESPACE,
-                MetricData=[
-                    {
-                        'MetricName': 'TokenUsage',
-                        'Dimensions': dimensions,
-                        'Value': tokens_used,
-                        'Unit': 'Count'
-                    }
-                ]
-            )
-            
-    except Exception as e:
-        logger.error(f"Error tracking token usage: {str(e)}")
-    finally:
-        _release_metrics_lock()
+    prompt = prompt_tokens or 0
+    _aggregator.record_tokens(prompt, max(tokens_used - prompt, 0), model_name)
+
+def record_shed_request(reason):
+    """
+    Count a request turned away by admission control.
+    
+    Args:
+        reason: Why it was shed (e.g. "queue_full", "user_limit")
+    """
+    _aggregator.record_shed(reason)
+
+def record_cancelled_generation(reason, wasted_tokens):
+    """
+    Count a generation stopped before it finished.
+    
+    Args:
+        reason: Why it was stopped (e.g. "disconnect", "deadline", "client")
+        wasted_tokens: Completion tokens it had decoded by then
+    """
+    _aggregator.record_cancellation(reason, wasted_tokens)
+
+def record_max_tokens_hit(cap):
+    """
+    Count an answer that reached its max_tokens.
+    
+    Args:
+        cap: "budget" for the adaptive budget (the answer is continued),
+            "limit" for the hard limit (the answer is cut off)
+    """
+    _aggregator.record_max_tokens_hit(cap)
 
 class LatencyMonitor:
     """Context manager for measuring and logging request latency."""
@@ -413,11 +942,6 @@ class LatencyMonitor:
             self.is_error = True
         
         latency = time.time() - self.start_time
-        log_request(
-            model=self.model,
-            latency=latency,
-            tokens_prompt=self.tokens_prompt,
-            tokens_completion=self.tokens_completion,
-            is_cached=self.is_cached,
-            is_error=self.is_error
-        ) 
\ No newline at end of file
+        _aggregator.record_request(latency, self.model, self.is_cached, False, self.is_error)
+        if self.tokens_prompt or self.tokens_completion:
+            _aggregator.record_tokens(self.tokens_prompt, self.tokens_completion, self.model)
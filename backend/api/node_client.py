@@ -0,0 +1,226 @@
+"""
+Pooled HTTP Client for Inference Nodes
+
+This module provides the shared HTTP client used to call peer inference
+nodes. It keeps one keep-alive connection pool per host (urllib3
+PoolManager), so consecutive requests to a node reuse an open TCP
+connection instead of paying a new handshake each time.
+
+Timeouts are split into a short connect timeout (a dead node is detected
+quickly) and a longer read timeout (generation can legitimately take a
+while). Failed calls are retried a bounded number of times with full-jitter
+exponential backoff, but only when a retry cannot duplicate work:
+
+1. Connection failures (the request never reached the node)
+2. 429/503 responses (the node shed the request before processing it)
+3. Read errors and 502/504 responses, for requests marked idempotent
+"""
+
+import json
+import random
+import threading
+import time
+
+import urllib3
+from urllib3.exceptions import (
+    ConnectTimeoutError,
+    HTTPError,
+    MaxRetryError,
+    NewConnectionError,
+    ProtocolError,
+    ReadTimeoutError,
+)
+from django.conf import settings
+
+CONNECT_TIMEOUT = getattr(settings, 'NODE_HTTP_CONNECT_TIMEOUT', 2.0)  # seconds
+READ_TIMEOUT = getattr(settings, 'NODE_HTTP_READ_TIMEOUT', 60.0)  # seconds
+MAX_RETRIES = getattr(settings, 'NODE_HTTP_MAX_RETRIES', 2)
+BACKOFF_BASE = getattr(settings, 'NODE_HTTP_BACKOFF_BASE', 0.1)  # seconds
+BACKOFF_MAX = getattr(settings, 'NODE_HTTP_BACKOFF_MAX', 2.0)  # seconds
+# Distinct hosts kept in the pool manager, and idle connections kept per host
+NUM_POOLS = getattr(settings, 'NODE_HTTP_NUM_POOLS', 32)
+POOL_MAXSIZE = getattr(settings, 'NODE_HTTP_POOL_MAXSIZE', 8)
+
+# Shared secret sent to peers' /api/inference/ endpoint
+NODE_AUTH_TOKEN = getattr(settings, 'INFERENCE_NODE_TOKEN', None)
+
+# Responses that mean the node did not process the request
+SHED_STATUSES = (429, 503)
+# Responses worth retrying only when repeating the request is harmless
+IDEMPOTENT_RETRY_STATUSES = (502, 504)
+
+
+def _is_connect_failure(error):
+    """Return True if the request never reached the server."""
+    if isinstance(error, MaxRetryError):
+        error = error.reason
+    return isinstance(error, (NewConnectionError, ConnectTimeoutError))
+
+
+class NodeHTTPClient:
+    """
+    Keep-alive HTTP client with per-host pools, split timeouts and jittered retries.
+
+    Args:
+        connect_timeout: Seconds to establish a connection
+        read_timeout: Seconds to wait for response data
+        max_retries: Retries after the first attempt
+        num_pools: Number of per-host pools kept
+        pool_maxsize: Connections kept alive per host
+    """
+
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, max_retries=MAX_RETRIES,
+                 num_pools=NUM_POOLS, pool_maxsize=POOL_MAXSIZE):
+        self.timeout = urllib3.Timeout(connect=connect_timeout, read=read_timeout)
+        self.max_retries = max_retries
+        # block=False: under a burst, open extra (non-pooled) connections
+        # rather than queueing callers behind the pool
+        headers = {'Content-Type': 'application/json', 'Connection': 'keep-alive'}
+        if NODE_AUTH_TOKEN:
+            headers['Authorization'] = f"Bearer {NODE_AUTH_TOKEN}"
+        self.pool = urllib3.PoolManager(
+            num_pools=num_pools,
+            maxsize=pool_maxsize,
+            block=False,
+            headers=headers,
+        )
+        self._stats = {'requests': 0, 'retries': 0, 'failures': 0}
+        self._lock = threading.Lock()
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+    def _backoff(self, attempt, retry_after=None):
+        """Sleep before the next attempt (full jitter, honouring Retry-After)."""
+        delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+        if retry_after:
+            try:
+                delay = max(delay, min(float(retry_after), BACKOFF_MAX))
+            except ValueError:
+                pass
+        time.sleep(delay)
+
+    def request(self, method, url, body=None, headers=None, idempotent=False, stream=False):
+        """
+        Send a request, retrying failures that are safe to retry.
+
+        Args:
+            method: HTTP method
+            url: Absolute URL
+            body: Request body (bytes or str)
+            headers: Extra headers, added to the pool's default headers
+            idempotent: Whether the request may be repeated after it reached the node
+            stream: Return the response unread (caller must ``release_conn()``)
+
+        Returns:
+            urllib3.HTTPResponse: The final response
+
+        Raises:
+            urllib3.exceptions.HTTPError: If every attempt failed without a response
+        """
+        self._count('requests')
+        attempt = 0
+        while True:
+            try:
+                response = self.pool.request(
+                    method, url,
+                    body=body,
+                    # Passing headers replaces the pool's defaults, so merge them
+                    headers=dict(self.pool.headers, **(headers or {})),
+                    timeout=self.timeout,
+                    retries=False,
+                    preload_content=not stream,
+                )
+            except (HTTPError, ProtocolError) as e:
+                retryable = _is_connect_failure(e) or (
+                    idempotent and isinstance(e, (ReadTimeoutError, ProtocolError))
+                )
+                if not retryable or attempt >= self.max_retries:
+                    self._count('failures')
+                    raise
+            else:
+                status = response.status
+                retryable = status in SHED_STATUSES or (idempotent and status in IDEMPOTENT_RETRY_STATUSES)
+                if not retryable or attempt >= self.max_retries:
+                    return response
+                retry_after = response.headers.get('Retry-After')
+                if stream:
+                    response.drain_conn()
+                    response.release_conn()
+                self._count('retries')
+                self._backoff(attempt, retry_after)
+                attempt += 1
+                continue
+
+            self._count('retries')
+            self._backoff(attempt)
+            attempt += 1
+
+    def post_json(self, url, payload, idempotent=False):
+        """
+        POST a JSON payload and decode the JSON response.
+
+        Returns:
+            tuple: (status code, decoded body or raw text if it is not JSON)
+        """
+        response = self.request('POST', url, body=json.dumps(payload), idempotent=idempotent)
+        text = response.data.decode('utf-8', errors='replace')
+        try:
+            return response.status, json.loads(text)
+        except ValueError:
+            return response.status, text
+
+    def stream(self, url, payload, chunk_size=1024):
+        """
+        POST a JSON payload and yield the response body as it arrives.
+
+        The connection goes back to the pool once the body is fully read; a
+        generator closed mid-body closes its connection instead.
+
+        Yields:
+            bytes: Response chunks
+        """
+        response = self.request('POST', url, body=json.dumps(payload), stream=True)
+        consumed = False
+        try:
+            if response.status != 200:
+                response.drain_conn()
+                consumed = True
+                raise HTTPError(f"HTTP {response.status}")
+            for chunk in response.stream(chunk_size, decode_content=True):
+                yield chunk
+            consumed = True
+        finally:
+            if consumed:
+                response.release_conn()
+            else:
+                # Abandoned mid-body: the connection holds unread data and
+                # cannot be reused
+                response.close()
+
+    def get_stats(self):
+        """Return request/retry/failure counters plus connections opened per host."""
+        with self._lock:
+            stats = dict(self._stats)
+        connections = {}
+        for key in list(self.pool.pools.keys()):
+            pool = self.pool.pools.get(key)
+            if pool is not None:
+                connections[f"{pool.host}:{pool.port}"] = pool.num_connections
+        stats['connections_opened'] = connections
+        return stats
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_node_client():
+    """Return the process-wide node HTTP client, creating it on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = NodeHTTPClient()
+    return _client
@@ -0,0 +1,282 @@
+"""
+Token Rate Limiting Module
+
+Per-user token buckets that charge the tokens a generation actually costs
+(prompt plus completion), so one user cannot monopolize the inference engine
+with long prompts and responses.
+
+A bucket holds up to RATE_LIMIT_BURST_TOKENS and refills at
+RATE_LIMIT_TOKENS_PER_MINUTE. Before prefill, the prompt size plus the
+largest possible completion is reserved; once the response is generated the
+reservation is settled against the real count and the unused part refunded.
+A request that cannot be reserved fails with a ``Retry-After`` estimate.
+
+Buckets live in Redis when RATE_LIMIT_REDIS_URL is set, updated by a Lua
+script so concurrent workers and hosts never race; otherwise each worker
+process keeps its own buckets in memory.
+"""
+
+import logging
+import math
+import threading
+import time
+from django.conf import settings
+
+from .monitoring import record_shed_request
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_ENABLED = getattr(settings, 'RATE_LIMIT_ENABLED', True)
+RATE_LIMIT_TOKENS_PER_MINUTE = getattr(settings, 'RATE_LIMIT_TOKENS_PER_MINUTE', 1000)
+RATE_LIMIT_BURST_TOKENS = getattr(settings, 'RATE_LIMIT_BURST_TOKENS', 8000)
+RATE_LIMIT_REDIS_URL = getattr(settings, 'RATE_LIMIT_REDIS_URL', None)
+RATE_LIMIT_KEY_PREFIX = getattr(settings, 'RATE_LIMIT_KEY_PREFIX', 'token_bucket:')
+
+# Refill the bucket, then take ``cost`` tokens if there are enough (or
+# unconditionally when forced, e.g. to settle a reservation). Uses the Redis
+# clock so hosts with skewed clocks share one notion of time.
+#   KEYS[1] bucket key
+#   ARGV    capacity, refill tokens/sec, cost, force (0/1), ttl seconds
+# Returns {taken (0/1), tokens left as a string}
+_TAKE_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local force = ARGV[4] == '1'
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local taken = 0
+if force or tokens >= cost then
+    tokens = tokens - cost
+    taken = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[5]))
+return {taken, tostring(tokens)}
+"""
+
+
+class RateLimited(Exception):
+    """
+    A user's token bucket cannot cover a request.
+
+    Attributes:
+        retry_after: Whole seconds until the bucket will have refilled enough
+        tokens_needed: Tokens the request needed
+        tokens_available: Tokens left in the bucket
+    """
+
+    def __init__(self, retry_after, tokens_needed, tokens_available):
+        super().__init__(
+            f"Token rate limit reached ({tokens_needed} needed, {max(0, int(tokens_available))} available)"
+        )
+        self.retry_after = retry_after
+        self.tokens_needed = tokens_needed
+        self.tokens_available = tokens_available
+
+
+class LocalTokenBuckets:
+    """Token buckets in this process's memory."""
+
+    name = 'local'
+
+    def __init__(self):
+        self._buckets = {}  # key -> [tokens, updated]
+        self._lock = threading.Lock()
+
+    def take(self, key, cost, capacity, rate, force=False):
+        """
+        Refill the bucket and take ``cost`` tokens if it holds enough.
+
+        Returns:
+            tuple: (taken, tokens left)
+        """
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.setdefault(key, [capacity, now])
+            tokens = min(capacity, bucket[0] + max(0.0, now - bucket[1]) * rate)
+            taken = force or tokens >= cost
+            if taken:
+                tokens -= cost
+            bucket[0], bucket[1] = tokens, now
+            if len(self._buckets) > 10000:
+                self._prune(now, capacity, rate)
+        return taken, tokens
+
+    def _prune(self, now, capacity, rate):
+        # Called with self._lock held: a full bucket is the same as no bucket
+        full = [key for key, (tokens, updated) in self._buckets.items()
+                if tokens + (now - updated) * rate >= capacity]
+        for key in full:
+            del self._buckets[key]
+
+
+class RedisTokenBuckets:
+    """
+    Token buckets in Redis, updated atomically by a Lua script.
+
+    Args:
+        client: ``redis.Redis`` client
+        prefix: Key prefix for bucket hashes
+    """
+
+    name = 'redis'
+
+    def __init__(self, client, prefix=RATE_LIMIT_KEY_PREFIX):
+        self.client = client
+        self.prefix = prefix
+        self._take = client.register_script(_TAKE_SCRIPT)
+
+    def take(self, key, cost, capacity, rate, force=False):
+        # A bucket untouched for two full refills is full again, so let it expire
+        ttl = max(60, math.ceil(2 * capacity / rate))
+        taken, tokens = self._take(keys=[f"{self.prefix}{key}"], args=[capacity, rate, cost, int(force), ttl])
+        return bool(taken), float(tokens)
+
+
+class TokenReservation:
+    """Tokens reserved for one generation, settled once the real count is known."""
+
+    def __init__(self, limiter, key, tokens):
+        self.limiter = limiter
+        self.key = key
+        self.tokens = tokens
+        self.settled = False
+
+    def settle(self, used_tokens):
+        """Charge ``used_tokens`` in place of the reservation, refunding or charging the difference."""
+        if self.settled:
+            return
+        self.settled = True
+        difference = used_tokens - self.tokens
+        if difference:
+            self.limiter.adjust(self.key, difference)
+
+    def cancel(self):
+        """Refund the whole reservation (the generation did not happen)."""
+        self.settle(0)
+
+
+class TokenBucketLimiter:
+    """
+    Per-key token bucket rate limiter.
+
+    Args:
+        buckets: Bucket store (LocalTokenBuckets or RedisTokenBuckets)
+        tokens_per_minute: Refill rate
+        burst_tokens: Bucket capacity
+    """
+
+    def __init__(self, buckets, tokens_per_minute=RATE_LIMIT_TOKENS_PER_MINUTE,
+                 burst_tokens=RATE_LIMIT_BURST_TOKENS):
+        self.buckets = buckets
+        self.rate = tokens_per_minute / 60.0
+        self.capacity = burst_tokens
+        self._lock = threading.Lock()
+        self._stats = {'reserved': 0, 'limited': 0, 'refunded_tokens': 0, 'overrun_tokens': 0, 'errors': 0}
+
+    def _take(self, key, cost, force=False):
+        try:
+            return self.buckets.take(key, cost, self.capacity, self.rate, force)
+        except Exception as e:
+            # Never fail a request because the limiter's store is unavailable
+            logger.error(f"Token bucket update failed for {key}: {str(e)}")
+            with self._lock:
+                self._stats['errors'] += 1
+            return True, self.capacity
+
+    def _limited(self, tokens_needed, tokens_available):
+        with self._lock:
+            self._stats['limited'] += 1
+        record_shed_request('rate_limited')
+        retry_after = max(1, math.ceil((tokens_needed - tokens_available) / self.rate))
+        return RateLimited(retry_after, tokens_needed, tokens_available)
+
+    def check(self, key, tokens):
+        """
+        Raise RateLimited unless the bucket holds ``tokens`` (capped at its
+        capacity), without taking any.
+        """
+        tokens = min(tokens, self.capacity)
+        _, available = self._take(key, 0)
+        if available < tokens:
+            raise self._limited(tokens, available)
+
+    def reserve(self, key, tokens):
+        """
+        Take ``tokens`` from ``key``'s bucket.
+
+        A request larger than the whole bucket only needs a full bucket, so
+        it is delayed rather than refused forever; it still pays in full.
+
+        Returns:
+            TokenReservation: To settle with the tokens actually used
+
+        Raises:
+            RateLimited: If the bucket does not hold enough tokens
+        """
+        needed = min(tokens, self.capacity)
+        taken, available = self._take(key, needed)
+        if not taken:
+            raise self._limited(needed, available)
+        if tokens > needed:
+            self._take(key, tokens - needed, force=True)
+        with self._lock:
+            self._stats['reserved'] += 1
+        return TokenReservation(self, key, tokens)
+
+    def adjust(self, key, tokens):
+        """Charge (positive) or refund (negative) tokens unconditionally."""
+        self._take(key, tokens, force=True)
+        with self._lock:
+            if tokens < 0:
+                self._stats['refunded_tokens'] -= tokens
+            else:
+                self._stats['overrun_tokens'] += tokens
+
+    def stats(self):
+        """Return this process's limiter counters and settings."""
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update(
+            backend=self.buckets.name,
+            tokens_per_minute=self.rate * 60,
+            burst_tokens=self.capacity,
+        )
+        return stats
+
+
+def _create_buckets():
+    if RATE_LIMIT_REDIS_URL:
+        try:
+            import redis
+            return RedisTokenBuckets(redis.Redis.from_url(RATE_LIMIT_REDIS_URL))
+        except Exception as e:
+            logger.error(f"Redis token buckets unavailable ({str(e)}), falling back to in-process buckets")
+    return LocalTokenBuckets()
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """Return the shared token bucket limiter, or None if rate limiting is disabled."""
+    global _limiter
+    if not RATE_LIMIT_ENABLED:
+        return None
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                _limiter = TokenBucketLimiter(_create_buckets())
+    return _limiter
+
+
+def get_rate_limit_stats():
+    """Return the limiter's counters (None if rate limiting is disabled)."""
+    limiter = get_rate_limiter()
+    return limiter.stats() if limiter is not None else None
@@ -0,0 +1,283 @@
+"""
+Scaling Policy Module
+
+Decides when the LLM service should scale out or in. Policies are plain
+objects fed one metric sample at a time, with no AWS calls of their own, so
+the same decision logic runs in AWSScalingManager, in unit tests and in
+offline replays of recorded metric traces (benchmarks/replay_scaling_policy.py).
+
+A sample is a dict:
+
+    timestamp       seconds (time.time() or the trace's clock)
+    capacity        current desired instance count
+    min_capacity    lower bound (optional)
+    max_capacity    upper bound (optional)
+    pending         True while a previous scaling action is still in progress
+    queue_depth     average requests waiting or running per instance
+    tokens_per_sec  average generated tokens per second per instance
+    p95_latency     p95 request latency in seconds
+    cpu_utilization average CPU percent (only used by CPUThresholdPolicy)
+
+Missing signals are None and never trigger an action on their own.
+
+Every policy shares the same guard rails: separate scale-out and scale-in
+cooldowns, a limit on instances added per step, and hysteresis, meaning low
+load must persist for a while before capacity is removed, and the scale-in
+thresholds sit well below the scale-out ones.
+"""
+
+import math
+from django.conf import settings
+
+SCALING_POLICY = getattr(settings, 'SCALING_POLICY', 'queue_latency')
+SCALE_OUT_COOLDOWN = getattr(settings, 'SCALE_OUT_COOLDOWN', 120)  # seconds
+SCALE_IN_COOLDOWN = getattr(settings, 'SCALE_IN_COOLDOWN', 600)  # seconds since the last action of either kind
+# High load must last this long before scaling out (seconds)
+SCALE_OUT_STABLE_SECONDS = getattr(settings, 'SCALE_OUT_STABLE_SECONDS', 60)
+# Low load must last this long before scaling in (seconds)
+SCALE_IN_STABLE_SECONDS = getattr(settings, 'SCALE_IN_STABLE_SECONDS', 600)
+SCALE_OUT_MAX_STEP = getattr(settings, 'SCALE_OUT_MAX_STEP', 2)  # instances added at once
+
+# Queue/latency policy targets
+SCALING_TARGET_QUEUE_DEPTH = getattr(settings, 'SCALING_TARGET_QUEUE_DEPTH', 2)  # per instance
+# Sustainable generated tokens/sec of one instance; None disables the throughput signal
+SCALING_INSTANCE_TOKENS_PER_SEC = getattr(settings, 'SCALING_INSTANCE_TOKENS_PER_SEC', None)
+SCALING_TARGET_UTILIZATION = getattr(settings, 'SCALING_TARGET_UTILIZATION', 0.7)
+SCALING_LATENCY_SLO = getattr(settings, 'SCALING_LATENCY_SLO', 30.0)  # p95 seconds, whole response
+# Scale in only while every signal is below this fraction of its target
+SCALING_SCALE_IN_RATIO = getattr(settings, 'SCALING_SCALE_IN_RATIO', 0.5)
+
+HIGH = 'high'
+LOW = 'low'
+NORMAL = 'normal'
+UNKNOWN = 'unknown'
+
+
+class ScalingPolicy:
+    """
+    Base class: cooldowns, step limits and hysteresis around ``assess``.
+
+    Subclasses implement ``assess(sample)`` returning ``(state, desired,
+    reason)`` where state is HIGH, LOW, NORMAL or UNKNOWN and desired is the
+    capacity the load calls for.
+    """
+
+    name = None
+
+    def __init__(self, scale_out_cooldown=SCALE_OUT_COOLDOWN, scale_in_cooldown=SCALE_IN_COOLDOWN,
+                 scale_out_stable_seconds=SCALE_OUT_STABLE_SECONDS,
+                 scale_in_stable_seconds=SCALE_IN_STABLE_SECONDS, max_step=SCALE_OUT_MAX_STEP):
+        self.scale_out_cooldown = scale_out_cooldown
+        self.scale_in_cooldown = scale_in_cooldown
+        self.scale_out_stable_seconds = scale_out_stable_seconds
+        self.scale_in_stable_seconds = scale_in_stable_seconds
+        self.max_step = max_step
+        self.reset()
+
+    def reset(self):
+        """Forget all history (cooldowns and sustained-load timers)."""
+        self._high_since = None
+        self._low_since = None
+        self._last_scale_out = None
+        self._last_scale_in = None
+
+    def assess(self, sample):
+        raise NotImplementedError
+
+    @staticmethod
+    def _since(then, now):
+        return math.inf if then is None else now - then
+
+    def evaluate(self, sample):
+        """
+        Decide what to do for one metric sample.
+
+        Args:
+            sample: Metric sample dict (see module docstring)
+
+        Returns:
+            dict: ``action`` ("scale_out", "scale_in" or "hold"), ``capacity``,
+            ``desired`` capacity, ``state``, ``reason`` and ``timestamp``
+        """
+        now = sample['timestamp']
+        capacity = sample['capacity']
+        min_capacity = sample.get('min_capacity') or 1
+        max_capacity = sample.get('max_capacity') or capacity
+        state, desired, reason = self.assess(sample)
+
+        if state == HIGH:
+            self._high_since = now if self._high_since is None else self._high_since
+            self._low_since = None
+        elif state == LOW:
+            self._low_since = now if self._low_since is None else self._low_since
+            self._high_since = None
+        else:
+            self._high_since = None
+            self._low_since = None
+
+        decision = {
+            'timestamp': now,
+            'policy': self.name,
+            'action': 'hold',
+            'capacity': capacity,
+            'desired': capacity,
+            'state': state,
+            'reason': reason,
+        }
+
+        if state == HIGH:
+            target = min(max_capacity, capacity + self.max_step, max(desired, capacity + 1))
+            if sample.get('pending'):
+                decision['reason'] = f"{reason}; scaling in progress"
+            elif capacity >= max_capacity:
+                decision['reason'] = f"{reason}; at max capacity"
+            elif now - self._high_since < self.scale_out_stable_seconds:
+                decision['reason'] = f"{reason}; waiting for sustained load"
+            elif self._since(self._last_scale_out, now) < self.scale_out_cooldown:
+                decision['reason'] = f"{reason}; scale-out cooldown"
+            else:
+                decision.update(action='scale_out', desired=target)
+                self._last_scale_out = now
+        elif state == LOW:
+            # Remove one instance at a time; load is re-measured before the next
+            target = max(min_capacity, capacity - 1)
+            last_action = max(
+                (t for t in (self._last_scale_out, self._last_scale_in) if t is not None), default=None
+            )
+            if sample.get('pending'):
+                decision['reason'] = f"{reason}; scaling in progress"
+            elif capacity <= min_capacity:
+                decision['reason'] = f"{reason}; at min capacity"
+            elif now - self._low_since < self.scale_in_stable_seconds:
+                decision['reason'] = f"{reason}; waiting for sustained low load"
+            elif self._since(last_action, now) < self.scale_in_cooldown:
+                decision['reason'] = f"{reason}; scale-in cooldown"
+            else:
+                decision.update(action='scale_in', desired=target)
+                self._last_scale_in = now
+                # Another step needs another full period of low load
+                self._low_since = now
+        return decision
+
+
+class QueueLatencyPolicy(ScalingPolicy):
+    """
+    Scale on request queue depth, token throughput and p95 latency vs an SLO.
+
+    CPU is not used: a llama.cpp instance pegs its cores whether one or ten
+    requests are waiting. Scale out when queue depth or throughput is above
+    target, or p95 latency is over the SLO while requests are queueing (a
+    slow p95 with an empty queue is long generations, which more instances
+    don't shorten). Scale in only when queue depth and throughput are below
+    ``scale_in_ratio`` of target, p95 is within the SLO, and one fewer
+    instance would still carry the load.
+    """
+
+    name = 'queue_latency'
+
+    def __init__(self, target_queue_depth=SCALING_TARGET_QUEUE_DEPTH,
+                 instance_tokens_per_sec=SCALING_INSTANCE_TOKENS_PER_SEC,
+                 target_utilization=SCALING_TARGET_UTILIZATION, latency_slo=SCALING_LATENCY_SLO,
+                 scale_in_ratio=SCALING_SCALE_IN_RATIO, **kwargs):
+        self.target_queue_depth = target_queue_depth
+        self.instance_tokens_per_sec = instance_tokens_per_sec
+        self.target_utilization = target_utilization
+        self.latency_slo = latency_slo
+        self.scale_in_ratio = scale_in_ratio
+        super().__init__(**kwargs)
+
+    def assess(self, sample):
+        capacity = max(sample['capacity'], 1)
+        high = []
+        low = []
+        desired = 0
+
+        queue_depth = sample.get('queue_depth')
+        if queue_depth is not None:
+            desired = max(desired, math.ceil(capacity * queue_depth / self.target_queue_depth))
+            if queue_depth > self.target_queue_depth:
+                high.append(f"queue depth {queue_depth:.1f} > {self.target_queue_depth}")
+            low.append(queue_depth < self.target_queue_depth * self.scale_in_ratio)
+
+        tokens_per_sec = sample.get('tokens_per_sec')
+        if tokens_per_sec is not None and self.instance_tokens_per_sec:
+            utilization = tokens_per_sec / self.instance_tokens_per_sec
+            desired = max(desired, math.ceil(capacity * utilization / self.target_utilization))
+            if utilization > self.target_utilization:
+                high.append(f"utilization {utilization:.0%} > {self.target_utilization:.0%}")
+            low.append(utilization < self.target_utilization * self.scale_in_ratio)
+
+        p95_latency = sample.get('p95_latency')
+        if p95_latency is not None:
+            queueing = queue_depth is None or queue_depth >= self.target_queue_depth * self.scale_in_ratio
+            if p95_latency > self.latency_slo and queueing:
+                high.append(f"p95 {p95_latency:.1f}s > SLO {self.latency_slo}s")
+                desired = max(desired, capacity + 1)
+            low.append(p95_latency <= self.latency_slo)
+
+        if high:
+            return HIGH, desired, ", ".join(high)
+        if not low:
+            return UNKNOWN, capacity, "no metrics"
+        if all(low) and desired < capacity:
+            return LOW, desired, "all signals below scale-in thresholds"
+        return NORMAL, capacity, "within targets"
+
+
+class CPUThresholdPolicy(ScalingPolicy):
+    """The original CPU rule: scale out above 70%, in below 30%, one instance at a time."""
+
+    name = 'cpu'
+
+    def __init__(self, high_threshold=70, low_threshold=30, **kwargs):
+        self.high_threshold = high_threshold
+        self.low_threshold = low_threshold
+        super().__init__(**kwargs)
+
+    def assess(self, sample):
+        cpu = sample.get('cpu_utilization')
+        capacity = sample['capacity']
+        if cpu is None:
+            return UNKNOWN, capacity, "no metrics"
+        if cpu > self.high_threshold:
+            return HIGH, capacity + 1, f"CPU {cpu:.0f}% > {self.high_threshold}%"
+        if cpu < self.low_threshold:
+            return LOW, capacity - 1, f"CPU {cpu:.0f}% < {self.low_threshold}%"
+        return NORMAL, capacity, "within targets"
+
+
+SCALING_POLICIES = {
+    QueueLatencyPolicy.name: QueueLatencyPolicy,
+    CPUThresholdPolicy.name: CPUThresholdPolicy,
+}
+
+
+def get_scaling_policy(name=None, **kwargs):
+    """
+    Create the configured scaling policy.
+
+    Args:
+        name: Policy name (defaults to the SCALING_POLICY setting)
+        **kwargs: Overrides for the policy's parameters
+
+    Raises:
+        ValueError: For an unknown policy name
+    """
+    name = name or SCALING_POLICY
+    if name not in SCALING_POLICIES:
+        raise ValueError(f"Unknown scaling policy: {name} (choose from {', '.join(SCALING_POLICIES)})")
+    return SCALING_POLICIES[name](**kwargs)
+
+
+def replay(policy, samples):
+    """
+    Run a policy over recorded samples, oldest first.
+
+    The policy sees each sample's recorded capacity, so the result shows
+    what it would have decided at each point of the trace.
+
+    Returns:
+        list: One decision per sample
+    """
+    policy.reset()
+    return [policy.evaluate(sample) for sample in samples]
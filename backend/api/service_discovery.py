@@ -0,0 +1,259 @@
+"""
+Service Discovery Module
+
+This module keeps the list of distributed inference nodes up to date in the
+background, so no request ever waits on a discovery call.
+
+A single refresher thread polls a discovery provider and swaps the node
+table atomically (readers only ever see a complete list). If a refresh
+fails, the last known list keeps being served. Listeners are notified of
+nodes that joined or left, so routing state (balancer health, hash ring)
+follows membership changes.
+
+Providers:
+1. CloudMapDiscovery - AWS Cloud Map instances of SERVICE_DISCOVERY_NAME
+2. StaticDiscovery - the INFERENCE_NODES setting/environment variable
+   ("host:port,host:port") or a JSON file (INFERENCE_NODES_FILE), for
+   running several nodes locally without AWS
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DISCOVERY_REFRESH_INTERVAL = getattr(settings, 'DISCOVERY_REFRESH_INTERVAL', 30)  # seconds
+INFERENCE_NODE_PATH = "/api/inference/"
+
+
+def make_node(node_id, ip, port):
+    """Build the node dict used throughout distributed inference."""
+    return {
+        'id': node_id,
+        'ip': ip,
+        'port': str(port),
+        'url': f"http://{ip}:{port}{INFERENCE_NODE_PATH}"
+    }
+
+
+class CloudMapDiscovery:
+    """
+    Discover nodes registered as instances of an AWS Cloud Map service.
+
+    Args:
+        client: boto3 ``servicediscovery`` client
+        service_name: Cloud Map service name
+    """
+
+    def __init__(self, client, service_name):
+        self.client = client
+        self.service_name = service_name
+        self._service_id = None
+
+    def _find_service_id(self):
+        kwargs = {}
+        while True:
+            response = self.client.list_services(**kwargs)
+            for service in response.get('Services', []):
+                if service['Name'] == self.service_name:
+                    return service['Id']
+            if not response.get('NextToken'):
+                return None
+            kwargs['NextToken'] = response['NextToken']
+
+    def discover(self):
+        """
+        Returns:
+            list: Node dicts
+
+        Raises:
+            Exception: If Cloud Map cannot be queried (the caller keeps stale nodes)
+        """
+        if self._service_id is None:
+            self._service_id = self._find_service_id()
+            if self._service_id is None:
+                raise LookupError(f"Cloud Map service {self.service_name} not found")
+
+        nodes = []
+        kwargs = {'ServiceId': self._service_id}
+        while True:
+            response = self.client.list_instances(**kwargs)
+            for instance in response.get('Instances', []):
+                attributes = instance.get('Attributes', {})
+                if 'AWS_INSTANCE_IPV4' in attributes:
+                    nodes.append(make_node(
+                        instance['Id'],
+                        attributes['AWS_INSTANCE_IPV4'],
+                        attributes.get('AWS_INSTANCE_PORT', '8000')
+                    ))
+            if not response.get('NextToken'):
+                return nodes
+            kwargs['NextToken'] = response['NextToken']
+
+
+class StaticDiscovery:
+    """
+    Discover nodes from configuration instead of AWS.
+
+    Nodes come from a JSON file (a list of ``"host:port"`` strings or
+    ``{"id", "ip", "port"}`` objects), re-read on every refresh so nodes can
+    be added or removed while the service runs, or from a comma-separated
+    ``"host:port"`` list.
+
+    Args:
+        nodes: Comma-separated string or list of ``"host:port"`` entries
+        path: Path to a JSON node file (takes precedence over ``nodes``)
+    """
+
+    def __init__(self, nodes=None, path=None):
+        if isinstance(nodes, str):
+            nodes = [entry.strip() for entry in nodes.split(',') if entry.strip()]
+        self.nodes = list(nodes or [])
+        self.path = path
+
+    @staticmethod
+    def _parse(entry):
+        if isinstance(entry, dict):
+            ip = entry['ip']
+            port = entry.get('port', 8000)
+            return make_node(entry.get('id', f"{ip}:{port}"), ip, port)
+        address = entry.split('://', 1)[-1].rstrip('/')
+        ip, _, port = address.partition(':')
+        port = port or '8000'
+        return make_node(f"{ip}:{port}", ip, port)
+
+    def discover(self):
+        entries = self.nodes
+        if self.path:
+            with open(self.path) as f:
+                entries = json.load(f)
+        return [self._parse(entry) for entry in entries]
+
+
+def get_discovery_provider(cloudmap_client=None):
+    """
+    Pick the discovery provider from settings/environment.
+
+    Returns:
+        The provider, or None if no discovery is configured (local only)
+    """
+    path = getattr(settings, 'INFERENCE_NODES_FILE', None) or os.environ.get('INFERENCE_NODES_FILE')
+    static_nodes = getattr(settings, 'INFERENCE_NODES', None) or os.environ.get('INFERENCE_NODES')
+    if path or static_nodes:
+        return StaticDiscovery(nodes=static_nodes, path=path)
+
+    service_name = getattr(settings, 'SERVICE_DISCOVERY_NAME', None)
+    if service_name and cloudmap_client is not None:
+        return CloudMapDiscovery(cloudmap_client, service_name)
+    return None
+
+
+class NodeDiscovery:
+    """
+    Background refresher holding the current node table.
+
+    Args:
+        provider: Object with a ``discover()`` method returning node dicts
+        interval: Seconds between refreshes
+    """
+
+    def __init__(self, provider, interval=DISCOVERY_REFRESH_INTERVAL):
+        self.provider = provider
+        self.interval = interval
+        # Replaced wholesale on every change, never mutated, so readers need no lock
+        self._nodes = ()
+        self._listeners = []
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._refresh_lock = threading.Lock()
+        self.last_success = None
+        self.last_error = None
+        self.consecutive_failures = 0
+
+    @property
+    def nodes(self):
+        """The current node list (a snapshot; may be stale if discovery is failing)."""
+        return list(self._nodes)
+
+    def add_listener(self, listener):
+        """
+        Register ``listener(joined, left, nodes)``, called after membership changes.
+
+        ``joined`` and ``left`` are lists of node dicts; ``nodes`` is the new table.
+        """
+        self._listeners.append(listener)
+
+    def refresh(self):
+        """
+        Query the provider once and swap in the result.
+
+        Returns:
+            bool: True if discovery succeeded (even if nothing changed)
+        """
+        with self._refresh_lock:
+            try:
+                discovered = self.provider.discover()
+            except Exception as e:
+                self.consecutive_failures += 1
+                self.last_error = str(e)
+                logger.warning(
+                    f"Service discovery failed ({self.consecutive_failures} in a row), "
+                    f"keeping {len(self._nodes)} known nodes: {str(e)}"
+                )
+                return False
+
+            self.consecutive_failures = 0
+            self.last_error = None
+            self.last_success = time.time()
+
+            previous = {node['id']: node for node in self._nodes}
+            current = {node['id']: node for node in discovered}
+            joined = [node for node_id, node in current.items() if node_id not in previous]
+            left = [node for node_id, node in previous.items() if node_id not in current]
+            changed = [node for node_id, node in current.items()
+                       if node_id in previous and previous[node_id] != node]
+            if not (joined or left or changed):
+                return True
+
+            self._nodes = tuple(discovered)
+
+        if joined or left:
+            logger.info(
+                f"Inference nodes changed: joined={[n['id'] for n in joined]} "
+                f"left={[n['id'] for n in left]}"
+            )
+        for listener in list(self._listeners):
+            try:
+                listener(joined, left, list(discovered))
+            except Exception as e:
+                logger.error(f"Error in node discovery listener: {str(e)}")
+        return True
+
+    def start(self):
+        """Start the background refresher (the first refresh happens right away)."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._refresh_loop, name="node-discovery", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _refresh_loop(self):
+        while True:
+            self.refresh()
+            if self._stop_event.wait(self.interval):
+                return
+
+    def stats(self):
+        return {
+            'nodes': len(self._nodes),
+            'last_success': self.last_success,
+            'last_error': self.last_error,
+            'consecutive_failures': self.consecutive_failures,
+        }
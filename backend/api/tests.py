@@ -1,3 +1,1295 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import random
+import socket
+import tempfile
+import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from unittest import mock
 
-# Create your tests here.
+from asgiref.testing import ApplicationCommunicator
+from django.core.cache import cache
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+from urllib3.exceptions import MaxRetryError, NewConnectionError, ReadTimeoutError
+
+from api import aws_scaling, lambda_handler, llm_handler, monitoring, node_client, views, websocket
+from api.admission import AdmissionController, AdmissionRejected
+from api.llm_handler import estimate_generation_tokens
+from api.latency_histogram import (
+    BUCKET_COUNT, MAX_TRACKABLE_MS, LatencyHistogram, _bucket_index, _bucket_upper_bound
+)
+from api.monitoring import MetricsAggregator
+from api.metrics_exposition import render_openmetrics, shared_cache_configured
+from api.cloudwatch_publisher import MAX_DATUMS_PER_CALL, CloudWatchPublisher
+from api.cancellation import CancelToken, cancellable_generation, client_disconnected, request_cancel
+from api.distributed_inference import NodeSlots, ResultRegistry, distributed_inference, node_key
+from api.hash_ring import HashRing
+from api.hedging import HedgePolicy
+from api.load_balancer import LoadBalancer
+from api.node_client import NodeHTTPClient
+from api.rate_limit import LocalTokenBuckets, RateLimited, TokenBucketLimiter
+from api.service_discovery import NodeDiscovery, StaticDiscovery, get_discovery_provider, make_node
+from api.scaling_policy import QueueLatencyPolicy, CPUThresholdPolicy, replay
+from api.token_budget import TokenBudgetEstimator, input_length_group
+from api.traffic_forecast import TrafficForecaster, apply_forecast, hour_of_week, plan_capacity
+
+
+def _wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class PayloadEncodingTests(SimpleTestCase):
+    def test_small_payload_is_not_compressed(self):
+        envelope, stats = lambda_handler.encode_payload({'user_input': 'hi'})
+        self.assertEqual(envelope['content_encoding'], 'identity')
+        self.assertFalse(stats['compressed'])
+        self.assertEqual(lambda_handler.decode_payload(envelope), {'user_input': 'hi'})
+
+    def test_large_payload_round_trips_through_gzip(self):
+        payload = {'user_input': 'hello world ' * 2000}
+        envelope, stats = lambda_handler.encode_payload(payload)
+        self.assertEqual(envelope['content_encoding'], 'gzip')
+        self.assertLess(stats['encoded_size'], stats['raw_size'])
+        self.assertEqual(lambda_handler.decode_payload(envelope), payload)
+
+    def test_pack_history_keeps_most_recent_messages(self):
+        history = [{'role': 'user', 'content': str(i) * 10} for i in range(5)]
+        packed, dropped = lambda_handler.pack_history(history, max_tokens=25, count_tokens=len)
+        self.assertEqual(packed, history[-2:])
+        self.assertEqual(dropped, 3)
+
+
+@mock.patch.object(lambda_handler, 'prepare_lambda_payload', lambda data: {'content_encoding': 'identity', 'body': ''})
+class LambdaJobTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.client_patch = mock.patch.object(lambda_handler, 'lambda_client')
+        self.lambda_client = self.client_patch.start()
+        self.lambda_client.invoke.return_value = {'StatusCode': 202}
+        self.addCleanup(self.client_patch.stop)
+
+    def _finished(self, job_id):
+        return lambda: lambda_handler.get_lambda_job(job_id)['status'] != 'pending'
+
+    def test_submit_invokes_event_and_collects_callback_result(self):
+        job_id = lambda_handler.submit_lambda_job({'user_input': 'hi'}, owner=7)
+        self.assertIsNotNone(job_id)
+        self.assertTrue(_wait_for(lambda: self.lambda_client.invoke.called))
+
+        kwargs = self.lambda_client.invoke.call_args.kwargs
+        self.assertEqual(kwargs['InvocationType'], 'Event')
+        self.assertEqual(json.loads(kwargs['Payload'])['job']['job_id'], job_id)
+        self.assertEqual(lambda_handler.get_lambda_job(job_id)['status'], 'pending')
+
+        self.assertTrue(lambda_handler.complete_lambda_job(job_id, {'response': 'hello'}))
+        job = lambda_handler.get_lambda_job(job_id)
+        self.assertEqual(job['status'], 'complete')
+        self.assertEqual(job['result'], {'response': 'hello'})
+        self.assertEqual(job['owner'], 7)
+        # A late duplicate callback or failure does not overwrite the result
+        self.assertFalse(lambda_handler.complete_lambda_job(job_id, {'response': 'again'}))
+        self.assertFalse(lambda_handler._fail_lambda_job(job_id, 'late failure'))
+        self.assertEqual(lambda_handler.get_lambda_job(job_id)['result'], {'response': 'hello'})
+
+    def test_job_is_finished_only_once(self):
+        with mock.patch.object(lambda_handler, 'LAMBDA_ASYNC_TIMEOUT', 0.2):
+            job_id = lambda_handler.submit_lambda_job({'user_input': 'hi'})
+            self.assertTrue(_wait_for(lambda: self.lambda_client.invoke.called))
+            # Another worker finished the job between this one's read and write
+            cache.add(f"{lambda_handler._job_key(job_id)}:finished", True)
+            self.assertFalse(lambda_handler.complete_lambda_job(job_id, {'response': 'hello'}))
+            # Nor does this worker's timeout overwrite it
+            self.assertTrue(_wait_for(lambda: job_id not in lambda_handler._job_futures))
+        self.assertEqual(lambda_handler.get_lambda_job(job_id)['status'], 'pending')
+
+    def test_rejected_invocation_fails_the_job(self):
+        self.lambda_client.invoke.side_effect = RuntimeError("throttled")
+        job_id = lambda_handler.submit_lambda_job({'user_input': 'hi'})
+        self.assertTrue(_wait_for(self._finished(job_id)))
+        job = lambda_handler.get_lambda_job(job_id)
+        self.assertEqual(job['status'], 'error')
+        self.assertIn('throttled', job['error'])
+
+    def test_job_without_result_times_out(self):
+        with mock.patch.object(lambda_handler, 'LAMBDA_ASYNC_TIMEOUT', 0.2):
+            job_id = lambda_handler.submit_lambda_job({'user_input': 'hi'})
+            self.assertTrue(_wait_for(self._finished(job_id)))
+        self.assertEqual(lambda_handler.get_lambda_job(job_id)['status'], 'error')
+
+    def test_submissions_beyond_the_outstanding_cap_are_refused(self):
+        with mock.patch.object(lambda_handler, '_job_slots', threading.BoundedSemaphore(1)):
+            first = lambda_handler.submit_lambda_job({'user_input': 'one'})
+            second = lambda_handler.submit_lambda_job({'user_input': 'two'})
+            self.assertIsNotNone(first)
+            self.assertIsNone(second)
+            self.assertTrue(_wait_for(lambda: first in lambda_handler._job_futures))
+            lambda_handler.complete_lambda_job(first, {'response': 'done'})
+            # The callback wakes the pool thread, which gives the slot back
+            self.assertTrue(_wait_for(lambda: lambda_handler._job_slots._value == 1, timeout=1))
+
+
+RATES = {'prefill_tokens_per_sec': 100, 'decode_tokens_per_sec': 20, 'completion_tokens': 100,
+         'generation_seconds': 10, 'in_flight': 0}
+
+
+@override_settings(SERVERLESS_OFFLOADING_ENABLED=True)
+class OffloadDecisionTests(SimpleTestCase):
+    def _decide(self, rates=RATES, admission=None, request_data=None, system_metrics=None):
+        admission = admission or {'slots': 1, 'waiting': 0}
+        with mock.patch.object(lambda_handler, 'get_generation_rates', return_value=dict(rates)), \
+                mock.patch.object(lambda_handler, 'get_admission_stats', return_value=admission), \
+                mock.patch.object(lambda_handler, 'estimate_remote_latency', return_value=10.0), \
+                self.assertLogs('api.offload_decisions', 'INFO') as logs:
+            decision = lambda_handler.decide_offload(request_data or {'prompt_tokens': 200}, system_metrics)
+        self.assertEqual(json.loads(logs.output[-1].split(':', 2)[2]), decision)
+        return decision
+
+    def test_local_estimate_counts_running_and_queued_generations(self):
+        # 200 / 100 prefill + 100 / 20 decode
+        self.assertEqual(lambda_handler.estimate_local_latency(200, RATES, {'slots': 1, 'waiting': 0}), 7)
+        busy = dict(RATES, in_flight=1)
+        # One running and three queued generations of 10 s, over two slots
+        self.assertEqual(lambda_handler.estimate_local_latency(200, busy, {'slots': 2, 'waiting': 3}), 27)
+        self.assertIsNone(lambda_handler.estimate_local_latency(200, {'in_flight': 0}, {'slots': 1}))
+
+    def test_idle_worker_keeps_the_request(self):
+        decision = self._decide()
+        self.assertFalse(decision['offload'])
+        self.assertEqual(decision['reason'], 'local_faster')
+        self.assertEqual(decision['local_estimate'], 7)
+
+    def test_saturated_queue_offloads(self):
+        decision = self._decide(rates=dict(RATES, in_flight=1), admission={'slots': 1, 'waiting': 3})
+        self.assertTrue(decision['offload'])
+        self.assertEqual(decision['reason'], 'remote_faster')
+        self.assertEqual((decision['local_in_flight'], decision['local_waiting']), (1, 3))
+
+    def test_large_prompt_offloads_before_local_rates_are_measured(self):
+        decision = self._decide(rates={'in_flight': 0}, request_data={'prompt_tokens': 5000})
+        self.assertEqual(decision['reason'], 'large_prompt_unmeasured')
+        self.assertTrue(decision['offload'])
+        decision = self._decide(rates={'in_flight': 0})
+        self.assertEqual(decision['reason'], 'local_unmeasured')
+        self.assertFalse(decision['offload'])
+
+    def test_memory_pressure_forces_offload(self):
+        decision = self._decide(system_metrics={'memory_percent': 95})
+        self.assertTrue(decision['offload'])
+        self.assertEqual(decision['reason'], 'memory_pressure')
+
+
+def _sample(timestamp, capacity=2, **signals):
+    sample = {'timestamp': timestamp, 'capacity': capacity, 'min_capacity': 1, 'max_capacity': 6}
+    sample.update(signals)
+    return sample
+
+
+class CloudWatchPublisherTests(SimpleTestCase):
+    def setUp(self):
+        self.client = mock.Mock()
+        self.publisher = CloudWatchPublisher(client=self.client, flush_interval=3600, max_series=2500)
+        self.addCleanup(self.publisher._stop_event.set)
+
+    def _datums(self):
+        return [datum for call in self.client.put_metric_data.call_args_list for datum in call.kwargs['MetricData']]
+
+    def test_samples_aggregate_into_statistic_sets(self):
+        for value in (3, 1, 8):
+            self.publisher.put('AI/LLMService', 'Latency', value, 'Seconds', [{'Name': 'Endpoint', 'Value': 'chat'}])
+        # Same series regardless of dimension order
+        self.publisher.put('AI/LLMService', 'Latency', 4, 'Seconds', [{'Value': 'chat', 'Name': 'Endpoint'}])
+        self.publisher.put('AI/LLMService', 'Latency', 100, 'Seconds', [{'Name': 'Endpoint', 'Value': 'other'}])
+
+        self.assertEqual(self.publisher.flush(), 2)
+        self.client.put_metric_data.assert_called_once()
+        self.assertEqual(self.client.put_metric_data.call_args.kwargs['Namespace'], 'AI/LLMService')
+        chat = next(datum for datum in self._datums() if datum['Dimensions'][0]['Value'] == 'chat')
+        self.assertEqual(chat['StatisticValues'], {'SampleCount': 4, 'Sum': 16, 'Minimum': 1, 'Maximum': 8})
+        self.assertEqual(chat['Unit'], 'Seconds')
+        # The buffer was drained
+        self.assertEqual(self.publisher.flush(), 0)
+
+    def test_flush_chunks_put_metric_data_calls(self):
+        for index in range(2 * MAX_DATUMS_PER_CALL + 5):
+            self.publisher.put('AI/LLMService', f"Metric{index}", 1)
+        self.publisher.put('Other', 'Metric', 1)
+
+        self.assertEqual(self.publisher.flush(), 2 * MAX_DATUMS_PER_CALL + 6)
+        sizes = sorted(len(call.kwargs['MetricData']) for call in self.client.put_metric_data.call_args_list)
+        self.assertEqual(sizes, [1, 5, MAX_DATUMS_PER_CALL, MAX_DATUMS_PER_CALL])
+        self.assertEqual(self.publisher.get_stats()['put_calls'], 4)
+
+    def test_full_buffer_drops_new_series_only(self):
+        publisher = CloudWatchPublisher(client=self.client, flush_interval=3600, max_series=2)
+        self.addCleanup(publisher._stop_event.set)
+        self.assertTrue(publisher.put('AI/LLMService', 'A', 1))
+        self.assertTrue(publisher.put('AI/LLMService', 'B', 1))
+        self.assertFalse(publisher.put('AI/LLMService', 'C', 1))
+        # Existing series still aggregate
+        self.assertTrue(publisher.put('AI/LLMService', 'A', 2))
+        stats = publisher.get_stats()
+        self.assertEqual((stats['dropped'], stats['samples'], stats['buffered_series']), (1, 3, 2))
+
+    def test_failed_call_is_counted(self):
+        self.client.put_metric_data.side_effect = RuntimeError('throttled')
+        self.publisher.put('AI/LLMService', 'A', 1)
+        with self.assertLogs('api.cloudwatch_publisher', 'ERROR'):
+            self.assertEqual(self.publisher.flush(), 0)
+        self.assertEqual(self.publisher.get_stats()['datums_failed'], 1)
+
+
+class ScalingPolicyTests(SimpleTestCase):
+    def setUp(self):
+        self.policy = QueueLatencyPolicy(
+            target_queue_depth=2, instance_tokens_per_sec=10, latency_slo=10,
+            scale_out_cooldown=120, scale_in_cooldown=600,
+            scale_out_stable_seconds=60, scale_in_stable_seconds=300, max_step=2,
+        )
+
+    def test_scale_out_needs_sustained_load_then_respects_cooldown(self):
+        self.assertEqual(self.policy.evaluate(_sample(0, queue_depth=5))['action'], 'hold')
+        decision = self.policy.evaluate(_sample(60, queue_depth=5))
+        self.assertEqual(decision['action'], 'scale_out')
+        # ceil(2 * 5 / 2) = 5 instances wanted, but at most 2 are added per step
+        self.assertEqual(decision['desired'], 4)
+        self.assertEqual(self.policy.evaluate(_sample(120, capacity=4, queue_depth=5))['action'], 'hold')
+        self.assertEqual(self.policy.evaluate(_sample(180, capacity=4, queue_depth=5))['action'], 'scale_out')
+
+    def test_latency_over_slo_scales_out_even_with_short_queue(self):
+        self.policy.evaluate(_sample(0, queue_depth=1, p95_latency=20))
+        decision = self.policy.evaluate(_sample(60, queue_depth=1, p95_latency=20))
+        self.assertEqual((decision['action'], decision['desired']), ('scale_out', 3))
+
+    def test_slow_p95_without_queueing_is_not_a_capacity_problem(self):
+        decisions = replay(self.policy, [_sample(t, queue_depth=0.3, p95_latency=20) for t in range(0, 600, 60)])
+        self.assertTrue(all(d['action'] == 'hold' for d in decisions))
+
+    def test_pegged_cpu_alone_does_not_scale_out(self):
+        decisions = replay(self.policy, [_sample(t, queue_depth=1, cpu_utilization=100) for t in range(0, 600, 60)])
+        self.assertTrue(all(d['action'] == 'hold' for d in decisions))
+        cpu_decisions = replay(CPUThresholdPolicy(scale_out_stable_seconds=0),
+                               [_sample(t, cpu_utilization=100) for t in range(0, 600, 60)])
+        self.assertEqual(cpu_decisions[0]['action'], 'scale_out')
+
+    def test_scale_in_has_hysteresis(self):
+        # Below the scale-out target but above the scale-in watermark: hold
+        self.assertEqual(replay(self.policy, [_sample(t, capacity=4, queue_depth=1.5)
+                                              for t in range(0, 1200, 60)])[-1]['action'], 'hold')
+        decisions = replay(self.policy, [_sample(t, capacity=4, queue_depth=0.2, tokens_per_sec=1, p95_latency=2)
+                                         for t in range(0, 1200, 60)])
+        actions = [d['action'] for d in decisions]
+        # First scale-in only after 300 s of low load, then one per 600 s cooldown
+        self.assertEqual(actions.index('scale_in'), 5)
+        self.assertEqual(actions.count('scale_in'), 2)
+        self.assertEqual(decisions[5]['desired'], 3)
+
+    def test_missing_metrics_and_pending_actions_hold(self):
+        self.assertEqual(self.policy.evaluate(_sample(0))['state'], 'unknown')
+        self.policy.evaluate(_sample(0, queue_depth=5))
+        decision = self.policy.evaluate(_sample(60, queue_depth=5, pending=True))
+        self.assertEqual(decision['action'], 'hold')
+
+
+# Monday 2024-01-01 00:00 UTC
+MONDAY = 1704067200
+
+
+def _weeks_of_traffic(weeks, base=4, peak_hour=14, peak=40):
+    """One timestamp per request: ``base`` per hour, ``peak`` at ``peak_hour`` every day."""
+    timestamps = []
+    for hour in range(weeks * 168):
+        count = peak if hour % 24 == peak_hour else base
+        start = MONDAY + hour * 3600
+        timestamps.extend(start + (i + 0.5) * 3600 / count for i in range(count))
+    return timestamps
+
+
+class TrafficForecastTests(SimpleTestCase):
+    def setUp(self):
+        self.now = MONDAY + 4 * 168 * 3600
+        self.forecaster = TrafficForecaster().fit(_weeks_of_traffic(4), self.now)
+
+    def test_hour_of_week_starts_monday(self):
+        self.assertEqual(list(hour_of_week([MONDAY, MONDAY + 3600, MONDAY - 3600])), [0, 1, 167])
+
+    def test_profile_recovers_daily_peak(self):
+        starts, expected = self.forecaster.forecast(self.now, 24)
+        self.assertEqual(int(expected.argmax()), 14)
+        self.assertAlmostEqual(expected[14], 40, delta=1)
+        self.assertAlmostEqual(self.forecaster.trend, 1.0, places=6)
+
+    def test_recent_surge_raises_near_term_forecast(self):
+        surge = [self.now - 3 * 3600 + i * 60 for i in range(3 * 60)]
+        forecaster = TrafficForecaster().fit(_weeks_of_traffic(4) + surge, self.now)
+        self.assertGreater(forecaster.trend, 1.5)
+        _, expected = forecaster.forecast(self.now, 24)
+        _, baseline = self.forecaster.forecast(self.now, 24)
+        self.assertGreater(expected[0], baseline[0])
+        # The trend fades towards the seasonal profile
+        self.assertLess(expected[23] / baseline[23], expected[0] / baseline[0])
+
+    def test_plan_covers_peak_within_cold_start(self):
+        # 13:30 Monday: the 14:00 peak is within a 45 minute cold start, not a 15 minute one
+        now = self.now + 13.5 * 3600
+        early = plan_capacity(self.forecaster, now, 900, service_seconds=120, safety_sigma=0)
+        ahead = plan_capacity(self.forecaster, now, 2700, service_seconds=120, safety_sigma=0)
+        self.assertEqual(early['capacity'], 1)
+        self.assertEqual(ahead['capacity'], 2)
+        self.assertEqual(ahead['peak_time'], self.now + 14 * 3600)
+
+    def test_apply_forecast_only_adds_capacity(self):
+        plan = {'capacity': 4, 'peak_time': self.now, 'peak_requests_per_hour': 100.0, 'lead_seconds': 600}
+        hold = {'action': 'hold', 'capacity': 2, 'desired': 2, 'reason': 'within targets'}
+        decision = apply_forecast(hold, plan, max_capacity=3)
+        self.assertEqual((decision['action'], decision['desired'], decision['predictive']), ('scale_out', 3, True))
+
+        scale_in = {'action': 'scale_in', 'capacity': 4, 'desired': 3, 'reason': 'low load'}
+        decision = apply_forecast(scale_in, plan)
+        self.assertEqual((decision['action'], decision['desired']), ('hold', 4))
+
+        scale_out = {'action': 'scale_out', 'capacity': 4, 'desired': 6, 'reason': 'queue depth'}
+        self.assertIs(apply_forecast(scale_out, plan), scale_out)
+
+
+class AdmissionControlTests(SimpleTestCase):
+    def setUp(self):
+        self.controller = AdmissionController(slots=1, max_queue=4, max_queued_per_user=2, max_wait=100,
+                                              queue_timeout=5, service_seconds=10)
+
+    def test_free_slot_admits_immediately(self):
+        self.assertEqual(self.controller.estimate_wait('a'), 0)
+        with self.controller.acquire('a'):
+            self.assertEqual(self.controller.stats()['in_flight'], 1)
+            self.assertEqual(self.controller.estimate_wait('b'), 10)
+        self.assertEqual(self.controller.stats()['in_flight'], 0)
+
+    def test_waiting_users_are_served_round_robin(self):
+        served = []
+        held = self.controller.acquire('busy')
+        threads = []
+        for user in ('a', 'a', 'b'):
+            before = self.controller.stats()['waiting']
+            thread = threading.Thread(target=lambda u=user: self._run(u, served), daemon=True)
+            thread.start()
+            self.assertTrue(_wait_for(lambda: self.controller.stats()['waiting'] == before + 1))
+            threads.append(thread)
+        # A new user waits one turn behind each waiting user, not behind every request
+        self.assertEqual(self.controller.estimate_wait('c'), 30)
+        self.assertEqual(self.controller.estimate_wait('b'), 40)
+        held.release()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(served, ['a', 'b', 'a'])
+
+    def _run(self, user, served):
+        with self.controller.acquire(user):
+            served.append(user)
+
+    def test_sheds_with_retry_after(self):
+        held = self.controller.acquire('busy')
+        for _ in range(2):
+            threading.Thread(target=self._run, args=('a', []), daemon=True).start()
+        self.assertTrue(_wait_for(lambda: self.controller.stats()['waiting'] == 2))
+        with self.assertRaises(AdmissionRejected) as raised:
+            self.controller.acquire('a')
+        self.assertEqual((raised.exception.status, raised.exception.reason), (429, 'user_limit'))
+
+        self.controller.max_wait = 15
+        with self.assertRaises(AdmissionRejected) as raised:
+            self.controller.acquire('b')
+        self.assertEqual((raised.exception.status, raised.exception.reason), (503, 'wait_too_long'))
+        self.assertEqual(raised.exception.retry_after, 10)
+        held.release()
+        self.assertTrue(_wait_for(lambda: self.controller.stats()['in_flight'] == 0))
+        self.assertEqual(self.controller.stats()['shed'], {'user_limit': 1, 'queue_full': 0,
+                                                         'wait_too_long': 1, 'timed_out': 0})
+
+    def test_async_waiters_hold_no_thread_and_leave_on_cancel(self):
+        async def scenario():
+            held = await self.controller.acquire_async('busy')
+            waiter = asyncio.ensure_future(self.controller.acquire_async('a'))
+            cancelled = asyncio.ensure_future(self.controller.acquire_async('b'))
+            await asyncio.sleep(0.01)
+            self.assertEqual(self.controller.stats()['waiting'], 2)
+            cancelled.cancel()
+            await asyncio.sleep(0.01)
+            self.assertEqual(self.controller.stats()['waiting'], 1)
+            # Released from another thread, as the inference executor does
+            threading.Thread(target=held.release).start()
+            admission = await asyncio.wait_for(waiter, 1)
+            self.assertEqual(self.controller.stats()['in_flight'], 1)
+            admission.release()
+
+        asyncio.run(scenario())
+        self.assertEqual(self.controller.stats()['in_flight'], 0)
+
+    def test_queued_request_times_out(self):
+        self.controller.queue_timeout = 0.05
+        with self.controller.acquire('busy'):
+            with self.assertRaises(AdmissionRejected) as raised:
+                self.controller.acquire('a')
+            self.assertEqual(raised.exception.reason, 'timed_out')
+            self.assertEqual(self.controller.stats()['waiting'], 0)
+        self.assertEqual(self.controller.stats()['in_flight'], 0)
+
+
+class TokenBucketTests(SimpleTestCase):
+    def setUp(self):
+        self.clock = [1000.0]
+        patcher = mock.patch('api.rate_limit.time.monotonic', side_effect=lambda: self.clock[0])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # 600 tokens/minute = 10 per second, bucket of 1000
+        self.limiter = TokenBucketLimiter(LocalTokenBuckets(), tokens_per_minute=600, burst_tokens=1000)
+
+    def test_reservation_refunds_unused_tokens(self):
+        reservation = self.limiter.reserve('alice', 800)
+        with self.assertRaises(RateLimited) as raised:
+            self.limiter.reserve('alice', 800)
+        self.assertEqual(raised.exception.retry_after, 60)
+        # Only 300 of the 800 were used
+        reservation.settle(300)
+        self.limiter.reserve('alice', 700)
+        # Other users have their own bucket
+        self.limiter.reserve('bob', 1000)
+
+    def test_bucket_refills_over_time(self):
+        self.limiter.reserve('alice', 1000)
+        self.assertRaises(RateLimited, self.limiter.check, 'alice', 100)
+        self.clock[0] += 10
+        self.limiter.check('alice', 100)
+        self.limiter.reserve('alice', 100)
+        self.assertRaises(RateLimited, self.limiter.reserve, 'alice', 100)
+
+    def test_overrun_puts_bucket_in_debt(self):
+        self.limiter.reserve('alice', 500).settle(1500)
+        with self.assertRaises(RateLimited) as raised:
+            self.limiter.check('alice', 1)
+        self.assertEqual(raised.exception.retry_after, 51)
+        # A request bigger than the bucket waits for a full bucket, then pays in full
+        self.clock[0] += 150
+        self.limiter.reserve('alice', 1200)
+        self.clock[0] += 100
+        self.assertRaises(RateLimited, self.limiter.reserve, 'alice', 900)
+        self.assertEqual(self.limiter.stats()['overrun_tokens'], 1000)
+
+
+class CancellationTests(SimpleTestCase):
+    def tearDown(self):
+        cache.clear()
+
+    def test_deadline_sets_token(self):
+        token = CancelToken(timeout=0.05)
+        self.assertFalse(token.is_set())
+        time.sleep(0.06)
+        self.assertTrue(token.is_set())
+        self.assertEqual(token.reason, 'deadline')
+
+    def test_cancel_request_reaches_local_and_other_workers(self):
+        with cancellable_generation(7, 'chat-a', timeout=None) as local:
+            # Same key, but not registered here: stands in for another worker's generation
+            remote = CancelToken('7:chat-a')
+            other_session = CancelToken('7:chat-b')
+            self.assertTrue(request_cancel(7, 'chat-a'))
+            self.assertTrue(local.is_set())
+            self.assertTrue(remote.is_set())
+            self.assertFalse(other_session.is_set())
+        self.assertEqual(remote.reason, 'client')
+        # A generation started after the cancel is not affected by it
+        with cancellable_generation(7, 'chat-a', timeout=None) as later:
+            self.assertFalse(later.is_set())
+        self.assertFalse(request_cancel(7, 'chat-a'))
+
+    def test_disconnect_is_detected_on_the_socket(self):
+        server, client = socket.socketpair()
+        try:
+            token = CancelToken(connection=server)
+            client.sendall(b'keep-alive')
+            self.assertFalse(token.is_set())
+            self.assertFalse(client_disconnected(server))
+            server.recv(64)
+            client.close()
+            # Polled at most every CANCEL_CHECK_INTERVAL
+            token._next_check = 0.0
+            self.assertTrue(token.is_set())
+            self.assertEqual(token.reason, 'disconnect')
+        finally:
+            server.close()
+
+
+class TokenBudgetTests(SimpleTestCase):
+    def setUp(self):
+        self.estimator = TokenBudgetEstimator(max_tokens=2000, percentile=95, headroom=1.25, min_tokens=256,
+                                              min_samples=10, window=50)
+
+    def test_full_budget_until_enough_samples(self):
+        for _ in range(9):
+            self.estimator.record('GPT4 Correct', 10, 100)
+        self.assertEqual(self.estimator.budget('GPT4 Correct', 10), 2000)
+        self.estimator.record('GPT4 Correct', 10, 100)
+        # 100 * 1.25, raised to the minimum budget
+        self.assertEqual(self.estimator.budget('GPT4 Correct', 10), 256)
+        self.assertEqual(self.estimator.budget('Math Correct', 10), 2000)
+
+    def test_budget_follows_group_then_mode(self):
+        for _ in range(20):
+            self.estimator.record('Math Correct', 10, 800)
+            self.estimator.record('Math Correct', 300, 1200)
+        self.assertEqual(input_length_group(10), '<=32')
+        self.assertEqual(input_length_group(300), '<=512')
+        self.assertEqual(self.estimator.budget('Math Correct', 10), 1000)
+        self.assertEqual(self.estimator.budget('Math Correct', 300), 1500)
+        # No samples for long inputs yet: the mode's histogram, capped at max_tokens
+        self.assertEqual(self.estimator.budget('Math Correct', 1000), 1500)
+
+    def test_running_window_forgets_old_answers(self):
+        for _ in range(100):
+            self.estimator.record('GPT4 Correct', 10, 1000, hit_cap=True)
+        for _ in range(100):
+            self.estimator.record('GPT4 Correct', 10, 300)
+        self.assertEqual(self.estimator.budget('GPT4 Correct', 10), 375)
+        group = self.estimator.stats()['groups']['GPT4 Correct <=32']
+        self.assertEqual(group['samples'], 100)
+        self.assertEqual(group['cap_hit_rate'], 0.5)
+
+    def test_rate_limit_pre_check_uses_the_budget(self):
+        for _ in range(10):
+            self.estimator.record('Math Correct', 10, 100)
+            self.estimator.record('GPT4 Correct', 10, 400)
+        message = 'x' * 40  # about 11 tokens
+        with mock.patch.object(llm_handler, 'token_budget', self.estimator):
+            self.assertEqual(estimate_generation_tokens(message, 'math'), 11 + 256)
+            # "auto" is checked against the larger budget of the two modes
+            self.assertEqual(estimate_generation_tokens(message, 'auto'), 11 + 500)
+            self.assertEqual(estimate_generation_tokens('x' * 4000, 'default'), 1001 + 500)
+
+
+class LatencyHistogramTests(SimpleTestCase):
+    def test_buckets_are_contiguous_and_cover_their_values(self):
+        for index in range(1, BUCKET_COUNT):
+            self.assertEqual(_bucket_index(_bucket_upper_bound(index - 1) + 1), index)
+        for value in list(range(0, 5000)) + [MAX_TRACKABLE_MS]:
+            index = _bucket_index(value)
+            self.assertLessEqual(value, _bucket_upper_bound(index))
+            self.assertEqual(_bucket_index(_bucket_upper_bound(index)), index)
+            # Bucket width is at most 1/16 of the values it holds
+            lower = _bucket_upper_bound(index - 1) + 1 if index else 0
+            self.assertLessEqual(_bucket_upper_bound(index) + 1 - lower, max(1, lower / 16))
+
+    def test_percentile_error_is_bounded(self):
+        rng = random.Random(7)
+        values = [rng.lognormvariate(6, 1.5) for _ in range(5000)]
+        histogram = LatencyHistogram()
+        for value in values:
+            histogram.record(value)
+        ordered = sorted(int(value) for value in values)
+        for percent in (1, 10, 50, 90, 99, 99.9):
+            exact = ordered[max(1, int(-(-len(ordered) * percent // 100))) - 1]
+            reported = histogram.percentile(percent)
+            self.assertGreaterEqual(reported, exact)
+            self.assertLessEqual(reported, max(exact + 1, exact * (1 + 1 / 16)))
+        self.assertEqual(histogram.percentile(100), max(values))
+
+    def test_merge_and_encoding_round_trip(self):
+        first, second, both = LatencyHistogram(), LatencyHistogram(), LatencyHistogram()
+        for value in range(0, 3000, 7):
+            first.record(value)
+            both.record(value)
+        for value in (5, 50, 500, 50000):
+            second.record(value)
+            both.record(value)
+        first.merge(second)
+        self.assertEqual(list(first.counts), list(both.counts))
+        self.assertEqual((first.count, first.min_ms, first.max_ms), (both.count, both.min_ms, both.max_ms))
+        self.assertAlmostEqual(first.total_ms, both.total_ms)
+
+        decoded = LatencyHistogram.from_dict(json.loads(json.dumps(first.to_dict())))
+        self.assertEqual(list(decoded.counts), list(first.counts))
+        self.assertEqual(decoded.summary(), first.summary())
+        self.assertEqual(LatencyHistogram.from_dict(None).count, 0)
+
+
+class MetricsExpositionTests(SimpleTestCase):
+    def test_process_local_cache_labels_every_series_with_pid(self):
+        self.assertFalse(shared_cache_configured())
+        body = render_openmetrics()
+        self.assertIn(f'llm_requests_total{{pid="{os.getpid()}"}} ', body)
+        self.assertTrue(body.endswith("# EOF\n"))
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+                                           'LOCATION': 'redis://127.0.0.1:6379'}})
+    def test_shared_cache_is_detected(self):
+        self.assertTrue(shared_cache_configured())
+
+
+class ResultRegistryTests(SimpleTestCase):
+    def setUp(self):
+        self.clock = [1000.0]
+        patcher = mock.patch('api.distributed_inference.time')
+        patcher.start().time.side_effect = lambda: self.clock[0]
+        self.addCleanup(patcher.stop)
+        self.registry = ResultRegistry(ttl=10)
+
+    def test_entries_expire_through_the_heap(self):
+        first = self.registry.register('a')
+        self.registry.register('b')
+        self.clock[0] += 5
+        # Completing restarts the TTL; the old heap entry for 'a' goes stale
+        self.registry.complete('a', first, {'response': 'ok'})
+        self.clock[0] += 6
+        self.assertIsNone(self.registry.get('b'))
+        self.registry.register('c')
+        self.assertEqual(len(self.registry), 2)
+        self.assertIs(self.registry.get('a'), first)
+        self.clock[0] += 10
+        self.registry.register('d')
+        self.assertEqual(len(self.registry), 1)
+        self.assertIsNone(self.registry.get('a'))
+
+    def test_completion_wakes_waiter(self):
+        future = self.registry.register('a')
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(future.result(timeout=5)))
+        waiter.start()
+        self.registry.complete('a', future, {'response': 'ok'})
+        waiter.join(5)
+        self.assertEqual(results, [{'response': 'ok'}])
+        self.assertTrue(self.registry.get('a').done())
+
+    def test_late_completion_after_expiry_is_dropped(self):
+        future = self.registry.register('a')
+        self.clock[0] += 11
+        self.registry.complete('a', future, {'response': 'late'})
+        self.assertIsNone(self.registry.get('a'))
+        self.assertEqual(len(self.registry), 0)
+
+
+class DistributedDispatchTests(SimpleTestCase):
+    def setUp(self):
+        self.nodes = [{'id': 'a', 'url': 'http://a'}, {'id': 'b', 'url': 'http://b'}]
+        self.clock = [0.0]
+        self.balancer = LoadBalancer(failure_threshold=1, open_cooldown=10, clock=lambda: self.clock[0])
+        for name, value in (('balancer', self.balancer), ('node_slots', NodeSlots()),
+                            ('_get_inference_nodes', lambda: self.nodes)):
+            patcher = mock.patch.object(distributed_inference, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _half_open(self, key):
+        # One failure opens the circuit; after the cooldown it takes a single probe
+        self.balancer.finish(key, 1.0, False)
+        self.clock[0] += 10
+
+    def _assert_available(self, node):
+        self.assertEqual(self.balancer.choose([node], key=node_key), [node])
+
+    def test_unused_critical_alternate_is_not_held_as_probe(self):
+        self._half_open('b')
+        with mock.patch.object(distributed_inference, '_do_remote_inference', return_value={'response': 'ok'}):
+            result = distributed_inference._run_request({'data': {'input': 'hi'}, 'request_type': 'critical'})
+        self.assertEqual(result, {'response': 'ok'})
+        # The primary answered before the hedge delay, so 'b' was never picked
+        self._assert_available(self.nodes[1])
+
+    def test_cancelled_hedge_releases_half_open_node(self):
+        self._half_open('b')
+        policy = HedgePolicy(budget_percent=100, min_samples=1)
+        policy.record(0.02)
+
+        def remote(node, request_data):
+            time.sleep(0.2)
+            return {'response': node['id']}
+
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+
+        started = []
+        queued = []
+
+        def submit(fn, *args):
+            # The primary runs; the hedge to 'b' stays queued as if every fan-out thread were busy
+            if started:
+                queued.append(Future())
+                return queued[-1]
+            started.append(fn)
+            return executor.submit(fn, *args)
+
+        with mock.patch.object(distributed_inference, 'hedge_policy', policy), \
+                mock.patch.object(distributed_inference.fanout_executor, 'submit', side_effect=submit), \
+                mock.patch.object(distributed_inference, '_do_remote_inference', side_effect=remote):
+            result = distributed_inference._run_hedged(
+                self.nodes[0], {'input': 'hi'}, lambda: distributed_inference._hedge_target(self.nodes[0], None)
+            )
+        self.assertEqual(result, {'response': 'a'})
+        self.assertEqual(policy.stats()['hedges_sent'], 1)
+        self.assertTrue(queued[0].cancelled())
+        self._assert_available(self.nodes[1])
+
+
+class HashRingTests(SimpleTestCase):
+    def setUp(self):
+        self.sessions = [f"session-{i}" for i in range(10000)]
+
+    def test_adding_a_node_moves_about_one_in_n_plus_one_sessions(self):
+        ring = HashRing([f"node-{i}" for i in range(4)])
+        before = {session: ring.get_node(session) for session in self.sessions}
+        ring.add_node("node-4")
+        moved = [session for session in self.sessions if ring.get_node(session) != before[session]]
+        self.assertAlmostEqual(len(moved) / len(self.sessions), 1 / 5, delta=0.05)
+        # Only the new node takes sessions over; nothing moves between the old ones
+        self.assertEqual({ring.get_node(session) for session in moved}, {"node-4"})
+
+    def test_first_available_falls_through_ring_successors(self):
+        ring = HashRing([f"node-{i}" for i in range(5)])
+        balancer = LoadBalancer(failure_threshold=1, open_cooldown=30, clock=lambda: 0.0)
+        preference = ring.get_nodes("session-42")
+        self.assertEqual(len(preference), 5)
+        self.assertEqual(balancer.first_available(preference), preference[0])
+        for node_id in preference[:2]:
+            balancer.finish(node_id, 1.0, False)
+        self.assertEqual(balancer.first_available(preference), preference[2])
+        for node_id in preference[2:]:
+            balancer.finish(node_id, 1.0, False)
+        self.assertIsNone(balancer.first_available(preference))
+
+
+class _TokenUser:
+    pk = id = 7
+    is_authenticated = True
+
+
+class WebSocketChatTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        token = AccessToken()
+        token['user_id'] = _TokenUser.pk
+        self.token = str(token)
+        self.controller = AdmissionController(slots=1, max_queue=4, max_queued_per_user=2, max_wait=100,
+                                              queue_timeout=5, service_seconds=10)
+        self.saved_count = 0
+        self.chat = self._patch('Chat')
+        self.chat.objects.filter.return_value.acount = mock.AsyncMock(side_effect=lambda: self.saved_count)
+        self.chat.objects.acreate = mock.AsyncMock()
+        self.generate = self._patch('generate_response', side_effect=self._generate)
+        self._patch('load_history_from_database')
+        self.get_rate_limiter = self._patch('get_rate_limiter', return_value=None)
+        self._patch('acquire_generation_slot_async', side_effect=self.controller.acquire_async)
+        patcher = mock.patch.object(websocket.JWTAuthentication, 'get_user', return_value=_TokenUser())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.wait_for_cancel = False
+
+    def _patch(self, name, **kwargs):
+        patcher = mock.patch.object(websocket, name, **kwargs)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def _generate(self, message, chat_session, model_mode, rate_limit_key, on_token, cancel_event):
+        on_token('Hel')
+        if self.wait_for_cancel:
+            _wait_for(cancel_event.is_set)
+            return {'response': 'Hel', 'mode': 'default', 'is_automatic': True, 'cancelled': True}
+        on_token('lo')
+        return {'response': 'Hello', 'mode': 'default', 'is_automatic': True}
+
+    async def _connect(self, path='/api/ws/chat/s1/', token=None):
+        communicator = ApplicationCommunicator(websocket.websocket_application, {
+            'type': 'websocket', 'path': path, 'query_string': f"token={token or self.token}".encode(),
+        })
+        await communicator.send_input({'type': 'websocket.connect'})
+        return communicator
+
+    async def _open(self):
+        communicator = await self._connect()
+        self.assertEqual(await communicator.receive_output(2), {'type': 'websocket.accept'})
+        self.assertEqual((await self._frame(communicator))['type'], 'ready')
+        return communicator
+
+    async def _send(self, communicator, **frame):
+        await communicator.send_input({'type': 'websocket.receive', 'text': json.dumps(frame)})
+
+    async def _frame(self, communicator):
+        return json.loads((await communicator.receive_output(2))['text'])
+
+    async def _close(self, communicator):
+        await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await communicator.wait(2)
+
+    async def test_connect_requires_a_valid_token_and_chat_path(self):
+        communicator = await self._connect(token='not-a-jwt')
+        self.assertEqual(await communicator.receive_output(2), {'type': 'websocket.close', 'code': 4401})
+        communicator = await self._connect(path='/api/ws/other/')
+        self.assertEqual(await communicator.receive_output(2), {'type': 'websocket.close', 'code': 4404})
+
+    async def test_turn_streams_tokens_then_done_and_saves_it(self):
+        communicator = await self._open()
+        await self._send(communicator, type='message', message='hi')
+        text = ''
+        frame = await self._frame(communicator)
+        while frame['type'] == 'token':
+            text += frame['text']
+            frame = await self._frame(communicator)
+        self.assertEqual(text, 'Hello')
+        self.assertEqual(frame['type'], 'done')
+        self.assertEqual(frame['response'], 'Hello')
+        self.assertFalse(frame['cancelled'])
+        self.assertEqual(frame['remaining_messages'], 4)
+        self.chat.objects.acreate.assert_awaited_once()
+        self.assertEqual(self.controller.stats()['in_flight'], 0)
+        await self._close(communicator)
+
+    async def test_rate_limited_turn_gets_an_error_frame(self):
+        self.get_rate_limiter.return_value = mock.Mock(**{'check.side_effect': RateLimited(12, 500, 40)})
+        communicator = await self._open()
+        await self._send(communicator, type='message', message='hi')
+        frame = await self._frame(communicator)
+        self.assertEqual(frame['type'], 'error')
+        self.assertTrue(frame['rate_limited'])
+        self.assertEqual(frame['retry_after'], 12)
+        self.generate.assert_not_called()
+        await self._close(communicator)
+
+    async def test_chat_limit_is_recounted_before_each_turn(self):
+        communicator = await self._open()
+        # Messages posted over HTTP on the same session count against the limit
+        self.saved_count = 5
+        await self._send(communicator, type='message', message='hi')
+        frame = await self._frame(communicator)
+        self.assertEqual(frame['type'], 'error')
+        self.assertTrue(frame['limit_reached'])
+        self.generate.assert_not_called()
+        await self._close(communicator)
+
+    async def test_cancel_while_queued_leaves_the_queue(self):
+        held = self.controller.acquire('busy')
+        communicator = await self._open()
+        await self._send(communicator, type='message', message='hi')
+        while self.controller.stats()['waiting'] == 0:
+            await asyncio.sleep(0.01)
+        await self._send(communicator, type='cancel')
+        frame = await self._frame(communicator)
+        self.assertEqual(frame['type'], 'done')
+        self.assertTrue(frame['cancelled'])
+        self.assertEqual(frame['response'], '')
+        self.assertEqual(self.controller.stats()['waiting'], 0)
+        self.generate.assert_not_called()
+        self.chat.objects.acreate.assert_not_awaited()
+        held.release()
+        await self._close(communicator)
+
+    async def test_cancel_while_decoding_keeps_the_partial_response(self):
+        self.wait_for_cancel = True
+        communicator = await self._open()
+        await self._send(communicator, type='message', message='hi')
+        self.assertEqual(await self._frame(communicator), {'type': 'token', 'text': 'Hel'})
+        await self._send(communicator, type='cancel')
+        frame = await self._frame(communicator)
+        self.assertEqual(frame['type'], 'done')
+        self.assertTrue(frame['cancelled'])
+        self.assertEqual(frame['response'], 'Hel')
+        # Past admission the turn is not cancelled, so the partial response is saved
+        self.chat.objects.acreate.assert_awaited_once()
+        self.assertEqual(self.controller.stats()['in_flight'], 0)
+        await self._close(communicator)
+
+    async def test_bad_frames_get_error_frames(self):
+        communicator = await self._open()
+        await communicator.send_input({'type': 'websocket.receive', 'text': '{not json'})
+        self.assertEqual((await self._frame(communicator))['error'], 'Invalid JSON frame')
+        await self._send(communicator, type='message', message='')
+        self.assertEqual((await self._frame(communicator))['error'], 'Message is required')
+        await self._close(communicator)
+
+
+class _FakeProvider:
+    def __init__(self, *results):
+        self.results = list(results)
+        self.calls = 0
+
+    def discover(self):
+        self.calls += 1
+        result = self.results[min(self.calls, len(self.results)) - 1]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+class ServiceDiscoveryTests(SimpleTestCase):
+    def setUp(self):
+        self.a, self.b, self.c = (make_node(name, f"10.0.0.{i}", 8000) for i, name in enumerate('abc', 1))
+
+    def test_failed_refresh_keeps_the_stale_table(self):
+        discovery = NodeDiscovery(_FakeProvider([self.a, self.b], ConnectionError("Cloud Map unreachable")))
+        self.assertTrue(discovery.refresh())
+        self.assertFalse(discovery.refresh())
+        self.assertEqual(discovery.nodes, [self.a, self.b])
+        self.assertEqual(discovery.stats()['consecutive_failures'], 1)
+        self.assertIn('unreachable', discovery.stats()['last_error'])
+
+    def test_readers_only_see_complete_tables(self):
+        small, large = [self.a], [self.a, self.b, self.c]
+        provider = _FakeProvider(small)
+        discovery = NodeDiscovery(provider)
+        discovery.refresh()
+        seen = set()
+        stop = threading.Event()
+
+        def read():
+            while not stop.is_set():
+                seen.add(tuple(node['id'] for node in discovery.nodes))
+        reader = threading.Thread(target=read, daemon=True)
+        reader.start()
+        for i in range(2000):
+            provider.results = [large if i % 2 else small]
+            provider.calls = 0
+            discovery.refresh()
+        stop.set()
+        reader.join(5)
+        self.assertLessEqual(seen, {('a',), ('a', 'b', 'c')})
+
+    def test_membership_changes_reach_listeners_and_balancer_once(self):
+        provider = _FakeProvider([self.a, self.b], [self.a, self.b], [self.b, self.c])
+        discovery = NodeDiscovery(provider)
+        events = []
+        discovery.add_listener(lambda joined, left, nodes: events.append(
+            ([n['id'] for n in joined], [n['id'] for n in left], [n['id'] for n in nodes])
+        ))
+        balancer = mock.Mock(wraps=LoadBalancer())
+        with mock.patch.object(distributed_inference, 'balancer', balancer), \
+                mock.patch.object(distributed_inference, 'hash_ring', HashRing()):
+            discovery.add_listener(distributed_inference._on_nodes_changed)
+            for _ in range(3):
+                discovery.refresh()
+            self.assertEqual(sorted(distributed_inference.hash_ring.get_nodes('session-1')), ['b', 'c'])
+        # The unchanged second refresh notifies nobody
+        self.assertEqual(events, [(['a', 'b'], [], ['a', 'b']), (['c'], ['a'], ['b', 'c'])])
+        self.assertEqual(sorted(call.args[0] for call in balancer.forget.call_args_list), ['a', 'a', 'b', 'c'])
+
+    def test_static_node_formats(self):
+        nodes = StaticDiscovery(nodes=" 10.0.0.1:9000, http://10.0.0.2/ ,").discover()
+        self.assertEqual([(n['id'], n['url']) for n in nodes], [
+            ('10.0.0.1:9000', 'http://10.0.0.1:9000/api/inference/'),
+            ('10.0.0.2:8000', 'http://10.0.0.2:8000/api/inference/'),
+        ])
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+            json.dump(["10.0.0.3:9001", {"id": "gpu-1", "ip": "10.0.0.4", "port": 9002}, {"ip": "10.0.0.5"}], f)
+        self.addCleanup(os.remove, f.name)
+        nodes = StaticDiscovery(nodes="10.0.0.1:9000", path=f.name).discover()
+        self.assertEqual([(n['id'], n['ip'], n['port']) for n in nodes], [
+            ('10.0.0.3:9001', '10.0.0.3', '9001'), ('gpu-1', '10.0.0.4', '9002'), ('10.0.0.5:8000', '10.0.0.5', '8000'),
+        ])
+
+    @override_settings(INFERENCE_NODES=None, INFERENCE_NODES_FILE=None, SERVICE_DISCOVERY_NAME=None)
+    def test_provider_from_environment(self):
+        with mock.patch.dict(os.environ, {'INFERENCE_NODES': '10.0.0.1:9000,10.0.0.2:9000'}):
+            provider = get_discovery_provider()
+        self.assertIsInstance(provider, StaticDiscovery)
+        self.assertEqual([n['id'] for n in provider.discover()], ['10.0.0.1:9000', '10.0.0.2:9000'])
+        with mock.patch.dict(os.environ, {}, clear=True):
+            self.assertIsNone(get_discovery_provider())
+
+    def test_refresh_thread_starts_once_and_stops(self):
+        provider = _FakeProvider([self.a])
+        discovery = NodeDiscovery(provider, interval=60)
+        discovery.start()
+        thread = discovery._thread
+        discovery.start()
+        self.assertIs(discovery._thread, thread)
+        self.assertTrue(_wait_for(lambda: discovery.nodes == [self.a]))
+        discovery.stop()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(provider.calls, 1)
+
+
+def _node_response(status=200, headers=None, chunks=()):
+    response = mock.Mock(status=status, headers=headers or {}, data=b'{}')
+    response.stream.return_value = iter(chunks)
+    return response
+
+
+class NodeHTTPClientTests(SimpleTestCase):
+    def setUp(self):
+        self.client = NodeHTTPClient(max_retries=2)
+        self.client.pool = mock.Mock(headers={'Content-Type': 'application/json', 'Authorization': 'Bearer peer'}, pools={})
+        patcher = mock.patch.object(node_client.time, 'sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _respond(self, *outcomes):
+        self.client.pool.request.side_effect = list(outcomes)
+
+    def test_caller_headers_are_merged_with_pool_defaults(self):
+        self._respond(_node_response())
+        self.client.request('POST', 'http://node/', headers={'X-Request-Id': '1'})
+        self.assertEqual(self.client.pool.request.call_args.kwargs['headers'], {
+            'Content-Type': 'application/json', 'Authorization': 'Bearer peer', 'X-Request-Id': '1',
+        })
+
+    def test_connect_failure_is_retried(self):
+        refused = NewConnectionError(None, "connection refused")
+        self._respond(refused, MaxRetryError(None, 'http://node/', refused), _node_response())
+        self.assertEqual(self.client.request('POST', 'http://node/').status, 200)
+        self.assertEqual(self.client.get_stats()['retries'], 2)
+
+    def test_read_timeout_is_retried_only_when_idempotent(self):
+        timeout = ReadTimeoutError(None, 'http://node/', "read timed out")
+        self._respond(timeout)
+        with self.assertRaises(ReadTimeoutError):
+            self.client.request('POST', 'http://node/')
+        self.assertEqual(self.client.pool.request.call_count, 1)
+        self._respond(timeout, _node_response())
+        self.assertEqual(self.client.request('POST', 'http://node/', idempotent=True).status, 200)
+
+    def test_gateway_errors_are_retried_only_when_idempotent(self):
+        self._respond(_node_response(502))
+        self.assertEqual(self.client.request('POST', 'http://node/').status, 502)
+        self._respond(_node_response(504), _node_response())
+        self.assertEqual(self.client.request('POST', 'http://node/', idempotent=True).status, 200)
+        self._respond(_node_response(500))
+        self.assertEqual(self.client.request('POST', 'http://node/', idempotent=True).status, 500)
+
+    def test_shed_responses_wait_for_retry_after(self):
+        self._respond(_node_response(429, {'Retry-After': '1.5'}), _node_response(503), _node_response())
+        self.assertEqual(self.client.request('POST', 'http://node/').status, 200)
+        first_delay = self.sleep.call_args_list[0].args[0]
+        self.assertEqual(first_delay, 1.5)
+
+    def test_retries_stop_after_max_retries(self):
+        self._respond(*[_node_response(503) for _ in range(4)])
+        self.assertEqual(self.client.request('POST', 'http://node/').status, 503)
+        self.assertEqual(self.client.pool.request.call_count, 3)
+        self._respond(*[NewConnectionError(None, "connection refused") for _ in range(4)])
+        with self.assertRaises(NewConnectionError):
+            self.client.request('POST', 'http://node/')
+        self.assertEqual(self.client.get_stats()['failures'], 1)
+
+    def test_stream_returns_connection_only_when_body_is_read(self):
+        response = _node_response(chunks=[b'a', b'b'])
+        self._respond(response)
+        self.assertEqual(list(self.client.stream('http://node/', {})), [b'a', b'b'])
+        response.release_conn.assert_called_once()
+        response.close.assert_not_called()
+
+        response = _node_response(chunks=[b'a', b'b'])
+        self._respond(response)
+        chunks = self.client.stream('http://node/', {})
+        self.assertEqual(next(chunks), b'a')
+        chunks.close()
+        # Unread data is left on the socket, so the connection is not reused
+        response.close.assert_called_once()
+        response.release_conn.assert_not_called()
+
+
+class AsyncChatViewTests(SimpleTestCase):
+    def setUp(self):
+        self.controller = AdmissionController(slots=1, max_queue=4, max_queued_per_user=2, max_wait=100,
+                                              queue_timeout=5, service_seconds=10)
+        self.chat = self._patch('Chat')
+        self.chat.objects.filter.return_value.acount = mock.AsyncMock(return_value=0)
+        self.chat.objects.acreate = mock.AsyncMock()
+        self.get_rate_limiter = self._patch('get_rate_limiter', return_value=None)
+        self.acquire = self._patch('acquire_generation_slot_async', side_effect=self.controller.acquire_async)
+        self.generate = self._patch('generate_response', side_effect=self._generate)
+        self.authenticate = mock.patch.object(views.JWTAuthentication, 'authenticate',
+                                              return_value=(_TokenUser(), None))
+        self.release_generation = threading.Event()
+        self.release_generation.set()
+        self.generation_started = threading.Event()
+
+    def _patch(self, name, **kwargs):
+        patcher = mock.patch.object(views, name, **kwargs)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def _generate(self, message, chat_session, model_mode, rate_limit_key, cancel_event):
+        self.generation_started.set()
+        self.release_generation.wait(5)
+        return {'response': f"on {threading.current_thread().name}", 'mode': 'default', 'is_automatic': True}
+
+    def _request(self, **headers):
+        return RequestFactory().post('/api/chat/async/', data=json.dumps({'message': 'hi', 'chat_session': 's1'}),
+                                     content_type='application/json', **headers)
+
+    async def _chat(self):
+        with self.authenticate:
+            return await views.async_chat(self._request())
+
+    async def test_invalid_jwt_is_rejected(self):
+        response = await views.async_chat(self._request(HTTP_AUTHORIZATION='Bearer not-a-jwt'))
+        self.assertEqual(response.status_code, 401)
+        self.generate.assert_not_called()
+
+    async def test_generation_runs_on_the_inference_executor(self):
+        response = await self._chat()
+        self.assertEqual(response.status_code, 200)
+        body = json.loads(response.content)
+        self.assertTrue(body['response'].startswith('on async-inference'))
+        self.assertEqual(body['remaining_messages'], 4)
+        self.chat.objects.acreate.assert_awaited_once()
+        self.assertEqual(self.controller.stats()['in_flight'], 0)
+
+    async def test_rate_limited_request_gets_429_with_retry_after(self):
+        self.get_rate_limiter.return_value = mock.Mock(**{'check.side_effect': RateLimited(12, 500, 40)})
+        response = await self._chat()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '12')
+        self.assertTrue(json.loads(response.content)['rate_limited'])
+        self.acquire.assert_not_called()
+
+    async def test_shed_request_gets_503_with_retry_after(self):
+        self.acquire.side_effect = AdmissionRejected(503, 'queue_full', 30, 45.0, "Server is busy")
+        response = await self._chat()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '30')
+        self.assertTrue(json.loads(response.content)['shed'])
+        self.generate.assert_not_called()
+
+    async def test_disconnect_releases_the_slot_when_generation_ends(self):
+        self.release_generation.clear()
+        task = asyncio.ensure_future(self._chat())
+        while not self.generation_started.is_set():
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        # The shielded generation still holds the slot until it stops
+        self.assertEqual(self.controller.stats()['in_flight'], 1)
+        self.assertTrue(self.generate.call_args.kwargs['cancel_event'].is_set())
+        self.release_generation.set()
+        for _ in range(500):
+            if self.controller.stats()['in_flight'] == 0:
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual(self.controller.stats()['in_flight'], 0)
+        self.chat.objects.acreate.assert_not_awaited()
+
+
+class RequestTraceTests(SimpleTestCase):
+    def setUp(self):
+        self.aggregator = MetricsAggregator(flush_interval=3600)
+        patcher = mock.patch.object(monitoring, '_aggregator', self.aggregator)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _summary(self, group, key):
+        return LatencyHistogram.from_dict(self.aggregator.pending()[group][key]).summary()
+
+    def test_spans_nest_and_add_up(self):
+        # trace start, generate start, db start/end, generate end, db start/end, trace end
+        clock = mock.Mock(side_effect=[100.0, 101.0, 102.0, 102.5, 104.0, 104.0, 104.25, 105.0])
+        with mock.patch.object(monitoring.time, 'time', clock):
+            with monitoring.request_trace(endpoint="chat") as trace:
+                with monitoring.trace_span("generate"):
+                    with monitoring.trace_span("db_load_history"):
+                        pass
+                # A nested trace joins the outer one instead of recording separately
+                with monitoring.request_trace(endpoint="inner") as inner:
+                    with monitoring.trace_span("db_load_history"):
+                        pass
+        self.assertIs(inner, trace)
+        self.assertEqual(trace.stages, {'generate': 3000.0, 'db_load_history': 750.0, 'total': 5000.0})
+        self.assertEqual(trace.generation_values(), {'db_ms': 750.0})
+        self.assertEqual(self._summary('stage_histograms', 'total')['count'], 1)
+
+    def test_trace_is_cleared_when_the_request_ends(self):
+        @monitoring.traced_request(endpoint="chat")
+        def failing_view():
+            self.assertIsNotNone(monitoring.get_current_trace())
+            raise ValueError("boom")
+
+        with self.assertRaises(ValueError):
+            failing_view()
+        self.assertIsNone(monitoring.get_current_trace())
+        self.assertEqual(self._summary('stage_histograms', 'total')['count'], 1)
+        # Outside a request, spans and annotations are no-ops
+        with monitoring.trace_span("generate"):
+            monitoring.annotate_trace(prompt_tokens=5)
+        self.assertNotIn('generate', self.aggregator.pending()['stage_histograms'])
+
+    def test_trace_values_feed_generation_histograms_and_token_usage(self):
+        for rate in (20.0, 40.0):
+            with monitoring.request_trace(endpoint="chat", model_name="mistral"):
+                with monitoring.trace_span("generate"):
+                    monitoring.annotate_trace(prompt_tokens=10, completion_tokens=20, decode_tokens_per_sec=rate)
+        pending = self.aggregator.pending()
+        self.assertEqual(set(pending['stage_histograms']), {'generate', 'total'})
+        rates = self._summary('generation_histograms', 'decode_tokens_per_sec')
+        self.assertEqual(rates['count'], 2)
+        self.assertEqual(rates['mean_ms'], 30.0)
+        self.assertEqual(pending['token_usage']['total'], 60)
+        self.assertEqual(pending['token_usage']['by_model'], {'mistral': 60})
+
+
+class MetricsAggregatorTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        monitoring.reset_metrics()
+        self.aggregator = MetricsAggregator(flush_interval=3600)
+
+    def _shared_totals(self):
+        return json.loads(cache.get(monitoring.METRICS_CACHE_KEY))
+
+    def _record(self, count):
+        for _ in range(count):
+            self.aggregator.record_request(0.5, model_name='mistral', endpoint='chat')
+
+    def test_concurrent_requests_are_all_flushed(self):
+        threads = [threading.Thread(target=self._record, args=(250,)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.aggregator.flush()
+        totals = self._shared_totals()
+        self.assertEqual(totals['total_requests'], 2000)
+        self.assertEqual(totals['total_latency'], 1000)
+        self.assertEqual(totals['requests_by_model'], {'mistral': 2000})
+        self.assertEqual(LatencyHistogram.from_dict(totals['latency_histograms']['endpoint:chat']).count, 2000)
+        # Shards of exited threads are dropped once drained
+        self.assertEqual(self.aggregator._shards, [])
+        self.assertEqual(self.aggregator.pending()['total_requests'], 0)
+
+    def test_failed_cache_write_is_retried_on_next_flush(self):
+        failures = []
+
+        def flaky_set(key, *args, **kwargs):
+            if key == monitoring.METRICS_CACHE_KEY and not failures:
+                failures.append(key)
+                raise ConnectionError("cache unavailable")
+            return cache.set(key, *args, **kwargs)
+
+        self._record(3)
+        with mock.patch.object(monitoring, 'cache', mock.Mock(wraps=cache, **{'set.side_effect': flaky_set})):
+            self.aggregator.flush()
+            self.assertEqual(self._shared_totals()['total_requests'], 0)
+            self.assertEqual(self.aggregator.pending()['total_requests'], 3)
+            self._record(2)
+            self.aggregator.flush()
+        self.assertEqual(self._shared_totals()['total_requests'], 5)
+        self.assertEqual(self.aggregator.pending()['total_requests'], 0)
+
+
+class ScalingManagerTests(SimpleTestCase):
+    def test_scale_checks_reuse_the_last_decision(self):
+        manager = aws_scaling.aws_scaling_manager
+        policy = mock.Mock(**{'evaluate.return_value': {
+            'action': 'scale_out', 'capacity': 2, 'desired': 3, 'reason': 'queue depth'
+        }})
+        with mock.patch.multiple(manager, policy=policy, last_decision=None, trace_file=None,
+                                 get_current_capacity=mock.DEFAULT, get_scaling_metrics=mock.DEFAULT):
+            self.assertTrue(manager.should_scale_out())
+            self.assertFalse(manager.should_scale_in())
+            self.assertTrue(manager.should_scale_out())
+            # The checks read the cached decision; only the next tick runs the policy again
+            policy.evaluate.assert_called_once()
+            manager.evaluate_scaling()
+            self.assertEqual(policy.evaluate.call_count, 2)
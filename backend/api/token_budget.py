@@ -0,0 +1,163 @@
+"""
+Token Budget Module
+
+Picks ``max_tokens`` for each generation instead of reserving the full
+GENERATION_MAX_TOKENS for every request. Whatever the budget does not
+reserve is left to the conversation history in the context window, and
+the token rate limiter reserves less up front.
+
+Requests are grouped by mode ("Math Correct" / "GPT4 Correct") and by
+input length. For each group, a running histogram of recent completion
+lengths is kept. It holds the last TOKEN_BUDGET_WINDOW to twice that many
+answers, in two LatencyHistograms that rotate. The budget is:
+
+    percentile(TOKEN_BUDGET_PERCENTILE) * TOKEN_BUDGET_HEADROOM
+
+It is clamped to [TOKEN_BUDGET_MIN_TOKENS, max_tokens]. A group with too few
+samples uses its mode's histogram; a mode without samples gets the full
+``max_tokens``.
+
+An answer that reaches its budget is not cut off. ``generate_response``
+continues it up to the hard limit, so the histograms still see true
+lengths. Cap hits are counted per group and in the aggregated metrics.
+"""
+
+import bisect
+import math
+import threading
+from django.conf import settings
+
+from .latency_histogram import LatencyHistogram
+
+TOKEN_BUDGET_ENABLED = getattr(settings, 'TOKEN_BUDGET_ENABLED', True)
+TOKEN_BUDGET_PERCENTILE = getattr(settings, 'TOKEN_BUDGET_PERCENTILE', 95)
+TOKEN_BUDGET_HEADROOM = getattr(settings, 'TOKEN_BUDGET_HEADROOM', 1.25)
+TOKEN_BUDGET_MIN_TOKENS = getattr(settings, 'TOKEN_BUDGET_MIN_TOKENS', 256)
+TOKEN_BUDGET_MIN_SAMPLES = getattr(settings, 'TOKEN_BUDGET_MIN_SAMPLES', 20)
+TOKEN_BUDGET_WINDOW = getattr(settings, 'TOKEN_BUDGET_WINDOW', 500)  # answers per histogram generation
+
+# Upper bounds (user input tokens) of the input length groups; the last group is open-ended
+INPUT_LENGTH_BOUNDS = (32, 128, 512)
+
+
+def input_length_group(input_tokens):
+    """Label of the input length group, e.g. "<=32" or ">512"."""
+    index = bisect.bisect_left(INPUT_LENGTH_BOUNDS, input_tokens)
+    if index == len(INPUT_LENGTH_BOUNDS):
+        return f">{INPUT_LENGTH_BOUNDS[-1]}"
+    return f"<={INPUT_LENGTH_BOUNDS[index]}"
+
+
+class RunningHistogram:
+    """
+    Histogram of the most recent ``window`` to ``2 * window`` values.
+
+    Two generations of LatencyHistogram: once the current one holds
+    ``window`` values it becomes the previous one, and the old previous
+    one is dropped.
+    """
+
+    def __init__(self, window=TOKEN_BUDGET_WINDOW):
+        self.window = window
+        self.current = LatencyHistogram()
+        self.previous = LatencyHistogram()
+        self.cap_hits = 0
+        self.total = 0
+
+    def record(self, value, hit_cap=False):
+        if self.current.count >= self.window:
+            self.previous, self.current = self.current, LatencyHistogram()
+        self.current.record(value)
+        self.total += 1
+        self.cap_hits += bool(hit_cap)
+
+    @property
+    def count(self):
+        return self.current.count + self.previous.count
+
+    def merged(self):
+        histogram = LatencyHistogram()
+        histogram.merge(self.previous)
+        histogram.merge(self.current)
+        return histogram
+
+
+class TokenBudgetEstimator:
+    """
+    Estimates ``max_tokens`` from mode, input length and past completion lengths.
+
+    Args:
+        max_tokens: Hard upper bound of any budget
+        percentile: Completion length percentile the budget covers
+        headroom: Factor applied on top of the percentile
+        min_tokens: Lower bound of any budget
+        min_samples: Samples a group needs before its own histogram is used
+        window: Running histogram window (answers)
+    """
+
+    def __init__(self, max_tokens, percentile=TOKEN_BUDGET_PERCENTILE, headroom=TOKEN_BUDGET_HEADROOM,
+                 min_tokens=TOKEN_BUDGET_MIN_TOKENS, min_samples=TOKEN_BUDGET_MIN_SAMPLES,
+                 window=TOKEN_BUDGET_WINDOW, enabled=TOKEN_BUDGET_ENABLED):
+        self.max_tokens = max_tokens
+        self.percentile = percentile
+        self.headroom = headroom
+        self.min_tokens = min(min_tokens, max_tokens)
+        self.min_samples = min_samples
+        self.window = window
+        self.enabled = enabled
+        self._groups = {}  # (mode, input length group) -> RunningHistogram
+        self._modes = {}  # mode -> RunningHistogram over all input lengths
+        self._lock = threading.Lock()
+
+    def _histogram(self, table, key):
+        # Called with self._lock held
+        histogram = table.get(key)
+        if histogram is None:
+            histogram = table[key] = RunningHistogram(self.window)
+        return histogram
+
+    def _budget_from(self, histogram):
+        tokens = math.ceil(histogram.merged().percentile(self.percentile) * self.headroom)
+        return max(self.min_tokens, min(self.max_tokens, tokens))
+
+    def budget(self, mode, input_tokens):
+        """
+        Return the ``max_tokens`` to generate with.
+
+        Args:
+            mode: "Math Correct" or "GPT4 Correct"
+            input_tokens: Tokens in the user's message (without history)
+        """
+        if not self.enabled:
+            return self.max_tokens
+        with self._lock:
+            for histogram in (self._groups.get((mode, input_length_group(input_tokens))), self._modes.get(mode)):
+                if histogram is not None and histogram.count >= self.min_samples:
+                    return self._budget_from(histogram)
+        return self.max_tokens
+
+    def record(self, mode, input_tokens, completion_tokens, hit_cap=False):
+        """
+        Record the length of a finished answer.
+
+        Args:
+            hit_cap: Whether the answer reached its budget
+        """
+        with self._lock:
+            self._histogram(self._groups, (mode, input_length_group(input_tokens))).record(completion_tokens, hit_cap)
+            self._histogram(self._modes, mode).record(completion_tokens, hit_cap)
+
+    def stats(self):
+        """Per group sample count, completion length percentiles, budget and cap hit rate."""
+        with self._lock:
+            groups = {}
+            for (mode, length_group), histogram in sorted(self._groups.items()):
+                merged = histogram.merged()
+                groups[f"{mode} {length_group}"] = {
+                    'samples': histogram.count,
+                    'p50_tokens': merged.percentile(50),
+                    f'p{self.percentile}_tokens': merged.percentile(self.percentile),
+                    'budget': self._budget_from(histogram) if histogram.count >= self.min_samples else None,
+                    'cap_hit_rate': round(histogram.cap_hits / histogram.total, 3),
+                }
+        return {'enabled': self.enabled, 'max_tokens': self.max_tokens, 'groups': groups}
@@ -0,0 +1,215 @@
+"""
+Traffic Forecast Module
+
+Forecasts hourly request volume from past request timestamps (Chat
+creation times) so capacity can be raised before a predictable peak,
+instead of after the latency spike a cold start would cause.
+
+The model is deliberately simple and fully vectorized with NumPy:
+
+1. Hour-of-week seasonality: the mean (and spread) of the request count for
+   each of the 168 hours of the week, with older weeks weighted down
+2. Short-term trend: the ratio of the last few hours' actual traffic to what
+   the profile expected, applied to the forecast and damped towards 1 the
+   further ahead it looks
+
+Hours are in UTC (the project's TIME_ZONE).
+"""
+
+import math
+from datetime import datetime, timezone
+
+import numpy as np
+from django.conf import settings
+
+HOURS_PER_WEEK = 168
+SECONDS_PER_HOUR = 3600
+# 1970-01-01 was a Thursday; shift so hour-of-week 0 is Monday 00:00
+_EPOCH_HOUR_OF_WEEK = 3 * 24
+
+FORECAST_HISTORY_WEEKS = getattr(settings, 'FORECAST_HISTORY_WEEKS', 6)
+# Weight of each older week relative to the next newer one
+FORECAST_WEEK_DECAY = getattr(settings, 'FORECAST_WEEK_DECAY', 0.7)
+# Hours of recent traffic compared with the profile to estimate the trend
+FORECAST_TREND_HOURS = getattr(settings, 'FORECAST_TREND_HOURS', 6)
+# Per-hour damping of the trend over the forecast horizon
+FORECAST_TREND_DAMPING = getattr(settings, 'FORECAST_TREND_DAMPING', 0.85)
+# Capacity is planned for mean + this many standard deviations of the hour's count
+FORECAST_SAFETY_SIGMA = getattr(settings, 'FORECAST_SAFETY_SIGMA', 1.0)
+
+
+def hour_of_week(timestamps):
+    """Hour of the week (0 = Monday 00:00 UTC) for epoch-second timestamps."""
+    hours = np.floor_divide(np.asarray(timestamps, dtype=np.float64), SECONDS_PER_HOUR).astype(np.int64)
+    return (hours + _EPOCH_HOUR_OF_WEEK) % HOURS_PER_WEEK
+
+
+class TrafficForecaster:
+    """
+    Hour-of-week seasonal profile with a damped short-term trend.
+
+    Args:
+        week_decay: Weight of each older week relative to the next newer one
+        trend_hours: Recent complete hours used to estimate the trend
+        trend_damping: Per-hour decay of the trend towards 1 in the forecast
+        max_trend: The trend factor is clipped to [1 / max_trend, max_trend]
+    """
+
+    def __init__(self, week_decay=FORECAST_WEEK_DECAY, trend_hours=FORECAST_TREND_HOURS,
+                 trend_damping=FORECAST_TREND_DAMPING, max_trend=2.0):
+        self.week_decay = week_decay
+        self.trend_hours = trend_hours
+        self.trend_damping = trend_damping
+        self.max_trend = max_trend
+        self.profile = None
+        self.spread = None
+        self.trend = 1.0
+        self.fitted_at = None
+        self.samples = 0
+
+    def fit(self, timestamps, now):
+        """
+        Fit the profile and trend on request timestamps before ``now``.
+
+        Only complete hours are used, so the hour in progress does not read
+        as a sudden drop in traffic.
+
+        Args:
+            timestamps: Epoch seconds of past requests (any order)
+            now: Current time in epoch seconds
+
+        Returns:
+            TrafficForecaster: self
+        """
+        end_hour = math.floor(now / SECONDS_PER_HOUR)
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        hours = np.floor_divide(timestamps, SECONDS_PER_HOUR).astype(np.int64)
+        hours = hours[hours < end_hour]
+        self.samples = int(hours.size)
+        self.fitted_at = now
+
+        if hours.size == 0:
+            self.profile = np.zeros(HOURS_PER_WEEK)
+            self.spread = np.zeros(HOURS_PER_WEEK)
+            self.trend = 1.0
+            return self
+
+        start_hour = int(hours.min())
+        counts = np.bincount(hours - start_hour, minlength=end_hour - start_hour).astype(np.float64)
+        bucket_hours = np.arange(start_hour, end_hour)
+        how = (bucket_hours + _EPOCH_HOUR_OF_WEEK) % HOURS_PER_WEEK
+        age_weeks = (end_hour - 1 - bucket_hours) // HOURS_PER_WEEK
+        weights = self.week_decay ** age_weeks
+
+        weight_sum = np.bincount(how, weights=weights, minlength=HOURS_PER_WEEK)
+        mean = np.bincount(how, weights=weights * counts, minlength=HOURS_PER_WEEK)
+        square = np.bincount(how, weights=weights * counts ** 2, minlength=HOURS_PER_WEEK)
+        seen = weight_sum > 0
+        overall = counts.mean()
+        self.profile = np.where(seen, mean / np.where(seen, weight_sum, 1), overall)
+        variance = np.where(seen, square / np.where(seen, weight_sum, 1), overall ** 2) - self.profile ** 2
+        # With few weeks the spread is unreliable; Poisson noise is a floor
+        self.spread = np.sqrt(np.maximum(variance, self.profile))
+
+        recent = slice(-self.trend_hours, None)
+        actual = counts[recent].sum()
+        expected = self.profile[how[recent]].sum()
+        self.trend = float(np.clip((actual + 1) / (expected + 1), 1 / self.max_trend, self.max_trend))
+        return self
+
+    def forecast(self, start, hours, safety_sigma=0.0):
+        """
+        Forecast request counts for ``hours`` whole hours from the one containing ``start``.
+
+        Args:
+            start: Epoch seconds
+            hours: Number of hourly buckets
+            safety_sigma: Standard deviations added to each hour's mean
+
+        Returns:
+            tuple: (bucket start times, expected requests per hour) as arrays
+        """
+        if self.profile is None:
+            raise RuntimeError("TrafficForecaster.fit() must be called before forecast()")
+        first_hour = math.floor(start / SECONDS_PER_HOUR)
+        bucket_hours = np.arange(first_hour, first_hour + hours)
+        how = (bucket_hours + _EPOCH_HOUR_OF_WEEK) % HOURS_PER_WEEK
+        trend = 1 + (self.trend - 1) * self.trend_damping ** np.arange(1, hours + 1)
+        expected = self.profile[how] * trend + safety_sigma * self.spread[how]
+        return bucket_hours * SECONDS_PER_HOUR, expected
+
+
+def required_capacity(requests_per_hour, service_seconds, slots=1, target_utilization=0.7):
+    """
+    Instances needed to serve an hourly request volume at a target utilization.
+
+    Args:
+        requests_per_hour: Scalar or array of hourly request counts
+        service_seconds: Mean time one request occupies a generation slot
+        slots: Concurrent generations per instance
+        target_utilization: Fraction of slot time to plan for
+
+    Returns:
+        numpy.ndarray: Instance counts (at least 0)
+    """
+    busy = np.asarray(requests_per_hour, dtype=np.float64) * service_seconds / SECONDS_PER_HOUR
+    return np.ceil(busy / (slots * target_utilization)).astype(np.int64)
+
+
+def plan_capacity(forecaster, now, lead_seconds, service_seconds, slots=1, target_utilization=0.7,
+                  safety_sigma=FORECAST_SAFETY_SIGMA):
+    """
+    Capacity to have launched now so it is serving by the time it is needed.
+
+    An instance launched now serves after ``lead_seconds`` (the cold start),
+    so capacity needed at any point up to then must be requested now.
+
+    Returns:
+        dict: ``capacity``, the ``peak_time`` and ``peak_requests_per_hour``
+        that drive it, and the ``lead_seconds`` used
+    """
+    hours = max(1, math.ceil((now % SECONDS_PER_HOUR + lead_seconds) / SECONDS_PER_HOUR))
+    starts, expected = forecaster.forecast(now, hours + 1, safety_sigma=safety_sigma)
+    capacity = required_capacity(expected, service_seconds, slots, target_utilization)
+    # Only buckets starting before the lead time has elapsed must be covered now
+    needed = starts < now + lead_seconds
+    needed[0] = True
+    peak = int(np.argmax(np.where(needed, capacity, -1)))
+    return {
+        'capacity': int(capacity[peak]),
+        'peak_time': float(starts[peak]),
+        'peak_requests_per_hour': round(float(expected[peak]), 1),
+        'lead_seconds': lead_seconds,
+    }
+
+
+def apply_forecast(decision, plan, min_capacity=1, max_capacity=None):
+    """
+    Raise a scaling policy decision to the capacity a forecast plan needs.
+
+    The forecast only ever adds capacity or blocks a scale-in; it never
+    removes instances.
+
+    Args:
+        decision: Decision dict from a ScalingPolicy
+        plan: Result of ``plan_capacity``
+        min_capacity: Lower capacity bound
+        max_capacity: Upper capacity bound (None for no bound)
+
+    Returns:
+        dict: The adjusted decision (``decision`` itself if unchanged)
+    """
+    predicted = max(min_capacity or 1, plan['capacity'])
+    if max_capacity:
+        predicted = min(predicted, max_capacity)
+    if predicted <= decision['desired']:
+        return decision
+
+    capacity = decision['capacity']
+    peak = datetime.fromtimestamp(plan['peak_time'], tz=timezone.utc).strftime('%a %H:%M UTC')
+    reason = (f"forecast {plan['peak_requests_per_hour']} req/h at {peak}, "
+              f"{plan['lead_seconds']:.0f}s cold start")
+    if predicted > capacity:
+        return dict(decision, action='scale_out', desired=predicted, reason=reason, predictive=True)
+    # Reactive scale-in, but the forecast needs the current capacity soon
+    return dict(decision, action='hold', desired=capacity, reason=f"{decision['reason']}; {reason}", predictive=True)
@@ -28,8 +28,13 @@ urlpatterns = [
     path("notes/ask/", views.NoteListCreate.as_view(), name="ask-anything"),
     path("chats/delete/<int:pk>/", views.ChatDelete.as_view(), name="delete-chat"),
     path('chat/', views.ChatView.as_view(), name='chat'),
+    path('async/chat/', views.async_chat, name='async-chat'),
+    path('chat/cancel/', views.cancel_chat_generation, name='cancel-chat'),
     path('chat-history/', views.ChatHistoryView.as_view(), name='chat-history'),
     path('initialize_model/', views.InitializeModelView.as_view(), name='initialize-model'),
+    path('inference/', views.inference_node, name='inference-node'),
+    path('lambda/jobs/<str:job_id>/', views.lambda_job_status, name='lambda-job-status'),
+    path('lambda/jobs/<str:job_id>/result/', views.lambda_job_result, name='lambda-job-result'),
     path('new-chat-session/', views.NewChatSessionView.as_view(), name='new-chat-session'),
     path('chat-session/<str:session_id>/', views.ChatSessionView.as_view(), name='chat-session'),
     path('chat-session/delete/<str:session_id>/', views.delete_chat_session, name='delete-chat-session'),
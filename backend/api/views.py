@@ -7,23 +7,110 @@ from .models import Note, Chat
 from .serializers import UserSerializer, NoteSerializer, ChatSerializer, UserUpdateSerializer
 from django.db.models import Q
 from django.contrib.auth import logout
-from .llm_handler import generate_response, LlamaModel, clear_chat_history, load_history_from_database
+from .llm_handler import (
+    generate_response, LlamaModel, clear_chat_history, load_history_from_database, estimate_generation_tokens,
+    inference_executor, token_budget
+)
 from rest_framework import serializers
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 import uuid
 from django.shortcuts import get_object_or_404
-from django.http import JsonResponse
+from django.http import JsonResponse, HttpResponse, HttpResponseNotAllowed
+from django.conf import settings
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth.decorators import login_required
 import json
 import logging
-from .monitoring import get_performance_metrics, get_system_metrics, reset_metrics
+import asyncio
+import functools
+from asgiref.sync import sync_to_async
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from .monitoring import (
+    get_performance_metrics, get_system_metrics, reset_metrics, record_latency,
+    traced_request, trace_span, request_trace
+)
 from .cache_management import get_cache_stats, reset_cache_stats, clear_model_cache
+from .metrics_exposition import render_openmetrics, CONTENT_TYPE as OPENMETRICS_CONTENT_TYPE
+from .lambda_handler import get_lambda_job, complete_lambda_job, LAMBDA_JOB_POLL_INTERVAL
+from .admission import (
+    AdmissionRejected, acquire_generation_slot, acquire_generation_slot_async, get_admission_stats
+)
+from .rate_limit import RateLimited, get_rate_limiter, get_rate_limit_stats
+from .cancellation import cancellable_generation, request_cancel
 
 logger = logging.getLogger(__name__)
 
+def _refusal(refused):
+    """
+    Body, status and headers for a request refused by rate limiting
+    (429) or shed by admission control (429/503).
+    """
+    if isinstance(refused, RateLimited):
+        body = {
+            'error': f"You're sending requests too quickly. Please try again in {refused.retry_after} seconds.",
+            'retry_after': refused.retry_after,
+            'rate_limited': True,
+        }
+        status_code = 429
+    else:
+        body = {
+            'error': refused.message,
+            'retry_after': refused.retry_after,
+            'estimated_wait': round(refused.estimated_wait, 1),
+            'shed': True,
+        }
+        status_code = refused.status
+    return body, status_code, {'Retry-After': str(refused.retry_after)}
+
+def _refusal_response(refused):
+    body, status_code, headers = _refusal(refused)
+    return Response(body, status=status_code, headers=headers)
+
+def _admit_generation(user, message, model_mode):
+    """
+    Check the user's token bucket and wait for a generation slot.
+    
+    Returns:
+        tuple: (admission, None), or (None, error response) if the request is refused
+    """
+    limiter = get_rate_limiter()
+    try:
+        if limiter is not None:
+            # Cheap early refusal: the real charge is made once the prompt size is known
+            limiter.check(user.pk, estimate_generation_tokens(message, model_mode))
+        with trace_span("admission"):
+            return acquire_generation_slot(user.pk), None
+    except (RateLimited, AdmissionRejected) as refused:
+        return None, _refusal_response(refused)
+
+def _unpack_response(response_data, model_mode):
+    """Return (response text, mode, is_automatic) from ``generate_response``'s result."""
+    if isinstance(response_data, dict) and 'response' in response_data:
+        return (
+            response_data['response'],
+            response_data.get('mode', 'GPT4 Correct'),
+            response_data.get('is_automatic', model_mode == 'auto'),
+        )
+    # Fallback for compatibility with older code
+    return response_data, 'GPT4 Correct', model_mode == 'auto'
+
+def _was_cancelled(response_data):
+    """Return True if ``generate_response`` was stopped before it finished."""
+    return isinstance(response_data, dict) and response_data.get('cancelled', False)
+
+def _cancelled_body(chat_session, session_messages_count):
+    """Body for a generation cancelled before the model produced anything (nothing is saved)."""
+    return {
+        'response': '',
+        'cancelled': True,
+        'remaining_messages': 5 - session_messages_count,
+        'limit_reached': session_messages_count >= 5,
+        'chat_session': chat_session,
+    }
+
 class CreateUserView(generics.CreateAPIView):
     queryset = User.objects.all()
     serializer_class = UserSerializer
@@ -177,6 +264,7 @@ class SignOutView(APIView):
 class ChatView(APIView):
     permission_classes = [IsAuthenticated]
 
+    @traced_request("chat")
     def post(self, request):
         message = request.data.get('message', '')
         chat_session = request.data.get('chat_session', 'default')
@@ -193,10 +281,11 @@ class ChatView(APIView):
         print(f"User: {request.user.username}, Chat session: {chat_session}, Mode: {model_mode}")
         
         # Check if user has reached the limit for this chat session
-        session_messages_count = Chat.objects.filter(
-            user=request.user, 
-            chat_session=chat_session
-        ).count()
+        with trace_span("db_count"):
+            session_messages_count = Chat.objects.filter(
+                user=request.user, 
+                chat_session=chat_session
+            ).count()
         
         if session_messages_count >= 5:
             return Response({
@@ -204,37 +293,51 @@ class ChatView(APIView):
                 'limit_reached': True
             }, status=400)
         
-        # Load existing conversation history from database
-        if session_messages_count > 0:
-            load_history_from_database(request.user, chat_session)
+        # Registered before queueing, so the deadline also covers the wait for a slot
+        with cancellable_generation(request.user.pk, chat_session,
+                                    connection=request.META.get('gunicorn.socket')) as cancel_token:
+            # Wait for a generation slot, or fail fast if the wait would be too long
+            admission, refusal = _admit_generation(request.user, message, model_mode)
+            if refusal is not None:
+                return refusal
         
-        # Generate response with chat session context and model mode
-        response_data = generate_response(message, chat_session, model_mode)
+            with admission, record_latency(endpoint="chat") as latency_labels:
+                # Load existing conversation history from database
+                if session_messages_count > 0:
+                    with trace_span("db_load_history"):
+                        load_history_from_database(request.user, chat_session)
         
-        # Extract the response text from the response data object
-        if isinstance(response_data, dict) and 'response' in response_data:
-            ai_response = response_data['response']
-            mode = response_data.get('mode', 'GPT4 Correct')
-            is_automatic = response_data.get('is_automatic', model_mode == 'auto')
-        else:
-            # Fallback for compatibility with older code
-            ai_response = response_data
-            mode = 'GPT4 Correct'
-            is_automatic = model_mode == 'auto'
+                # Generate response with chat session context and model mode
+                with trace_span("generate"):
+                    try:
+                        response_data = generate_response(message, chat_session, model_mode,
+                                                          rate_limit_key=request.user.pk,
+                                                          cancel_event=cancel_token)
+                    except RateLimited as limited:
+                        return _refusal_response(limited)
+        
+                # Extract the response text from the response data object
+                ai_response, mode, is_automatic = _unpack_response(response_data, model_mode)
+                latency_labels["model_mode"] = mode
+        
+        cancelled = _was_cancelled(response_data)
+        if cancelled and not ai_response:
+            return Response(_cancelled_body(chat_session, session_messages_count))
         
         # Calculate remaining messages
         remaining_messages = 5 - (session_messages_count + 1)
         
         # Save the chat with remaining_messages data
-        chat = Chat.objects.create(
-            user=request.user,
-            message=message,
-            response=ai_response,
-            chat_session=chat_session,
-            remaining_messages=remaining_messages,  # Actually save the value to the database
-            model_mode=mode,  # Save the model mode
-            is_automatic=is_automatic  # Save whether mode was automatic
-        )
+        with trace_span("db_write"):
+            chat = Chat.objects.create(
+                user=request.user,
+                message=message,
+                response=ai_response,
+                chat_session=chat_session,
+                remaining_messages=remaining_messages,  # Actually save the value to the database
+                model_mode=mode,  # Save the model mode
+                is_automatic=is_automatic  # Save whether mode was automatic
+            )
         
         return Response({
             'response': ai_response,
@@ -242,9 +345,125 @@ class ChatView(APIView):
             'limit_reached': remaining_messages <= 0,
             'chat_session': chat_session,
             'mode': mode,
-            'is_automatic': is_automatic
+            'is_automatic': is_automatic,
+            'cancelled': cancelled
         })
 
+def _generate_for_async_view(user, chat_session, message, model_mode, load_history, cancel_token):
+    """History loading and generation for ``async_chat``, run on an inference thread."""
+    # Traces are per thread, so the request is traced here rather than on the event loop
+    with request_trace(endpoint="async_chat"):
+        if load_history:
+            with trace_span("db_load_history"):
+                load_history_from_database(user, chat_session)
+        with trace_span("generate"):
+            return generate_response(message, chat_session, model_mode, rate_limit_key=user.pk,
+                                     cancel_event=cancel_token)
+
+async def _authenticate_jwt(request):
+    """Return the user of the request's JWT bearer token, or None."""
+    try:
+        result = await sync_to_async(JWTAuthentication().authenticate)(request)
+    except AuthenticationFailed:
+        return None
+    return result[0] if result else None
+
+async def async_chat(request):
+    """
+    Async version of ChatView for ASGI servers, with the same request and response.
+    
+    While a request waits for a generation slot or for the model, it holds
+    no thread, so a single uvicorn worker can keep hundreds of slow chat
+    requests open. Generation runs on ``inference_executor``.
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    user = await _authenticate_jwt(request)
+    if user is None:
+        return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=401)
+    try:
+        data = json.loads(request.body or b'{}')
+    except ValueError:
+        return JsonResponse({'error': 'Invalid JSON body'}, status=400)
+    
+    message = data.get('message', '')
+    chat_session = data.get('chat_session', 'default')
+    model_mode = data.get('model_mode', 'auto')
+    if not message:
+        return JsonResponse({'error': 'Message is required'}, status=400)
+    if model_mode not in ['auto', 'default', 'math']:
+        model_mode = 'auto'
+    
+    session_messages_count = await Chat.objects.filter(user=user, chat_session=chat_session).acount()
+    if session_messages_count >= 5:
+        return JsonResponse({
+            'error': 'Chat limit reached. Please start a new chat.',
+            'limit_reached': True
+        }, status=400)
+    
+    with cancellable_generation(user.pk, chat_session) as cancel_token:
+        limiter = get_rate_limiter()
+        try:
+            if limiter is not None:
+                await sync_to_async(limiter.check, thread_sensitive=False)(
+                    user.pk, estimate_generation_tokens(message, model_mode)
+                )
+            admission = await acquire_generation_slot_async(user.pk)
+        except (RateLimited, AdmissionRejected) as refused:
+            body, status_code, headers = _refusal(refused)
+            return JsonResponse(body, status=status_code, headers=headers)
+    
+        with record_latency(endpoint="async_chat") as latency_labels:
+            future = asyncio.get_running_loop().run_in_executor(
+                inference_executor,
+                functools.partial(
+                    _generate_for_async_view, user, chat_session, message, model_mode, session_messages_count > 0,
+                    cancel_token
+                )
+            )
+            # The slot is released when the generation ends, which is within
+            # one token once the cancel token is set
+            future.add_done_callback(lambda _: admission.release())
+            try:
+                response_data = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # The request was torn down (e.g. the client disconnected)
+                cancel_token.cancel('disconnect')
+                raise
+            except RateLimited as limited:
+                body, status_code, headers = _refusal(limited)
+                return JsonResponse(body, status=status_code, headers=headers)
+            ai_response, mode, is_automatic = _unpack_response(response_data, model_mode)
+            latency_labels["model_mode"] = mode
+    
+    cancelled = _was_cancelled(response_data)
+    if cancelled and not ai_response:
+        return JsonResponse(_cancelled_body(chat_session, session_messages_count))
+    
+    remaining_messages = 5 - (session_messages_count + 1)
+    await Chat.objects.acreate(
+        user=user,
+        message=message,
+        response=ai_response,
+        chat_session=chat_session,
+        remaining_messages=remaining_messages,
+        model_mode=mode,
+        is_automatic=is_automatic
+    )
+    
+    return JsonResponse({
+        'response': ai_response,
+        'remaining_messages': remaining_messages,
+        'limit_reached': remaining_messages <= 0,
+        'chat_session': chat_session,
+        'mode': mode,
+        'is_automatic': is_automatic,
+        'cancelled': cancelled
+    })
+
+# Bearer-token API: no session cookie, so no CSRF check
+async_chat.csrf_exempt = True
+
 class InitializeModelView(APIView):
     permission_classes = [IsAuthenticated]
 
@@ -402,6 +621,7 @@ def delete_chat_session(request, session_id):
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@traced_request("create_chat")
 def create_chat(request):
     try:
         user_message = request.data.get('message', '')
@@ -416,10 +636,11 @@ def create_chat(request):
             model_mode = 'auto'  # Default to auto if invalid
         
         # Get count of existing messages in this session
-        session_messages_count = Chat.objects.filter(
-            user=request.user,
-            chat_session=chat_session
-        ).count()
+        with trace_span("db_count"):
+            session_messages_count = Chat.objects.filter(
+                user=request.user,
+                chat_session=chat_session
+            ).count()
         
         # Check if this is the first message
         is_first_message = session_messages_count == 0
@@ -437,44 +658,71 @@ def create_chat(request):
                 title += '...'
         else:
             # Load existing conversation history from database
-            load_history_from_database(request.user, chat_session)
+            with trace_span("db_load_history"):
+                load_history_from_database(request.user, chat_session)
         
-        # Generate AI response with chat session context and model mode
-        response_data = generate_response(user_message, chat_session, model_mode)
+        with cancellable_generation(request.user.pk, chat_session,
+                                    connection=request.META.get('gunicorn.socket')) as cancel_token:
+            admission, refusal = _admit_generation(request.user, user_message, model_mode)
+            if refusal is not None:
+                return refusal
         
-        # Extract the response text and mode information
-        if isinstance(response_data, dict) and 'response' in response_data:
-            ai_response = response_data['response']
-            mode = response_data.get('mode', 'GPT4 Correct')
-            is_automatic = response_data.get('is_automatic', model_mode == 'auto')
-        else:
-            # Fallback for compatibility with older code
-            ai_response = response_data
-            mode = 'GPT4 Correct'
-            is_automatic = model_mode == 'auto'
+            with admission, record_latency(endpoint="create_chat") as latency_labels:
+                # Generate AI response with chat session context and model mode
+                with trace_span("generate"):
+                    try:
+                        response_data = generate_response(user_message, chat_session, model_mode,
+                                                          rate_limit_key=request.user.pk,
+                                                          cancel_event=cancel_token)
+                    except RateLimited as limited:
+                        return _refusal_response(limited)
+        
+                # Extract the response text and mode information
+                ai_response, mode, is_automatic = _unpack_response(response_data, model_mode)
+                latency_labels["model_mode"] = mode
+        
+        cancelled = _was_cancelled(response_data)
+        if cancelled and not ai_response:
+            return Response(_cancelled_body(chat_session, session_messages_count))
         
         # Calculate remaining messages
         remaining_messages = 5 - (session_messages_count + 1)
         
         # Save the chat with all information
-        chat = Chat.objects.create(
-            user=request.user,
-            chat_session=chat_session,
-            message=user_message,
-            response=ai_response,
-            title=title,  # This will be None for non-first messages
-            remaining_messages=remaining_messages,
-            model_mode=mode,  # Save the model mode
-            is_automatic=is_automatic  # Save whether mode was automatic
-        )
+        with trace_span("db_write"):
+            chat = Chat.objects.create(
+                user=request.user,
+                chat_session=chat_session,
+                message=user_message,
+                response=ai_response,
+                title=title,  # This will be None for non-first messages
+                remaining_messages=remaining_messages,
+                model_mode=mode,  # Save the model mode
+                is_automatic=is_automatic  # Save whether mode was automatic
+            )
         
-        return Response(ChatSerializer(chat).data)
+        data = ChatSerializer(chat).data
+        data['cancelled'] = cancelled
+        return Response(data)
     except Exception as e:
         return Response(
             {"error": str(e)}, 
             status=status.HTTP_500_INTERNAL_SERVER_ERROR
         )
 
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def cancel_chat_generation(request):
+    """
+    Stop the user's running generation in a chat session.
+    
+    The generation stops after its current token and its request returns
+    the partial response with ``cancelled: true``.
+    """
+    chat_session = request.data.get('chat_session', 'default')
+    request_cancel(request.user.pk, chat_session)
+    return Response({'chat_session': chat_session, 'cancel_requested': True}, status=status.HTTP_202_ACCEPTED)
+
 @api_view(['PUT'])
 @permission_classes([IsAuthenticated])
 def rename_chat_session(request, session_id):
@@ -721,17 +969,30 @@ def admin_dashboard(request):
         avg_latency = 0
         if performance_metrics["total_requests"] > 0:
             avg_latency = performance_metrics["total_latency"] / performance_metrics["total_requests"]
+        overall_latency = performance_metrics["latency_percentiles"].get("all", {})
         
         # Prepare response data
         dashboard_data = {
             "performance": {
                 "total_requests": performance_metrics["total_requests"],
                 "avg_latency_ms": round(avg_latency * 1000, 2),  # Convert to ms
+                "p50_latency_ms": overall_latency.get("p50_ms", 0),
+                "p90_latency_ms": overall_latency.get("p90_ms", 0),
+                "p99_latency_ms": overall_latency.get("p99_ms", 0),
+                "max_latency_ms": overall_latency.get("max_ms", 0),
+                "latency_percentiles": performance_metrics["latency_percentiles"],
                 "cached_responses": performance_metrics["cached_responses"],
                 "errors": performance_metrics["errors"],
                 "token_usage": performance_metrics["token_usage"],
                 "requests_by_model": performance_metrics["requests_by_model"],
+                "pipeline": performance_metrics["pipeline"],
+                "shed_requests": performance_metrics["shed_requests"],
+                "cancelled_generations": performance_metrics["cancelled_generations"],
+                "wasted_tokens": performance_metrics["wasted_tokens"],
             },
+            "admission": get_admission_stats(),
+            "rate_limit": get_rate_limit_stats(),
+            "token_budget": token_budget.stats(),
             "cache": {
                 "hit_rate": round(cache_hit_rate * 100, 2),  # As percentage
                 "total_requests": cache_stats["total_cache_requests"],
@@ -802,3 +1063,138 @@ def reset_monitoring(request):
             "status": "error",
             "message": str(e)
         }, status=500)
+
+@csrf_exempt
+@require_http_methods(["GET"])
+def prometheus_metrics(request):
+    """
+    Prometheus/OpenMetrics scrape endpoint.
+    
+    Reports service-wide counters and latency histograms plus per-worker gauges.
+    If ``METRICS_AUTH_TOKEN`` is set, scrapers must send it as a bearer token.
+    
+    Returns:
+        HttpResponse: OpenMetrics text exposition
+    """
+    auth_token = getattr(settings, 'METRICS_AUTH_TOKEN', None)
+    if auth_token and request.headers.get('Authorization') != f"Bearer {auth_token}":
+        return HttpResponse("Unauthorized\n", status=401, content_type="text/plain")
+    
+    try:
+        body = render_openmetrics()
+    except Exception as e:
+        logger.error(f"Error rendering metrics: {str(e)}")
+        return HttpResponse(f"Error rendering metrics: {str(e)}\n", status=500, content_type="text/plain")
+    
+    return HttpResponse(body, content_type=OPENMETRICS_CONTENT_TYPE)
+
+@csrf_exempt
+@require_http_methods(["POST"])
+@traced_request("inference")
+def inference_node(request):
+    """
+    Node-to-node inference endpoint used by distributed inference.
+    
+    Peers post ``{"input", "session_id", "model_mode"}`` with
+    ``INFERENCE_NODE_TOKEN`` as a bearer token and get back the same dict
+    ``generate_response`` returns. The endpoint is disabled (503) until the
+    token is set. Generations wait in the admission queue like chat requests
+    (queued per peer), and peer sessions are kept apart from this node's own
+    chat sessions.
+    
+    Returns:
+        JsonResponse: The generation result, or 429/503 if it was shed
+    """
+    auth_token = getattr(settings, 'INFERENCE_NODE_TOKEN', None)
+    if not auth_token:
+        return JsonResponse({'error': 'Node-to-node inference is not enabled'}, status=503)
+    if request.headers.get('Authorization') != f"Bearer {auth_token}":
+        return JsonResponse({'error': 'Unauthorized'}, status=401)
+    
+    try:
+        data = json.loads(request.body or b'{}')
+    except ValueError:
+        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+    
+    user_input = data.get('input', '')
+    if not user_input:
+        return JsonResponse({'error': 'Input is required'}, status=400)
+    
+    # A peer's session id must never reach the history of a local chat session
+    chat_session = f"peer:{data.get('session_id', 'default')}"
+    model_mode = data.get('model_mode', 'auto')
+    if model_mode not in ['auto', 'default', 'math']:
+        model_mode = 'auto'
+    
+    try:
+        with trace_span("admission"):
+            admission = acquire_generation_slot(f"peer:{request.META.get('REMOTE_ADDR')}")
+    except AdmissionRejected as refused:
+        body, status_code, headers = _refusal(refused)
+        return JsonResponse(body, status=status_code, headers=headers)
+    
+    with admission, record_latency(endpoint="inference") as latency_labels:
+        with trace_span("generate"):
+            response_data = generate_response(user_input, chat_session, model_mode)
+        if isinstance(response_data, dict):
+            latency_labels["model_mode"] = response_data.get('mode')
+    
+    if not isinstance(response_data, dict):
+        response_data = {'response': response_data}
+    return JsonResponse(response_data)
+
+@csrf_exempt
+@require_http_methods(["POST"])
+def lambda_job_result(request, job_id):
+    """
+    Callback the Lambda function posts an asynchronous job's result to.
+    
+    The function must send ``LAMBDA_CALLBACK_TOKEN`` as a bearer token; the
+    endpoint is disabled (503) until the token is set. The body is the
+    function's result dict, optionally in the compressed payload envelope.
+    
+    Returns:
+        JsonResponse: ``{"stored": true}``, or 404/409 for unknown
+        or already finished jobs
+    """
+    auth_token = getattr(settings, 'LAMBDA_CALLBACK_TOKEN', None)
+    if not auth_token:
+        return JsonResponse({'error': 'Lambda job callbacks are not enabled'}, status=503)
+    if request.headers.get('Authorization') != f"Bearer {auth_token}":
+        return JsonResponse({'error': 'Unauthorized'}, status=401)
+    
+    try:
+        result = json.loads(request.body or b'{}')
+    except ValueError:
+        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+    
+    job = get_lambda_job(job_id)
+    if job is None:
+        return JsonResponse({'error': 'Job not found'}, status=404)
+    if not complete_lambda_job(job_id, result):
+        return JsonResponse({'error': 'Job already finished'}, status=409)
+    return JsonResponse({'stored': True})
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def lambda_job_status(request, job_id):
+    """
+    Poll an asynchronous Lambda job.
+    
+    Returns ``status`` "pending" (with a ``retry_after`` hint in seconds),
+    "complete" with the ``result``, or "error" with the ``error``. Jobs of
+    other users, and jobs submitted without an owner, are reported as not found.
+    """
+    job = get_lambda_job(job_id)
+    if job is None or job.get('owner') is None or job['owner'] != request.user.id:
+        return Response({'error': 'Job not found'}, status=status.HTTP_404_NOT_FOUND)
+    
+    body = {'job_id': job_id, 'status': job['status']}
+    if job['status'] == 'pending':
+        # Poll gently while the function is still running
+        body['retry_after'] = max(1, int(LAMBDA_JOB_POLL_INTERVAL * 2))
+    elif job['status'] == 'complete':
+        body['result'] = job['result']
+    else:
+        body['error'] = job.get('error')
+    return Response(body)
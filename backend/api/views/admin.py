@@ -33,6 +33,7 @@ class AdminDashboardView(APIView):
         cache_stats = get_cache_stats()
         
         # Calculate additional derived metrics
+        overall_latency = performance_metrics.get("latency_percentiles", {}).get("all", {})
         total_requests = performance_metrics.get("total_requests", 0)
         error_count = performance_metrics.get("errors", 0)
         error_rate = (error_count / total_requests * 100) if total_requests > 0 else 0
@@ -46,6 +47,12 @@ class AdminDashboardView(APIView):
                 "total_requests": total_requests,
                 "error_rate": error_rate,
                 "cache_hit_rate": cache_stats.get("hit_rate", 0),
+                "latency_p50_ms": overall_latency.get("p50_ms", 0),
+                "latency_p99_ms": overall_latency.get("p99_ms", 0),
+                "stage_p50_ms": {
+                    stage: summary.get("p50_ms", 0)
+                    for stage, summary in performance_metrics.get("pipeline", {}).get("stages", {}).items()
+                },
             }
         }
         
@@ -99,8 +106,26 @@ class PerformanceMetricsView(APIView):
     
     @method_decorator(csrf_exempt)
     def get(self, request, format=None):
-        """Get performance metrics."""
+        """
+        Get performance metrics.
+        
+        Includes p50/p90/p99/max latency overall, per endpoint and per model mode.
+        Pass ``?endpoint=<name>`` or ``?model_mode=<mode>`` to return only the
+        percentiles for that key.
+        """
         metrics = get_performance_metrics()
+        percentiles = metrics.get("latency_percentiles", {})
+        
+        endpoint = request.query_params.get('endpoint')
+        model_mode = request.query_params.get('model_mode')
+        if endpoint or model_mode:
+            key = f"endpoint:{endpoint}" if endpoint else f"mode:{model_mode}"
+            if key not in percentiles:
+                return Response({"error": f"No latency data for {key}"},
+                                status=status.HTTP_404_NOT_FOUND)
+            return Response({key: percentiles[key]}, status=status.HTTP_200_OK)
+        
+        metrics["latency"] = percentiles.get("all", {})
         return Response(metrics, status=status.HTTP_200_OK)
     
     @method_decorator(csrf_exempt)
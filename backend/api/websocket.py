@@ -0,0 +1,318 @@
+"""
+WebSocket Chat Module
+
+A persistent chat channel per chat session, served by the ASGI application
+at ``/api/ws/chat/<chat_session>/?token=<JWT access token>``.
+
+Compared with one HTTP request per message, the connection authenticates
+once, loads the session's history once (later turns reuse the in-memory
+history), and streams the response as it is generated. A client can cancel
+a turn mid-generation, which stops the model's decode loop after the current
+token and frees the generation slot for the next request.
+
+Protocol (JSON text frames):
+
+    client -> {"type": "message", "message": "...", "model_mode": "auto"}
+    client -> {"type": "cancel"}      (or POST /api/chat/cancel/ with the chat_session)
+    server -> {"type": "ready", "chat_session": "...", "remaining_messages": 5}
+    server -> {"type": "token", "text": "..."}           (repeated)
+    server -> {"type": "done", "response": "...", "mode": "...", "is_automatic": true,
+               "remaining_messages": 4, "limit_reached": false, "cancelled": false}
+    server -> {"type": "error", "error": "...", ...}
+
+One turn runs at a time per connection. Turns go through the same token
+rate limit and admission queue as the HTTP chat endpoints; a refused turn
+gets an error frame with the fields of the HTTP error body.
+"""
+
+import asyncio
+import functools
+import json
+import logging
+import re
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+
+from .admission import AdmissionRejected, acquire_generation_slot_async
+from .cancellation import cancellable_generation
+from .llm_handler import (
+    generate_response, load_history_from_database, inference_executor, estimate_generation_tokens
+)
+from .models import Chat
+from .monitoring import record_latency, request_trace, trace_span
+from .rate_limit import RateLimited, get_rate_limiter
+from .views import _refusal, _unpack_response, _was_cancelled
+
+logger = logging.getLogger(__name__)
+
+CHAT_PATH = re.compile(r'/api/ws/chat/([\w-]{1,50})/')
+MESSAGES_PER_SESSION = 5
+
+# Close codes (4000-4999 are application defined)
+CLOSE_UNAUTHORIZED = 4401
+CLOSE_NOT_FOUND = 4404
+
+
+def _generate_turn(user, chat_session, message, model_mode, on_token, cancel_event):
+    """Generation for one WebSocket turn, run on an inference thread."""
+    with request_trace(endpoint="websocket_chat"):
+        with trace_span("generate"):
+            return generate_response(
+                message, chat_session, model_mode, rate_limit_key=user.pk,
+                on_token=on_token, cancel_event=cancel_event
+            )
+
+
+def _load_history(user, chat_session):
+    """Load a session's history on a worker thread, outside any request cycle."""
+    # No request_started/finished here to recycle this thread's connection
+    close_old_connections()
+    try:
+        with request_trace(endpoint="websocket_connect"):
+            with trace_span("db_load_history"):
+                load_history_from_database(user, chat_session)
+    finally:
+        close_old_connections()
+
+
+async def _authenticate(scope):
+    """Return the user of the ``token`` query parameter's JWT, or None."""
+    token = parse_qs(scope.get('query_string', b'').decode('latin-1')).get('token')
+    if not token:
+        return None
+    authentication = JWTAuthentication()
+    try:
+        validated = authentication.get_validated_token(token[0])
+        return await sync_to_async(authentication.get_user)(validated)
+    except (InvalidToken, TokenError):
+        return None
+
+
+class ChatSocket:
+    """
+    One WebSocket connection to a chat session.
+
+    Args:
+        scope, receive, send: The ASGI connection
+        chat_session: Chat session id from the URL
+    """
+
+    def __init__(self, scope, receive, send, chat_session):
+        self.scope = scope
+        self.receive = receive
+        self.send = send
+        self.chat_session = chat_session
+        self.user = None
+        self.messages_count = 0
+        self.closed = False
+        self._turn = None
+        self._cancel_token = None
+        # True while the turn waits for its rate limit check and generation slot
+        self._waiting = False
+
+    async def run(self):
+        """Authenticate, then serve turns until the client disconnects."""
+        self.user = await _authenticate(self.scope)
+        if self.user is None:
+            await self.send({'type': 'websocket.close', 'code': CLOSE_UNAUTHORIZED})
+            return
+        await self.send({'type': 'websocket.accept'})
+
+        self.messages_count = await Chat.objects.filter(user=self.user, chat_session=self.chat_session).acount()
+        if self.messages_count:
+            # A database read: keep it off the inference threads, which may all be generating
+            await sync_to_async(_load_history, thread_sensitive=False)(self.user, self.chat_session)
+        await self._send_json({
+            'type': 'ready',
+            'chat_session': self.chat_session,
+            'remaining_messages': MESSAGES_PER_SESSION - self.messages_count,
+        })
+
+        try:
+            while True:
+                event = await self.receive()
+                if event['type'] == 'websocket.disconnect':
+                    break
+                if event['type'] == 'websocket.receive':
+                    await self._handle(event.get('text') or (event.get('bytes') or b'').decode('utf-8', 'replace'))
+        finally:
+            self.closed = True
+            self._cancel('disconnect')
+            if self._turn is not None:
+                await asyncio.gather(self._turn, return_exceptions=True)
+
+    async def _handle(self, text):
+        try:
+            data = json.loads(text)
+        except ValueError:
+            await self._send_error('Invalid JSON frame')
+            return
+        kind = data.get('type') if isinstance(data, dict) else None
+
+        if kind == 'message':
+            if self._turn is not None and not self._turn.done():
+                await self._send_error('A response is still being generated. Send "cancel" to stop it.')
+                return
+            message = data.get('message', '')
+            if not message or not isinstance(message, str):
+                await self._send_error('Message is required')
+                return
+            model_mode = data.get('model_mode', 'auto')
+            if model_mode not in ['auto', 'default', 'math']:
+                model_mode = 'auto'
+            self._waiting = True
+            self._turn = asyncio.create_task(self._run_turn(message, model_mode))
+        elif kind == 'cancel':
+            self._cancel()
+        else:
+            await self._send_error(f"Unknown frame type: {kind!r}")
+
+    def _cancel(self, reason='client'):
+        """Stop the current turn: the wait for a slot, or the model after its next token."""
+        if self._turn is None or self._turn.done():
+            return
+        if self._waiting:
+            self._turn.cancel()
+        else:
+            # Never cancel the task itself past admission, e.g. while it saves the turn
+            self._cancel_token.cancel(reason)
+
+    async def _run_turn(self, message, model_mode):
+        # No deadline: the client sees the response as it streams and can cancel it
+        with cancellable_generation(self.user.pk, self.chat_session, timeout=None) as cancel_token:
+            self._cancel_token = cancel_token
+            try:
+                admission = await self._admit(message, model_mode)
+            finally:
+                self._waiting = False
+            if admission is None:
+                return
+            try:
+                response_data = await self._stream(admission, message, model_mode)
+            except RateLimited as limited:
+                body, _, _ = _refusal(limited)
+                await self._send_error(**body)
+                return
+
+        ai_response, mode, is_automatic = _unpack_response(response_data, model_mode)
+        if ai_response:
+            self.messages_count += 1
+            await Chat.objects.acreate(
+                user=self.user,
+                message=message,
+                response=ai_response,
+                chat_session=self.chat_session,
+                remaining_messages=MESSAGES_PER_SESSION - self.messages_count,
+                model_mode=mode,
+                is_automatic=is_automatic
+            )
+        await self._send_done(ai_response, mode, is_automatic, _was_cancelled(response_data))
+
+    async def _admit(self, message, model_mode):
+        """
+        Check the chat limit and rate limit, then wait for a generation slot.
+
+        Returns:
+            Admission: The held slot, or None if the turn was refused or cancelled
+        """
+        # Re-counted every turn: the session may also get messages over HTTP
+        self.messages_count = await Chat.objects.filter(user=self.user, chat_session=self.chat_session).acount()
+        if self.messages_count >= MESSAGES_PER_SESSION:
+            await self._send_error('Chat limit reached. Please start a new chat.', limit_reached=True)
+            return None
+        limiter = get_rate_limiter()
+        try:
+            if limiter is not None:
+                await sync_to_async(limiter.check, thread_sensitive=False)(
+                    self.user.pk, estimate_generation_tokens(message, model_mode)
+                )
+            return await acquire_generation_slot_async(self.user.pk)
+        except (RateLimited, AdmissionRejected) as refused:
+            body, _, _ = _refusal(refused)
+            await self._send_error(**body)
+        except asyncio.CancelledError:
+            # Cancelled while queued (the client's "cancel" or a disconnect)
+            await self._send_done('', None, model_mode == 'auto', cancelled=True)
+        return None
+
+    async def _stream(self, admission, message, model_mode):
+        """Run the generation on an inference thread, forwarding its tokens as they arrive."""
+        loop = asyncio.get_running_loop()
+        tokens = asyncio.Queue()
+        with record_latency(endpoint="websocket_chat") as latency_labels:
+            future = loop.run_in_executor(
+                inference_executor,
+                functools.partial(
+                    _generate_turn, self.user, self.chat_session, message, model_mode,
+                    functools.partial(loop.call_soon_threadsafe, tokens.put_nowait), self._cancel_token
+                )
+            )
+
+            def finished(_):
+                admission.release()
+                tokens.put_nowait(None)
+            future.add_done_callback(finished)
+
+            # Coalesce tokens that queued up while the previous frame was sent
+            done = False
+            while not done:
+                pieces = [await tokens.get()]
+                while not tokens.empty():
+                    pieces.append(tokens.get_nowait())
+                if pieces[-1] is None:
+                    pieces.pop()
+                    done = True
+                if pieces:
+                    await self._send_json({'type': 'token', 'text': ''.join(pieces)})
+
+            response_data = future.result()
+            latency_labels["model_mode"] = _unpack_response(response_data, model_mode)[1]
+        return response_data
+
+    async def _send_done(self, response, mode, is_automatic, cancelled):
+        remaining_messages = MESSAGES_PER_SESSION - self.messages_count
+        await self._send_json({
+            'type': 'done',
+            'response': response,
+            'mode': mode,
+            'is_automatic': is_automatic,
+            'remaining_messages': remaining_messages,
+            'limit_reached': remaining_messages <= 0,
+            'cancelled': cancelled,
+        })
+
+    async def _send_error(self, error, **fields):
+        await self._send_json(dict(fields, type='error', error=error))
+
+    async def _send_json(self, data):
+        if self.closed:
+            return
+        try:
+            await self.send({'type': 'websocket.send', 'text': json.dumps(data)})
+        except Exception as e:
+            # The client went away mid-send; the receive loop sees the disconnect
+            logger.debug(f"WebSocket send failed: {str(e)}")
+            self.closed = True
+
+
+async def websocket_application(scope, receive, send):
+    """ASGI application for WebSocket connections."""
+    event = await receive()
+    if event['type'] != 'websocket.connect':
+        return
+    match = CHAT_PATH.fullmatch(scope['path'])
+    if match is None:
+        await send({'type': 'websocket.close', 'code': CLOSE_NOT_FOUND})
+        return
+    try:
+        await ChatSocket(scope, receive, send, match.group(1)).run()
+    except Exception:
+        logger.exception("WebSocket chat connection failed")
+        try:
+            await send({'type': 'websocket.close', 'code': 1011})
+        except Exception:
+            pass
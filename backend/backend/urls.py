@@ -1,6 +1,6 @@
 from django.contrib import admin
 from django.urls import path, include
-from api.views import CreateUserView, SignOutView
+from api.views import CreateUserView, SignOutView, prometheus_metrics
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 
 urlpatterns = [
@@ -11,4 +11,5 @@ urlpatterns = [
     path("api-auth/", include("rest_framework.urls")),
     path("api/", include("api.urls")),  # Includes new paths from api/urls.py
     path("api/user/signout/", SignOutView.as_view(), name="sign-out"),  # Direct access to sign-out
+    path("metrics", prometheus_metrics, name="metrics"),  # Prometheus/OpenMetrics scrape target
 ]
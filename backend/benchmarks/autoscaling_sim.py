@@ -0,0 +1,390 @@
+"""
+Autoscaling simulator for capacity planning.
+
+Replays a request arrival trace against simulated inference instances that
+scale under a scaling policy from api/scaling_policy.py, so policies and
+thresholds can be compared before they touch a live Auto Scaling Group.
+
+Each instance serves --slots generations at a time; a generation takes
+--prefill-seconds plus its completion tokens / --tokens-per-sec. Requests
+wait in one shared queue. New instances only take traffic after
+--cold-start seconds (instance boot, model download and load), and an
+instance removed by scale-in finishes its running requests first. Every
+--sample-interval seconds the same signals the service publishes
+(queue depth and tokens/sec per instance, p95 latency) are fed to the
+policy, exactly as AWSScalingManager would.
+
+The simulation is discrete-event on a virtual clock, so a day of traffic
+runs in about a second and is reproducible with --seed.
+
+Arrivals come from a trace (``epoch_seconds[,completion_tokens]`` per line,
+as written by ``python manage.py export_chat_arrivals``) or a synthetic day
+with a diurnal peak and a burst.
+
+With --predictive, capacity is also raised ahead of forecast peaks as in
+AWSScalingManager.apply_forecast: the forecaster is refitted every 6
+simulated hours on the arrivals so far (plus, for the synthetic day,
+--history-days of earlier synthetic traffic).
+
+Usage:
+    python benchmarks/autoscaling_sim.py
+    python benchmarks/autoscaling_sim.py --policy queue_latency,cpu,fixed --cold-start 600
+    python benchmarks/autoscaling_sim.py --trace arrivals.csv --timeline timeline.csv
+    python benchmarks/autoscaling_sim.py --policy queue_latency --predictive --cold-start 900
+"""
+
+import argparse
+import bisect
+import csv
+import heapq
+import inspect
+import math
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure()
+
+from api.latency_histogram import LatencyHistogram
+from api.scaling_policy import SCALING_POLICIES, SCALING_TARGET_UTILIZATION, ScalingPolicy, get_scaling_policy
+from api.traffic_forecast import TrafficForecaster, apply_forecast, plan_capacity
+
+FORECAST_REFIT_SECONDS = 6 * 3600
+
+
+def load_arrivals(path, default_tokens, rng):
+    """Read ``timestamp[,completion_tokens]`` lines, shifted to start at 0."""
+    arrivals = []
+    with open(path) as f:
+        for row in csv.reader(f):
+            if not row or not row[0].strip() or row[0].startswith('#'):
+                continue
+            tokens = int(row[1]) if len(row) > 1 and row[1].strip() else _sample_tokens(default_tokens, rng)
+            arrivals.append((float(row[0]), tokens))
+    arrivals.sort()
+    start = arrivals[0][0] if arrivals else 0.0
+    return [(timestamp - start, tokens) for timestamp, tokens in arrivals]
+
+
+def _sample_tokens(mean, rng):
+    # Response lengths are right-skewed; lognormal with sigma 0.6 keeps the mean
+    return max(1, int(rng.lognormvariate(math.log(mean) - 0.18, 0.6)))
+
+
+def synthetic_arrivals(hours, base_rate, peak_rate, mean_tokens, rng):
+    """
+    Non-homogeneous Poisson arrivals: ``base_rate`` at night rising to
+    ``peak_rate`` (requests/sec) mid-afternoon, plus a 20 minute burst at
+    twice the peak at 10:00.
+    """
+    def rate(t):
+        hour = (t / 3600) % 24
+        value = base_rate + (peak_rate - base_rate) * (1 - math.cos(2 * math.pi * (hour - 2) / 24)) / 2
+        if 10 <= hour < 10 + 1 / 3:
+            value = max(value, 2 * peak_rate)
+        return value
+
+    ceiling = 2 * peak_rate
+    arrivals = []
+    t = 0.0
+    # Thinning: draw at the ceiling rate and keep each arrival with probability rate(t) / ceiling
+    while True:
+        t += rng.expovariate(ceiling)
+        if t >= hours * 3600:
+            return arrivals
+        if rng.random() < rate(t) / ceiling:
+            arrivals.append((t, _sample_tokens(mean_tokens, rng)))
+
+
+class _Instance:
+    __slots__ = ('id', 'launched_at', 'ready_at', 'terminated_at', 'running', 'draining')
+
+    def __init__(self, instance_id, launched_at, ready_at):
+        self.id = instance_id
+        self.launched_at = launched_at
+        self.ready_at = ready_at
+        self.terminated_at = None
+        self.running = 0
+        self.draining = False
+
+
+def simulate(arrivals, policy, args, history=None):
+    """
+    Run the arrivals against a fleet scaled by ``policy`` (None keeps the
+    initial capacity fixed). If ``history`` (earlier arrival timestamps) is
+    given, forecast-driven pre-scaling is applied on top.
+
+    Returns:
+        dict: Latency and queue-wait histograms (ms), SLO attainment,
+        instance-hours, scale action counts and the sampled timeline
+    """
+    if policy is not None:
+        policy.reset()
+    instances = []
+    queue = []  # (arrival time, completion tokens), FIFO
+    queue_head = 0
+    latency = LatencyHistogram()
+    wait = LatencyHistogram()
+    within_slo = 0
+    actions = {'scale_out': 0, 'scale_in': 0}
+    timeline = []
+
+    events = []
+    sequence = 0
+
+    def push(time, kind, payload=None):
+        nonlocal sequence
+        sequence += 1
+        heapq.heappush(events, (time, sequence, kind, payload))
+
+    def launch(now, cold_start):
+        instance = _Instance(len(instances), now, now + cold_start)
+        instances.append(instance)
+        push(instance.ready_at, 'ready', instance)
+
+    for _ in range(args.initial):
+        launch(0.0, 0.0)
+    for arrival, tokens in arrivals:
+        push(arrival, 'arrival', tokens)
+    end_of_arrivals = arrivals[-1][0] if arrivals else 0.0
+    push(args.sample_interval, 'sample')
+
+    forecaster = None
+    if history is not None:
+        forecaster = TrafficForecaster()
+        arrival_times = [arrival for arrival, _ in arrivals]
+        mean_tokens = sum(tokens for _, tokens in arrivals) / max(len(arrivals), 1)
+        service_seconds = args.prefill_seconds + mean_tokens / args.tokens_per_sec
+    pre_scaled = 0
+
+    # Per sample interval
+    interval_tokens = 0
+    interval_latency = LatencyHistogram()
+    interval_arrivals = 0
+
+    def active():
+        return [i for i in instances if i.terminated_at is None and not i.draining]
+
+    def dispatch(now):
+        nonlocal queue_head
+        while queue_head < len(queue):
+            free = [i for i in active() if i.ready_at <= now and i.running < args.slots]
+            if not free:
+                return
+            instance = min(free, key=lambda i: (i.running, i.id))
+            arrived, tokens = queue[queue_head]
+            queue_head += 1
+            instance.running += 1
+            wait.record((now - arrived) * 1000)
+            service = args.prefill_seconds + tokens / args.tokens_per_sec
+            push(now + service, 'finish', (instance, arrived, tokens))
+
+    now = 0.0
+    while events:
+        now, _, kind, payload = heapq.heappop(events)
+        if kind == 'arrival':
+            queue.append((now, payload))
+            interval_arrivals += 1
+            dispatch(now)
+        elif kind == 'ready':
+            dispatch(now)
+        elif kind == 'finish':
+            instance, arrived, tokens = payload
+            instance.running -= 1
+            total = now - arrived
+            latency.record(total * 1000)
+            interval_latency.record(total * 1000)
+            interval_tokens += tokens
+            within_slo += total <= args.slo
+            if instance.draining and instance.running == 0:
+                instance.terminated_at = now
+            dispatch(now)
+        elif kind == 'sample':
+            fleet = active()
+            ready = [i for i in fleet if i.ready_at <= now]
+            serving = max(len(ready), 1)
+            waiting = len(queue) - queue_head
+            running = sum(i.running for i in ready)
+            sample = {
+                'timestamp': now,
+                'capacity': len(fleet),
+                'min_capacity': args.min_capacity,
+                'max_capacity': args.max_capacity,
+                'pending': len(ready) < len(fleet),
+                'queue_depth': (waiting + running) / serving,
+                'tokens_per_sec': interval_tokens / args.sample_interval / serving,
+                'p95_latency': interval_latency.percentile(95) / 1000 if interval_latency.count else None,
+                # A loaded llama.cpp instance is CPU bound whatever its queue
+                'cpu_utilization': 100.0 * min(1.0, running / (serving * args.slots)) if ready else 0.0,
+            }
+            if policy is not None:
+                decision = policy.evaluate(sample)
+            else:
+                decision = {'action': 'hold', 'capacity': len(fleet), 'desired': len(fleet), 'reason': 'fixed'}
+            if forecaster is not None:
+                if forecaster.fitted_at is None or now - forecaster.fitted_at >= FORECAST_REFIT_SECONDS:
+                    seen = arrival_times[:bisect.bisect_left(arrival_times, now)]
+                    forecaster.fit(list(history) + seen, now)
+                plan = plan_capacity(forecaster, now, args.cold_start, service_seconds,
+                                     slots=args.slots, target_utilization=SCALING_TARGET_UTILIZATION)
+                decision = apply_forecast(decision, plan, args.min_capacity, args.max_capacity)
+                pre_scaled += decision.get('predictive', False) and decision['action'] == 'scale_out'
+            action = decision['action']
+            if action != 'hold':
+                if action == 'scale_out':
+                    for _ in range(decision['desired'] - len(fleet)):
+                        launch(now, args.cold_start)
+                elif action == 'scale_in':
+                    for _ in range(len(fleet) - decision['desired']):
+                        # Cancel a booting instance first, else drain the least busy
+                        victim = min(active(), key=lambda i: (i.ready_at <= now, i.running, -i.id))
+                        victim.draining = True
+                        if victim.running == 0:
+                            victim.terminated_at = now
+                actions[action] += 1
+            timeline.append({
+                'time': now,
+                'arrivals': interval_arrivals,
+                'instances': len(fleet),
+                'ready': len(ready),
+                'queue': waiting,
+                'queue_depth_per_instance': round(sample['queue_depth'], 2),
+                'p95_latency': round(sample['p95_latency'], 1) if sample['p95_latency'] is not None else '',
+                'action': action,
+            })
+            interval_tokens = 0
+            interval_latency = LatencyHistogram()
+            interval_arrivals = 0
+            if now < end_of_arrivals or queue_head < len(queue):
+                push(now + args.sample_interval, 'sample')
+
+    instance_seconds = sum((i.terminated_at if i.terminated_at is not None else now) - i.launched_at
+                           for i in instances)
+    return {
+        'latency': latency,
+        'wait': wait,
+        'slo_attainment': within_slo / latency.count if latency.count else 1.0,
+        'instance_hours': instance_seconds / 3600,
+        'peak_instances': max((row['instances'] for row in timeline), default=args.initial),
+        'actions': actions,
+        'pre_scaled': pre_scaled,
+        'timeline': timeline,
+    }
+
+
+def make_policy(name, overrides):
+    """Create a policy with the overrides it accepts (None for "fixed")."""
+    if name == 'fixed':
+        return None
+    if name not in SCALING_POLICIES:
+        raise SystemExit(f"Unknown policy {name}")
+    accepted = set(inspect.signature(SCALING_POLICIES[name].__init__).parameters)
+    accepted |= set(inspect.signature(ScalingPolicy.__init__).parameters)
+    return get_scaling_policy(name, **{k: v for k, v in overrides.items() if k in accepted})
+
+
+def print_timeline(timeline, report_interval, sample_interval):
+    per_row = max(1, int(report_interval / sample_interval))
+    print(f"{'hour':>6}{'arrivals':>10}{'instances':>11}{'max queue':>11}{'max q/inst':>12}{'p95 s':>8}")
+    for start in range(0, len(timeline), per_row):
+        rows = timeline[start:start + per_row]
+        p95s = [row['p95_latency'] for row in rows if row['p95_latency'] != '']
+        print(f"{rows[0]['time'] / 3600:>6.1f}{sum(row['arrivals'] for row in rows):>10}"
+              f"{max(row['instances'] for row in rows):>11}{max(row['queue'] for row in rows):>11}"
+              f"{max(row['queue_depth_per_instance'] for row in rows):>12.1f}"
+              f"{(max(p95s) if p95s else 0):>8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--trace', help='Arrival trace: epoch_seconds[,completion_tokens] per line')
+    parser.add_argument('--hours', type=float, default=24, help='Synthetic trace length')
+    parser.add_argument('--base-rate', type=float, default=0.02, help='Synthetic night-time requests/sec')
+    parser.add_argument('--peak-rate', type=float, default=0.15, help='Synthetic peak requests/sec')
+    parser.add_argument('--response-tokens', type=int, default=150, help='Mean completion tokens')
+    parser.add_argument('--tokens-per-sec', type=float, default=15.0, help='Decode speed per generation')
+    parser.add_argument('--prefill-seconds', type=float, default=1.5)
+    parser.add_argument('--slots', type=int, default=1, help='Concurrent generations per instance')
+    parser.add_argument('--cold-start', type=float, default=300, help='Seconds from launch to serving')
+    parser.add_argument('--initial', type=int, default=2, help='Instances at the start')
+    parser.add_argument('--min-capacity', type=int, default=1)
+    parser.add_argument('--max-capacity', type=int, default=10)
+    parser.add_argument('--sample-interval', type=float, default=60, help='Seconds between policy evaluations')
+    parser.add_argument('--slo', type=float, default=60, help='Latency SLO for the attainment figure (seconds)')
+    parser.add_argument('--policy', default='queue_latency',
+                        help=f"Comma-separated: {', '.join(SCALING_POLICIES)} or fixed")
+    # Policy parameter overrides (default: the scaling_policy settings)
+    parser.add_argument('--latency-slo', type=float, help='Policy p95 latency SLO (seconds)')
+    parser.add_argument('--target-queue-depth', type=float)
+    parser.add_argument('--instance-tokens-per-sec', type=float)
+    parser.add_argument('--scale-out-cooldown', type=float)
+    parser.add_argument('--scale-in-cooldown', type=float)
+    parser.add_argument('--scale-in-stable', type=float, dest='scale_in_stable_seconds')
+    parser.add_argument('--report-interval', type=float, default=3600, help='Timeline row width (seconds)')
+    parser.add_argument('--predictive', action='store_true', help='Also pre-scale from a traffic forecast')
+    parser.add_argument('--history-days', type=int, default=14,
+                        help='Synthetic history the forecaster starts with (--predictive without --trace)')
+    parser.add_argument('--timeline', help='Write the per-sample timeline of the first policy to this CSV')
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    history = None
+    if args.trace:
+        arrivals = load_arrivals(args.trace, args.response_tokens, rng)
+        if args.predictive:
+            history = []
+    else:
+        arrivals = synthetic_arrivals(args.hours, args.base_rate, args.peak_rate, args.response_tokens, rng)
+        if args.predictive:
+            # Earlier days of the same pattern, ending where the simulation starts
+            past = synthetic_arrivals(args.history_days * 24, args.base_rate, args.peak_rate,
+                                      args.response_tokens, random.Random(args.seed + 1))
+            history = [arrival - args.history_days * 86400 for arrival, _ in past]
+    span = arrivals[-1][0] / 3600 if arrivals else 0
+    print(f"{len(arrivals)} requests over {span:.1f}h, {args.slots} slot(s) x {args.tokens_per_sec} tokens/s "
+          f"per instance, cold start {args.cold_start:.0f}s\n")
+
+    overrides = {
+        key: getattr(args, key) for key in (
+            'latency_slo', 'target_queue_depth', 'instance_tokens_per_sec',
+            'scale_out_cooldown', 'scale_in_cooldown', 'scale_in_stable_seconds',
+        ) if getattr(args, key) is not None
+    }
+    results = []
+    for name in args.policy.split(','):
+        name = name.strip()
+        policy = make_policy(name, overrides)
+        result = simulate(arrivals, policy, args, history)
+        if history is not None:
+            name += '+forecast'
+        results.append((name, result))
+        if len(results) == 1:
+            print(f"timeline ({name}):")
+            print_timeline(result['timeline'], args.report_interval, args.sample_interval)
+            if args.timeline:
+                with open(args.timeline, 'w', newline='') as f:
+                    writer = csv.DictWriter(f, fieldnames=list(result['timeline'][0]))
+                    writer.writeheader()
+                    writer.writerows(result['timeline'])
+            print()
+
+    print(f"{'policy':<15}{'p50 s':>8}{'p95 s':>8}{'p99 s':>8}{'wait p95':>10}{'in SLO':>8}"
+          f"{'inst-h':>9}{'peak':>6}{'out/in':>8}")
+    for name, result in results:
+        latency = result['latency']
+        print(f"{name:<15}{latency.percentile(50) / 1000:>8.1f}{latency.percentile(95) / 1000:>8.1f}"
+              f"{latency.percentile(99) / 1000:>8.1f}{result['wait'].percentile(95) / 1000:>10.1f}"
+              f"{result['slo_attainment']:>8.1%}{result['instance_hours']:>9.1f}{result['peak_instances']:>6}"
+              f"{result['actions']['scale_out']:>4}/{result['actions']['scale_in']:<3}")
+        if result['pre_scaled']:
+            print(f"{'':<15}({result['pre_scaled']} scale-outs ahead of forecast peaks)")
+
+
+if __name__ == '__main__':
+    main()
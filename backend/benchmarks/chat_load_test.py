@@ -0,0 +1,218 @@
+"""
+Load test the chat endpoint over WSGI and ASGI.
+
+Opens N concurrent connections against each target, each posting one chat
+message in a new session, and reports per concurrency level: status codes
+(200, 429/503 shed by admission control, connection errors), latency
+percentiles, throughput, and, given the server's /metrics URL, the workers'
+resident memory.
+
+Run the same backend under both servers, e.g.:
+
+    gunicorn backend.wsgi --workers 1 --threads 8 --bind 127.0.0.1:8000
+    uvicorn backend.asgi:application --workers 1 --port 8001     # pip install uvicorn
+
+    python benchmarks/chat_load_test.py \\
+        --target wsgi=http://127.0.0.1:8000/api/chat/ \\
+        --target asgi=http://127.0.0.1:8001/api/async/chat/ \\
+        --concurrency 10,50,200 --users 20
+
+Load test users (loadtest-0, loadtest-1, ...) are registered on first use.
+Requests are spread over them so the per-user queue and token limits do not
+dominate. Only the standard library is used.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import uuid
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api.latency_histogram import LatencyHistogram
+
+PROMPTS = (
+    "Explain the difference between a process and a thread.",
+    "What is 17 * 23? Show your working.",
+    "Summarize the causes of the French Revolution in three sentences.",
+    "Write a haiku about load testing.",
+)
+
+
+async def http_request(url, method='GET', body=None, headers=None, timeout=120.0):
+    """
+    Minimal HTTP/1.1 client (one connection per request).
+
+    Returns:
+        tuple: (status code, headers dict, body bytes)
+    """
+    parts = urlsplit(url)
+    if parts.scheme == 'https':
+        import ssl
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(parts.hostname, parts.port or 443, ssl=ssl.create_default_context()), timeout
+        )
+    else:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(parts.hostname, parts.port or 80), timeout)
+    try:
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        data = json.dumps(body).encode() if body is not None else b''
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {parts.netloc}", "Connection: close",
+                 f"Content-Length: {len(data)}"]
+        if body is not None:
+            lines.append("Content-Type: application/json")
+        lines.extend(f"{name}: {value}" for name, value in (headers or {}).items())
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + data)
+        await writer.drain()
+        raw = await asyncio.wait_for(reader.read(), timeout)
+    finally:
+        writer.close()
+    head, _, payload = raw.partition(b"\r\n\r\n")
+    head_lines = head.decode('latin-1').split("\r\n")
+    status = int(head_lines[0].split()[1])
+    response_headers = {}
+    for line in head_lines[1:]:
+        name, _, value = line.partition(':')
+        response_headers[name.strip().lower()] = value.strip()
+    if response_headers.get('transfer-encoding') == 'chunked':
+        payload = _dechunk(payload)
+    return status, response_headers, payload
+
+
+def _dechunk(payload):
+    body = b''
+    while payload:
+        size_line, _, payload = payload.partition(b"\r\n")
+        size = int(size_line.split(b';')[0], 16)
+        if size == 0:
+            break
+        body += payload[:size]
+        payload = payload[size + 2:]
+    return body
+
+
+async def get_tokens(base_url, users, password):
+    """Register (if needed) and log in the load test users; return their access tokens."""
+    async def token_for(index):
+        username = f"loadtest-{index}"
+        credentials = {'username': username, 'password': password}
+        # 400 if the user already exists
+        await http_request(f"{base_url}/api/user/register/", 'POST', credentials)
+        status, _, body = await http_request(f"{base_url}/api/token/", 'POST', credentials)
+        if status != 200:
+            raise SystemExit(f"login as {username} failed: {status} {body[:200]!r}")
+        return json.loads(body)['access']
+    return await asyncio.gather(*(token_for(index) for index in range(users)))
+
+
+async def resident_memory(metrics_url):
+    """Sum of llm_process_resident_memory_bytes over the workers, in MB (None if unavailable)."""
+    try:
+        status, _, body = await http_request(metrics_url, timeout=10)
+    except (OSError, asyncio.TimeoutError):
+        return None
+    if status != 200:
+        return None
+    total = 0.0
+    for line in body.decode().splitlines():
+        if line.startswith('llm_process_resident_memory_bytes{'):
+            total += float(line.rsplit(' ', 1)[1])
+    return total / (1024 * 1024) if total else None
+
+
+async def run_level(url, tokens, concurrency, requests, timeout):
+    """Send ``requests`` chat requests with ``concurrency`` in flight; return the results."""
+    histogram = LatencyHistogram()
+    statuses = {}
+    in_flight = [0, 0]  # current, peak
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(index):
+        async with semaphore:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight[1], in_flight[0])
+            body = {
+                'message': PROMPTS[index % len(PROMPTS)],
+                'chat_session': f"loadtest-{uuid.uuid4().hex[:12]}",
+                'model_mode': 'default',
+            }
+            start = time.time()
+            try:
+                status, _, _ = await http_request(
+                    url, 'POST', body, {'Authorization': f"Bearer {tokens[index % len(tokens)]}"}, timeout
+                )
+                key = str(status)
+            except asyncio.TimeoutError:
+                key = 'timeout'
+            except OSError as e:
+                key = type(e).__name__
+            finally:
+                in_flight[0] -= 1
+            statuses[key] = statuses.get(key, 0) + 1
+            if key == '200':
+                histogram.record((time.time() - start) * 1000)
+
+    start = time.time()
+    await asyncio.gather(*(one(index) for index in range(requests)))
+    return {
+        'wall': time.time() - start,
+        'statuses': statuses,
+        'latency': histogram,
+        'peak_in_flight': in_flight[1],
+    }
+
+
+async def run(args):
+    targets = []
+    for target in args.target:
+        name, _, url = target.partition('=')
+        if not url:
+            raise SystemExit(f"--target must be NAME=URL, got {target!r}")
+        targets.append((name, url))
+    levels = [int(level) for level in args.concurrency.split(',')]
+
+    print(f"{'target':<8} {'conc':>5} {'reqs':>5} {'ok':>5} {'shed':>5} {'other':>6} "
+          f"{'p50 s':>7} {'p95 s':>7} {'max s':>7} {'ok/s':>6} {'RSS MB':>7}")
+    for name, url in targets:
+        parts = urlsplit(url)
+        base_url = f"{parts.scheme}://{parts.netloc}"
+        tokens = await get_tokens(base_url, args.users, args.password)
+        for concurrency in levels:
+            requests = args.requests or 2 * concurrency
+            result = await run_level(url, tokens, concurrency, requests, args.timeout)
+            memory = await resident_memory(args.metrics or f"{base_url}/metrics")
+            statuses = result['statuses']
+            ok = statuses.get('200', 0)
+            shed = statuses.get('429', 0) + statuses.get('503', 0)
+            latency = result['latency']
+            print(f"{name:<8} {concurrency:>5} {requests:>5} {ok:>5} {shed:>5} {requests - ok - shed:>6} "
+                  f"{latency.percentile(50) / 1000:>7.1f} {latency.percentile(95) / 1000:>7.1f} "
+                  f"{latency.max_ms / 1000 if latency.count else 0:>7.1f} {ok / result['wall']:>6.2f} "
+                  f"{memory if memory is not None else float('nan'):>7.0f}")
+            other = {key: count for key, count in statuses.items() if key not in ('200', '429', '503')}
+            if other:
+                print(f"{'':<8} other: {other}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--target', action='append', required=True,
+                        help='NAME=URL of a chat endpoint (repeatable)')
+    parser.add_argument('--concurrency', default='10,50,200', help='Comma-separated concurrency levels')
+    parser.add_argument('--requests', type=int, help='Requests per level (default: 2 x concurrency)')
+    parser.add_argument('--users', type=int, default=20, help='Load test users to spread requests over')
+    parser.add_argument('--password', default='loadtest-password')
+    parser.add_argument('--timeout', type=float, default=120.0, help='Per-request timeout (seconds)')
+    parser.add_argument('--metrics', help='OpenMetrics URL for worker memory (default: <target>/metrics)')
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
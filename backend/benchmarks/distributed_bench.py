@@ -0,0 +1,89 @@
+"""
+Distributed inference throughput and failover benchmark.
+
+Drives DistributedInference (dispatch pool, balancer, hash ring, hedging)
+against running inference nodes, normally the fake ones from
+fake_inference_node.py, and reports throughput, latency percentiles,
+errors and how requests spread over the nodes.
+
+Usage:
+    python benchmarks/fake_inference_node.py --nodes 3 --port 8101 --failure-rate 0.05 &
+    INFERENCE_NODES=127.0.0.1:8101,127.0.0.1:8102,127.0.0.1:8103 \\
+        python benchmarks/distributed_bench.py --requests 300 --concurrency 12
+
+Kill one of the nodes mid-run to watch failover (circuit opens, sessions
+move to the next node along the ring).
+"""
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(DISCOVERY_REFRESH_INTERVAL=2)
+
+from api.latency_histogram import LatencyHistogram
+from api.distributed_inference import distributed_inference, get_dispatch_stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--concurrency', type=int, default=12, help='Requests in flight at once')
+    parser.add_argument('--sessions', type=int, default=50, help='Distinct chat sessions')
+    parser.add_argument('--timeout', type=float, default=120.0)
+    args = parser.parse_args()
+
+    if not os.environ.get('INFERENCE_NODES') and not os.environ.get('INFERENCE_NODES_FILE'):
+        parser.error("set INFERENCE_NODES (see fake_inference_node.py)")
+
+    # Wait for the first background discovery refresh
+    deadline = time.time() + 10
+    while not distributed_inference._get_inference_nodes() and time.time() < deadline:
+        time.sleep(0.1)
+    print(f"nodes: {[node['id'] for node in distributed_inference._get_inference_nodes()]}")
+
+    histogram = LatencyHistogram()
+    errors = 0
+    served_by = {}
+
+    def one(index):
+        start = time.time()
+        future = distributed_inference.submit_request({
+            'input': f"benchmark question {index}",
+            'session_id': f"bench-session-{index % args.sessions}",
+            'model_mode': 'default',
+        })
+        result = future.result(timeout=args.timeout)
+        return time.time() - start, result
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for latency, result in executor.map(one, range(args.requests)):
+            if 'error' in result:
+                errors += 1
+            else:
+                histogram.record(latency * 1000)
+                node = result.get('node', 'local')
+                served_by[node] = served_by.get(node, 0) + 1
+    wall = time.time() - start
+
+    summary = histogram.summary()
+    print(f"\n{args.requests} requests in {wall:.1f}s ({args.requests / wall:.1f} req/s), {errors} errors")
+    print(f"latency ms: p50={summary['p50_ms']:.0f} p90={summary['p90_ms']:.0f} "
+          f"p99={summary['p99_ms']:.0f} max={summary['max_ms']:.0f}")
+    print(f"served by: {served_by}")
+    stats = get_dispatch_stats()
+    print(f"hedging: {stats['hedging']}")
+    for node_id, health in sorted(stats['health'].items()):
+        print(f"  {node_id}: {health}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+"""
+Fake inference node for exercising distributed inference locally.
+
+Serves the same ``POST /api/inference/`` contract as a real node, but
+instead of running the model it sleeps for a prefill delay plus
+``tokens / tokens-per-sec`` and returns filler text. Failures are injected
+at a configurable rate, and each node runs one generation at a time like a
+single llama.cpp instance (raise --concurrency to change that).
+
+Only the standard library is used, so nodes start instantly and need no
+model file or Django.
+
+Usage:
+    # Three nodes on ports 8101-8103, the last one slow and flaky
+    python benchmarks/fake_inference_node.py --nodes 2 --port 8101 &
+    python benchmarks/fake_inference_node.py --port 8103 --tokens-per-sec 5 --failure-rate 0.3 &
+
+    # Point the service at them
+    INFERENCE_NODES=127.0.0.1:8101,127.0.0.1:8102,127.0.0.1:8103 python manage.py runserver
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FILLER_WORDS = ("the", "model", "answer", "is", "a", "token", "of", "inference", "node", "reply")
+
+
+class FakeNode:
+    """Simulated model: prefill latency, decode speed, failure rate and a concurrency limit."""
+
+    def __init__(self, name, prefill_latency, tokens_per_sec, response_tokens, failure_rate, concurrency, seed=None):
+        self.name = name
+        self.prefill_latency = prefill_latency
+        self.tokens_per_sec = tokens_per_sec
+        self.response_tokens = response_tokens
+        self.failure_rate = failure_rate
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'failures': 0, 'in_flight': 0}
+
+    def _count(self, key, amount=1):
+        with self.lock:
+            self.stats[key] += amount
+
+    def generate(self, payload):
+        """
+        Yield tokens at the configured pace.
+
+        Raises:
+            RuntimeError: For an injected failure (after the prefill delay)
+        """
+        with self.lock:
+            fail = self.rng.random() < self.failure_rate
+            tokens = max(1, int(self.rng.gauss(self.response_tokens, self.response_tokens * 0.2)))
+        with self.slots:
+            self._count('in_flight')
+            try:
+                time.sleep(self.prefill_latency)
+                if fail:
+                    self._count('failures')
+                    raise RuntimeError("injected failure")
+                interval = 1.0 / self.tokens_per_sec
+                for index in range(tokens):
+                    time.sleep(interval)
+                    yield FILLER_WORDS[index % len(FILLER_WORDS)] + " "
+            finally:
+                self._count('in_flight', -1)
+
+
+def make_handler(node):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def _send_json(self, status, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path.rstrip('/') == '/api/health':
+                with node.lock:
+                    stats = dict(node.stats)
+                self._send_json(200, {'status': 'ok', 'node': node.name, **stats})
+            else:
+                self._send_json(404, {'error': 'Not found'})
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if self.path.rstrip('/') != '/api/inference':
+                self._send_json(404, {'error': 'Not found'})
+                return
+            try:
+                payload = json.loads(body or b'{}')
+            except ValueError:
+                self._send_json(400, {'error': 'Invalid JSON'})
+                return
+
+            node._count('requests')
+            model_mode = payload.get('model_mode', 'auto')
+            mode = "Math Correct" if model_mode == "math" else "GPT4 Correct"
+            try:
+                if payload.get('stream'):
+                    self._stream(node.generate(payload))
+                    return
+                response = "".join(node.generate(payload)).strip()
+            except RuntimeError as e:
+                self._send_json(500, {'error': str(e), 'response': 'Error processing your request', 'node': node.name})
+                return
+            self._send_json(200, {
+                'response': response,
+                'mode': mode,
+                'is_automatic': model_mode == 'auto',
+                'node': node.name,
+            })
+
+        def _stream(self, tokens):
+            # Prefill (and any injected failure) happens before the first token,
+            # so the status line can still report the error
+            try:
+                first = next(tokens)
+            except RuntimeError as e:
+                self._send_json(500, {'error': str(e), 'node': node.name})
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for token in _prepend(first, tokens):
+                data = token.encode('utf-8')
+                self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+            self.wfile.write(b"0\r\n\r\n")
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def _prepend(first, rest):
+    yield first
+    yield from rest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8101, help='Port of the first node')
+    parser.add_argument('--nodes', type=int, default=1, help='Nodes to start on consecutive ports')
+    parser.add_argument('--latency', type=float, default=0.2, help='Prefill delay in seconds')
+    parser.add_argument('--tokens-per-sec', type=float, default=40.0)
+    parser.add_argument('--response-tokens', type=int, default=60, help='Mean tokens per response')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Share of requests that fail')
+    parser.add_argument('--concurrency', type=int, default=1, help='Concurrent generations per node')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    servers = []
+    for index in range(args.nodes):
+        port = args.port + index
+        node = FakeNode(
+            f"{args.host}:{port}", args.latency, args.tokens_per_sec, args.response_tokens,
+            args.failure_rate, args.concurrency,
+            seed=None if args.seed is None else args.seed + index,
+        )
+        server = ThreadingHTTPServer((args.host, port), make_handler(node))
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+
+    addresses = ",".join(f"{args.host}:{server.server_address[1]}" for server in servers)
+    print(f"Fake inference nodes running: INFERENCE_NODES={addresses}", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        for server in servers:
+            server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
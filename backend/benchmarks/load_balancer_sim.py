@@ -0,0 +1,129 @@
+"""
+Load balancer simulation benchmark.
+
+Replays the same Poisson request stream against a set of fake inference
+nodes with skewed latencies (one slow node, one failing node) and compares
+uniform random selection with the power-of-two-choices LoadBalancer.
+
+The simulation is discrete-event on a virtual clock, so it runs in well
+under a second and is reproducible with --seed.
+
+Usage:
+    python benchmarks/load_balancer_sim.py [--requests 20000] [--rate 6] [--seed 7]
+"""
+
+import argparse
+import heapq
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure()
+
+from api.latency_histogram import LatencyHistogram
+from api.load_balancer import LoadBalancer
+
+# Fake nodes: mean service time in seconds when idle, and failure probability.
+# Service time grows with the number of requests already running on the node.
+NODES = [
+    {'id': 'fast-1', 'latency': 0.4, 'failure_rate': 0.01},
+    {'id': 'fast-2', 'latency': 0.5, 'failure_rate': 0.01},
+    {'id': 'medium', 'latency': 0.9, 'failure_rate': 0.02},
+    {'id': 'slow', 'latency': 3.0, 'failure_rate': 0.02},
+    {'id': 'failing', 'latency': 0.05, 'failure_rate': 0.9},
+]
+CONGESTION_FACTOR = 0.35
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def simulate(strategy, requests, rate, seed):
+    """
+    Run one strategy over the request stream.
+
+    Returns:
+        dict: Latency summary of successful requests plus error and per-node counts
+    """
+    rng = random.Random(seed)
+    node_rng = random.Random(seed + 1)
+    clock = _Clock()
+    balancer = LoadBalancer(clock=clock, rng=random.Random(seed + 2))
+    in_flight = {node['id']: 0 for node in NODES}
+    sent = {node['id']: 0 for node in NODES}
+    histogram = LatencyHistogram()
+    errors = 0
+    fallbacks = 0
+
+    # Events: (time, sequence, kind, payload)
+    events = []
+    arrival = 0.0
+    for sequence in range(requests):
+        arrival += rng.expovariate(rate)
+        heapq.heappush(events, (arrival, sequence, 'arrival', None))
+    sequence = requests
+
+    while events:
+        clock.now, _, kind, payload = heapq.heappop(events)
+        if kind == 'arrival':
+            if strategy == 'random':
+                node = rng.choice(NODES)
+            else:
+                chosen = balancer.choose(NODES, key=lambda n: n['id'])
+                if not chosen:
+                    fallbacks += 1
+                    continue
+                node = chosen[0]
+            node_id = node['id']
+            balancer.start(node_id)
+            sent[node_id] += 1
+            service = node_rng.lognormvariate(0, 0.4) * node['latency']
+            service *= 1 + CONGESTION_FACTOR * in_flight[node_id]
+            in_flight[node_id] += 1
+            failed = node_rng.random() < node['failure_rate']
+            sequence += 1
+            heapq.heappush(events, (clock.now + service, sequence, 'done', (node_id, service, failed)))
+        else:
+            node_id, service, failed = payload
+            in_flight[node_id] -= 1
+            balancer.finish(node_id, service, not failed)
+            if failed:
+                errors += 1
+            else:
+                histogram.record(service * 1000)
+
+    result = histogram.summary()
+    result['errors'] = errors
+    result['local_fallbacks'] = fallbacks
+    result['sent'] = sent
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--rate', type=float, default=6.0, help='Arrivals per second')
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    print(f"{args.requests} requests at {args.rate}/s over {len(NODES)} nodes\n")
+    print(f"{'strategy':<10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'errors':>9}{'fallback':>10}  sent per node")
+    for strategy in ('random', 'p2c'):
+        result = simulate(strategy, args.requests, args.rate, args.seed)
+        sent = ' '.join(f"{node_id}={count}" for node_id, count in result['sent'].items())
+        print(f"{strategy:<10}{result['p50_ms']:>10.0f}{result['p90_ms']:>10.0f}{result['p99_ms']:>10.0f}"
+              f"{result['errors']:>9}{result['local_fallbacks']:>10}  {sent}")
+
+
+if __name__ == '__main__':
+    main()
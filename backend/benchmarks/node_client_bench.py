@@ -0,0 +1,110 @@
+"""
+Node HTTP client benchmark.
+
+Starts a local stub inference node (HTTP/1.1 keep-alive, fixed JSON reply)
+and measures per-request overhead of:
+
+1. A new connection per call, as the old bare ``requests.post`` did
+2. The shared pooled NodeHTTPClient
+
+Usage:
+    python benchmarks/node_client_bench.py [--requests 2000] [--threads 4]
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure()
+
+import urllib3
+
+from api.latency_histogram import LatencyHistogram
+from api.node_client import NodeHTTPClient
+
+REPLY = json.dumps({'response': 'ok', 'tokens_used': 1}).encode('utf-8')
+
+
+class _StubNodeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; without this, Nagle plus
+    # delayed ACKs adds ~40 ms to every keep-alive response
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(REPLY)))
+        self.end_headers()
+        self.wfile.write(REPLY)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _run(label, call, requests, threads):
+    histogram = LatencyHistogram()
+    lock = threading.Lock()
+
+    def one(_):
+        start = time.perf_counter()
+        call()
+        elapsed_us = (time.perf_counter() - start) * 1e6
+        with lock:
+            histogram.record(elapsed_us)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(one, range(requests)))
+    wall = time.perf_counter() - start
+    summary = histogram.summary(suffix="")
+    print(f"{label:<22}{summary['mean']:>10.0f}{summary['p50']:>10.0f}{summary['p99']:>10.0f}"
+          f"{requests / wall:>12.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _StubNodeHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/api/inference/"
+    payload = {'input': 'hello', 'session_id': 'bench', 'model_mode': 'default'}
+    body = json.dumps(payload)
+
+    def fresh_connection():
+        # One throwaway pool per call: new TCP connection every time
+        pool = urllib3.PoolManager()
+        pool.request('POST', url, body=body, headers={'Content-Type': 'application/json'},
+                     timeout=30, retries=False)
+        pool.clear()
+
+    client = NodeHTTPClient()
+
+    def pooled():
+        client.post_json(url, payload)
+
+    print(f"{args.requests} requests, {args.threads} threads (latency in microseconds)\n")
+    print(f"{'client':<22}{'mean':>10}{'p50':>10}{'p99':>10}{'req/s':>12}")
+    _run('new connection/call', fresh_connection, args.requests, args.threads)
+    _run('pooled keep-alive', pooled, args.requests, args.threads)
+    print(f"\npooled client stats: {client.get_stats()}")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+Replay a scaling policy against a recorded metric trace.
+
+Traces are JSON lines, either as written by AWSScalingManager when
+SCALING_TRACE_FILE is set (``{"sample": ..., "decision": ...}``) or bare
+samples (see api/scaling_policy.py for the fields). Every scale action the
+policy would take is printed, followed by a summary, and, for recorded
+traces, how many decisions differ from the ones made at the time.
+
+Without a trace, a synthetic day is generated instead: a slow daily ramp
+with a short burst at noon. Its capacity follows the policy's decisions
+(immediately, with no provisioning delay) and the per-instance signals are
+recomputed from the total load, which is enough to compare policies and
+parameters.
+
+Usage:
+    python benchmarks/replay_scaling_policy.py --trace scaling-trace.jsonl
+    python benchmarks/replay_scaling_policy.py --policy cpu
+    python benchmarks/replay_scaling_policy.py --latency-slo 10 --scale-in-stable 300
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure()
+
+from api.scaling_policy import SCALING_POLICIES, get_scaling_policy, replay
+
+
+def load_trace(path):
+    samples = []
+    recorded = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if 'sample' in entry:
+                samples.append(entry['sample'])
+                recorded.append(entry.get('decision'))
+            else:
+                samples.append(entry)
+                recorded.append(None)
+    return samples, recorded
+
+
+def synthetic_load(hours=24, step=60, seed=1):
+    """Yield (timestamp, requests in flight across the fleet) for a day with a burst at noon."""
+    rng = random.Random(seed)
+    for index in range(int(hours * 3600 / step)):
+        hour = index * step / 3600
+        load = 2 + 6 * (1 - math.cos(2 * math.pi * hour / 24)) / 2
+        if 12 <= hour < 12.5:
+            load += 10
+        yield index * step, load * rng.uniform(0.85, 1.15)
+
+
+def synthetic_sample(timestamp, load, capacity):
+    """Per-instance signals for ``load`` spread over ``capacity`` instances."""
+    queue_depth = load / capacity
+    return {
+        'timestamp': timestamp,
+        'capacity': capacity,
+        'min_capacity': 1,
+        'max_capacity': 10,
+        'queue_depth': queue_depth,
+        # One generation at a time per instance at ~8 tokens/sec
+        'tokens_per_sec': min(queue_depth, 1.0) * 8.0,
+        'p95_latency': 4.0 * max(queue_depth, 1.0),
+        'cpu_utilization': min(100.0, 60 + 40 * min(queue_depth, 1.0)),
+    }
+
+
+def replay_synthetic(policy, capacity=3):
+    """Run the policy over the synthetic day, applying each decision to capacity."""
+    policy.reset()
+    decisions = []
+    for timestamp, load in synthetic_load():
+        decision = policy.evaluate(synthetic_sample(timestamp, load, capacity))
+        capacity = decision['desired']
+        decisions.append(decision)
+    return decisions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--trace', help='JSON lines trace (default: synthetic day)')
+    parser.add_argument('--policy', default='queue_latency', choices=sorted(SCALING_POLICIES))
+    parser.add_argument('--target-queue-depth', type=float)
+    parser.add_argument('--instance-tokens-per-sec', type=float)
+    parser.add_argument('--latency-slo', type=float)
+    parser.add_argument('--scale-out-cooldown', type=float)
+    parser.add_argument('--scale-in-cooldown', type=float)
+    parser.add_argument('--scale-in-stable', type=float, dest='scale_in_stable_seconds')
+    parser.add_argument('--quiet', action='store_true', help='Only print the summary')
+    args = parser.parse_args()
+
+    overrides = {
+        key: value for key, value in vars(args).items()
+        if key not in ('trace', 'policy', 'quiet') and value is not None
+    }
+    policy = get_scaling_policy(args.policy, **overrides)
+
+    if args.trace:
+        samples, recorded = load_trace(args.trace)
+        decisions = replay(policy, samples)
+    else:
+        decisions = replay_synthetic(policy)
+        recorded = [None] * len(decisions)
+    counts = {}
+    differing = 0
+    for decision, previous in zip(decisions, recorded):
+        counts[decision['action']] = counts.get(decision['action'], 0) + 1
+        if previous is not None and previous['action'] != decision['action']:
+            differing += 1
+        if decision['action'] != 'hold' and not args.quiet:
+            print(f"t={decision['timestamp']:>8.0f}  {decision['action']:<9} "
+                  f"{decision['capacity']} -> {decision['desired']}  ({decision['reason']})")
+
+    capacities = [decision['desired'] for decision in decisions]
+    print(f"\n{len(decisions)} samples, policy {policy.name}: {counts}")
+    print(f"capacity: min {min(capacities)}, max {max(capacities)}, "
+          f"mean {sum(capacities) / len(capacities):.2f} instances")
+    if any(previous is not None for previous in recorded):
+        print(f"{differing} decisions differ from the recorded ones")
+
+
+if __name__ == '__main__':
+    main()